@@ -0,0 +1,48 @@
+"""
+Script to add integer time indexes to existing daily h5 files and build a
+catalog of all files with their station, start, end, and frame count.
+The catalog is written to {h5_dir}/catalog.h5
+
+Run from the base directory with:
+python3 src/data/build-h5-catalog.py data/interim/training/themis/
+
+Written by Riley Troyer
+science@rileytroyer.com
+"""
+# Import needed libraries
+from datetime import datetime
+from pathlib import Path
+import logging
+import os
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+from src.data.h5_reader import add_epoch_index, build_catalog
+
+# Important directories
+logs_dir = 'logs/'
+
+# Initiate logging
+logging.basicConfig(filename=logs_dir + f'build-h5-catalog-{datetime.today().date()}.log',
+                    encoding='utf-8',
+                    format='%(asctime)s %(levelname)-8s %(message)s',
+                    level=logging.INFO,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+#------------------------------Initializing done------------------------------
+
+h5_dir = sys.argv[1]
+
+# Files written before the epoch_us dataset existed need it added
+for root, dirs, files in os.walk(h5_dir):
+    for f in files:
+        if f.startswith('all-images-') and f.endswith('.h5'):
+            try:
+                add_epoch_index(os.path.join(root, f))
+            except Exception as e:
+                logging.warning(f'Unable to add time index to {f}: {e}')
+
+build_catalog(h5_dir)
@@ -0,0 +1,69 @@
+"""
+Script to build per-day time indexes of raw THEMIS or PFRR images.
+Only headers are read so this is much faster than decoding the images.
+Indexes are written to data/interim/time-index/themis/YYYY-MM-DD-{asi}.h5
+and data/interim/time-index/pfrr/YYYY-MM-DD-{wavelength}.h5
+
+Run from the base directory with:
+python3 src/data/build-time-index.py themis data/raw/testing/stream0 YYYY-MM-DD YYYY-MM-DD
+python3 src/data/build-time-index.py pfrr data/raw/training/pfrr YYYY-MM-DD YYYY-MM-DD
+
+Written by Riley Troyer
+science@rileytroyer.com
+"""
+# Import needed libraries
+from datetime import datetime, timedelta
+from pathlib import Path
+import logging
+import os
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+from src.data.time_index import build_pfrr_time_index, build_themis_time_index
+
+# Important directories
+logs_dir = 'logs/'
+index_dir = 'data/interim/time-index/'
+
+# How many threads to read headers with
+workers = 8
+
+# Initiate logging
+logging.basicConfig(filename=logs_dir + f'build-time-index-{datetime.today().date()}.log',
+                    encoding='utf-8',
+                    format='%(asctime)s %(levelname)-8s %(message)s',
+                    level=logging.INFO,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+#------------------------------Initializing done------------------------------
+
+camera_type, raw_dir = sys.argv[1], sys.argv[2]
+start_date = datetime.strptime(sys.argv[3], '%Y-%m-%d')
+end_date = datetime.strptime(sys.argv[4], '%Y-%m-%d')
+
+date = start_date
+while date <= end_date:
+
+    if camera_type == 'themis':
+        day_dir = os.path.join(raw_dir, date.strftime('%Y/%m/%d'))
+
+        if os.path.exists(day_dir):
+            for asi_name in sorted(os.listdir(day_dir)):
+                index_file = f'{index_dir}themis/{date.date()}-{asi_name[0:4]}.h5'
+                build_themis_time_index(os.path.join(day_dir, asi_name), index_file,
+                                        workers=workers)
+
+    else:
+        for day_dir in sorted(os.listdir(raw_dir)):
+            if not day_dir.startswith(str(date.date())):
+                continue
+            index_file = f'{index_dir}pfrr/{day_dir}.h5'
+            build_pfrr_time_index(os.path.join(raw_dir, day_dir), index_file,
+                                  workers=workers)
+
+    date += timedelta(days=1)
+
+logging.info('Finished building time indexes.')
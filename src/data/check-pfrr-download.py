@@ -0,0 +1,124 @@
+"""
+Script to check that PFRR downloads skip, resume and re-fetch files the way
+download_pfrr_images says they do, against a local ftp server instead of
+optics.gi.alaska.edu. The server serves random files laid out like the PFRR
+archive and records which files are retrieved and where retrievals restart.
+Needs pyftpdlib (pip install pyftpdlib), the downloads themselves don't.
+
+Run from the base directory with:
+python3 src/data/check-pfrr-download.py
+
+Written by Riley Troyer
+science@rileytroyer.com
+"""
+# Import needed libraries
+from datetime import date
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import sys
+import tempfile
+import threading
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+from src.data.pfrr_data_functions import FTPConnectionPool, _pfrr_day_dir, download_pfrr_images
+
+# Day and wavelength of the fake archive
+day = date(2021, 1, 5)
+wavelength = '558'
+
+logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                    level=logging.WARNING,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+#------------------------------Initializing done------------------------------
+
+if __name__ == '__main__':
+
+    work_dir = tempfile.mkdtemp(prefix='check-pfrr-download-')
+    ftp_root = os.path.join(work_dir, 'ftp')
+    save_dir = os.path.join(work_dir, 'save') + '/'
+
+    # Six 558 nm files and one 630 nm file that should be filtered out
+    remote_dir = ftp_root + _pfrr_day_dir(day)
+    os.makedirs(remote_dir)
+    filenames = ['PKR_DASC_0{}_{:%Y%m%d}_{:02d}0000.000.FITS'.format(wavelength, day, hour)
+                 for hour in range(6)]
+    for n, filename in enumerate(filenames + ['PKR_DASC_0630_{:%Y%m%d}_010000.000.FITS'.format(day)]):
+        with open(os.path.join(remote_dir, filename), 'wb') as f:
+            f.write(os.urandom(10000 + n))
+
+    def remote_bytes(filename:str) -> bytes:
+        with open(os.path.join(remote_dir, filename), 'rb') as f:
+            return f.read()
+
+    # Record what the downloads ask the server for
+    retrieved, restarts = [], []
+
+    class _RecordingHandler(FTPHandler):
+        def ftp_REST(self, line):
+            restarts.append(int(line))
+            return super().ftp_REST(line)
+
+        def on_file_sent(self, file):
+            retrieved.append(os.path.basename(file))
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(ftp_root)
+    _RecordingHandler.authorizer = authorizer
+
+    server = FTPServer(('127.0.0.1', 0), _RecordingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ftp_pool = FTPConnectionPool(host='127.0.0.1', port=server.socket.getsockname()[1], size=3)
+
+    # Local day directory from an earlier run without a manifest: one complete
+    # file, one interrupted download and one file of the wrong size
+    day_dir = save_dir + '{}-{}/'.format(day, wavelength)
+    os.makedirs(day_dir)
+    with open(day_dir + filenames[0], 'wb') as f:
+        f.write(remote_bytes(filenames[0]))
+    with open(day_dir + filenames[1] + '.part', 'wb') as f:
+        f.write(remote_bytes(filenames[1])[:4000])
+    with open(day_dir + filenames[2], 'wb') as f:
+        f.write(b'x'*5)
+
+    try:
+        download_pfrr_images(day, save_dir, wavelength=wavelength, processes=3,
+                             ftp_pool=ftp_pool, retries=1, backoff=0.1)
+
+        # Skip the complete file, resume the partial one, re-fetch the rest
+        assert sorted(retrieved) == sorted(filenames[1:]), retrieved
+        assert restarts == [4000], restarts
+        for filename in filenames:
+            with open(day_dir + filename, 'rb') as f:
+                assert f.read() == remote_bytes(filename), filename
+        assert not [f for f in os.listdir(day_dir) if f.endswith('.part')]
+
+        with open(day_dir + 'manifest.json', 'r') as f:
+            manifest = json.load(f)
+        assert sorted(manifest) == sorted(filenames), manifest
+        assert all(entry['status'] == 'done' for entry in manifest.values()), manifest
+        print('First run: skipped 1 file, resumed 1 and fetched {}.'.format(len(retrieved) - 1))
+
+        # Everything is in the manifest now, so nothing is retrieved again
+        retrieved.clear()
+        download_pfrr_images(day, save_dir, wavelength=wavelength, processes=3,
+                             ftp_pool=ftp_pool, retries=1, backoff=0.1)
+        assert retrieved == [], retrieved
+        print('Second run: nothing retrieved.')
+
+    finally:
+        ftp_pool.close()
+        server.close_all()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print('All PFRR download checks passed.')
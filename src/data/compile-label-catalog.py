@@ -0,0 +1,34 @@
+"""
+Script to compile the classification spreadsheets in docs/classifications/
+into the label catalog at data/interim/label-catalog.h5
+Scripts that need labels call get_label_catalog, which does this
+automatically when a spreadsheet changes, so this only forces a rebuild.
+
+Written by Riley Troyer
+science@rileytroyer.com
+"""
+# Import needed libraries
+from datetime import datetime
+from pathlib import Path
+import logging
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+from src.data.label_catalog import compile_label_catalog
+
+# Important directories
+logs_dir = 'logs/'
+
+# Initiate logging
+logging.basicConfig(filename=logs_dir + f'compile-label-catalog-{datetime.today().date()}.log',
+                    encoding='utf-8',
+                    format='%(asctime)s %(levelname)-8s %(message)s',
+                    level=logging.INFO,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+#------------------------------Initializing done------------------------------
+
+compile_label_catalog('docs/classifications/', 'data/interim/label-catalog.h5')
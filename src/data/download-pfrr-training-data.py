@@ -9,11 +9,8 @@ science@rileytroyer.com
 """
 # Import needed libraries
 from datetime import datetime
-from dateutil import parser
-import pandas as pd
 from pathlib import Path
 import logging
-import numpy as np
 import sys
 
 # Add root to path
@@ -21,12 +18,21 @@ path_root = Path(__file__).parents[2]
 sys.path.append(str(path_root))
 
 # Import functions to do downloading and processing
+from src.data.label_catalog import catalog_days, get_label_catalog
 from src.data.pfrr_data_functions import download_pfrr_images, pfrr_asi_to_hdf5_8bit_clahe
+from src.data.training_pipeline import run_download_process_pipeline
 
 # Important directories
 data_dir = 'data/'
 logs_dir = 'logs/'
 
+# How many days to download at once, and to process at once
+download_workers = 2
+process_workers = 1
+
+# Keeps track of finished days so a restart skips them
+manifest_file = data_dir + 'interim/training/pfrr-manifest.json'
+
 # Initiate logging
 logging.basicConfig(filename=logs_dir + f'download-pfrr-training-data-{datetime.today().date()}.log',
                     encoding='utf-8',
@@ -40,52 +46,44 @@ logging.basicConfig(filename=logs_dir + f'download-pfrr-training-data-{datetime.
 
 classification_dir = 'docs/classifications/'
 
-b1 = classification_dir + 'pfrr/New ML Batch 1 updated.xlsx'
-b2 = classification_dir + 'pfrr/New ML Batch 2 updated.xlsx'
-
-strfiles = [b1, b2]
+# Spreadsheets relative to classification_dir
+strfiles = ['pfrr/New ML Batch 1 updated.xlsx',
+            'pfrr/New ML Batch 2 updated.xlsx']
 
-days_list = []
+# Download day N+1 while day N is being processed
+def download_job(date):
+    # Each thread reuses one logged-in ftp connection, the server
+    # doesn't like too many connections at once
+    download_pfrr_images(date.date(), save_dir='data/raw/training/pfrr/',
+                         wavelength='558', processes=4)
 
-logging.info('Reading in classification files.')
+def process_job(date):
+    # Using more processes than cpu cores will slow this down
+    pfrr_asi_to_hdf5_8bit_clahe(date.date(), save_dir='data/raw/training/pfrr/',
+                                h5_dir='data/interim/training/pfrr/',
+                                wavelength='558', del_files=False, processes=4)
 
-# Read in classification csvs and combine into one full dataframe
-for strfile in strfiles:
+def output_file(date):
+    return f'data/interim/training/pfrr/all-images-{date.date()}-558.h5'
 
-    classification_csv = pd.read_excel(strfile, sheet_name='pfrr')
+def job_key(date):
+    return str(date.date())
 
-    days = [d.to_pydatetime() for d in classification_csv['Date']]
 
-    # Add days to master list
-    days_list.extend(days)
+if __name__ == '__main__':
 
-# Create a new column to combine station and date
-days_list = np.unique(days_list)
+    logging.info('Reading in label catalog.')
 
-# Loop through each day, download, and create .h5 file
-logging.info('Starting download and processing for all days.')
+    # Compiled from the classification spreadsheets, only rebuilt when they change
+    catalog = get_label_catalog(classification_dir)
+    days_list = [d for d, station in catalog_days(catalog, sources=strfiles)]
 
-for date in days_list:
-    
-    logging.info(f'Downloading images for {date} to data/raw/training/pfrr/.')
-    try: 
-        # Download the images to the raw directory
-        # You can use significantly more processes than cpu cores to speed this up
-        download_pfrr_images(date.date(), save_dir='data/raw/training/pfrr/',
-                            wavelength='558', processes=25)
-    except Exception as e:
-        logging.critical(f'Unable to download files for {date}. Stopped with error {e}')
-    
-    logging.info(f'Images downloaded. Starting to process images.')
-    try:
-        # Create the hdf5 file
-        # Using more processes than cpu cores will slow this down
-        pfrr_asi_to_hdf5_8bit_clahe(date.date(), save_dir='data/raw/training/pfrr/',
-                                    h5_dir='data/interim/training/pfrr/',
-                                    wavelength='558', del_files=False, processes=4)
-    except Exception as e:
-        logging.critical(f'Unable to create h5 file for {date}. Stopped with error {e}')
+    logging.info('Starting download and processing for all days.')
 
-    logging.info(f'Images processed. They are available at data/interim/training/pfrr/.')
+    run_download_process_pipeline(days_list, download_job, process_job, output_file,
+                                  manifest_file=manifest_file,
+                                  download_workers=download_workers,
+                                  process_workers=process_workers,
+                                  key_func=job_key)
 
-logging.info('Finished downloading and processing all days.')
\ No newline at end of file
+    logging.info('Finished downloading and processing all days.')
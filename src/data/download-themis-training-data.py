@@ -9,11 +9,8 @@ science@rileytroyer.com
 """
 # Import needed libraries
 from datetime import datetime
-from dateutil import parser
-import pandas as pd
 from pathlib import Path
 import logging
-import numpy as np
 import sys
 
 # Add root to path
@@ -21,12 +18,28 @@ path_root = Path(__file__).parents[2]
 sys.path.append(str(path_root))
 
 # Import functions to do downloading and processing
-from src.data.themis_data_functions import download_themis_images, themis_asi_to_hdf5_8bit_clahe
+from src.data.label_catalog import catalog_days, get_label_catalog
+from src.data.themis_data_functions import (download_themis_images, plan_themis_downloads,
+                                            themis_asi_to_hdf5_8bit_clahe)
+from src.data.training_pipeline import run_download_process_pipeline
 
 # Important directories
 data_dir = 'data/'
 logs_dir = 'logs/'
 
+# How many days to download at once, and to process at once
+download_workers = 4
+process_workers = 1
+
+# How many processes each day uses to read and CLAHE process hours
+hour_workers = 4
+
+# Keeps track of finished days so a restart skips them
+manifest_file = data_dir + 'interim/training/themis-manifest.json'
+
+# Parsed skymaps shared by all days and stations
+skymap_store_dir = 'data/interim/skymaps/themis/'
+
 # Initiate logging
 logging.basicConfig(filename=logs_dir + f'download-themis-training-data-{datetime.today().date()}.log',
                     encoding='utf-8',
@@ -45,78 +58,55 @@ logging.basicConfig(filename=logs_dir + f'download-themis-training-data-{datetim
 
 classification_dir = 'docs/classifications/'
 
-b20220901 = classification_dir + 'themis/classification-09092022 updated.xlsx'
-b20221017 = classification_dir + 'themis/classification-10012022.xlsx'
-b20221120 = classification_dir + 'themis/classification-11202022.xlsx'
-b20230201 = classification_dir + 'themis/classification-02012023.xlsx'
-
-strfiles = [b20220901, b20221017, b20221120, b20230201]
-
-days_list = []
-asis_list = []
-
-logging.info('Reading in classification files.')
-
-# Read in classification csvs and combine into one full dataframe
-for strfile in strfiles:
-
-    classification_csv = pd.read_excel(strfile, sheet_name='themis')
-
-    # Check format of date
-    if type(classification_csv['Date'][0]) == str:
-        days = [parser.isoparse(d) for d in classification_csv['Date']]
-
-    else:
-        days = [datetime(int(d[0:4]), int(d[4:6]), int(d[6:8]))
-                for d in classification_csv['Date'].astype(str)]
-
-
-    # Add days to master list
-    days_list.extend(days)
-
-    # Also extend asis
-    asis_list.extend(list(classification_csv['camera']))
+# Spreadsheets relative to classification_dir
+strfiles = ['themis/classification-09092022 updated.xlsx',
+            'themis/classification-10012022.xlsx',
+            'themis/classification-11202022.xlsx',
+            'themis/classification-02012023.xlsx']
 
-# Create a new column to combine station and date
-days_list = np.array(days_list)
-asis_list = np.array(asis_list)
+# Download day N+1 while day N is being processed
+def download_job(job):
+    date, asi = job
+    return download_themis_images(date, asi, 'data/raw/training/themis/',
+                                  skymap_store_dir=skymap_store_dir)
 
-last_date = datetime(1000, 1, 1)
-last_asi = '0000'
+def process_job(job):
+    date, asi = job
+    themis_asi_to_hdf5_8bit_clahe(date, asi,
+                                  save_dir='data/raw/training/themis/',
+                                  h5_dir='data/interim/training/themis/',
+                                  skymap_store_dir=skymap_store_dir,
+                                  hour_workers=hour_workers)
 
-# Loop through each day, download, and create .h5 file
-logging.info('Starting download and processing for all days.')
+def output_file(job):
+    date, asi = job
+    return f'data/interim/training/themis/all-images-{date.date()}-{asi}.h5'
 
-for n in range(0, len(days_list)):
+def job_key(job):
+    date, asi = job
+    return f'{date.date()}-{asi}'
 
-    date = days_list[n]
-    asi = asis_list[n]
 
-    if (date.date() == last_date.date()) & (asi == last_asi):
-        continue
+if __name__ == '__main__':
 
-    logging.info(f'Downloading images for {date} and {asi} to data/raw/training/themis/.')
-    # Download images
-    try:
-        download_themis_images(date, asi, 'data/raw/training/themis/')
+    logging.info('Reading in label catalog.')
 
-    except Exception as e:
-        logging.critical(f'Unable to download files for {date} and {asi}. Stopped with error {e}') 
+    # Compiled from the classification spreadsheets, only rebuilt when they change
+    catalog = get_label_catalog(classification_dir)
+    days = [(d, asi) for d, asi in catalog_days(catalog, sources=strfiles) if asi != 'pfrr']
 
-    logging.info(f'Images downloaded. Starting to process images.')
-    # Process images
-    try:
-        themis_asi_to_hdf5_8bit_clahe(date, asi,
-                                      save_dir='data/raw/training/themis/',
-                                      h5_dir='data/interim/training/themis/')  
-    
-    except Exception as e:
-        logging.critical(f'Unable to process files for {date} and {asi}. Stopped with error {e}')
+    days_list = [d for d, asi in days]
+    asis_list = [asi for d, asi in days]
 
-    last_date = date
-    last_asi = asi
+    # Remove duplicate days for each station across all files
+    jobs = plan_themis_downloads(days_list, asis_list)
 
-    logging.info(f'Images processed. They are available at data/interim/training/themis/.')
+    logging.info(f'Starting download and processing for {len(jobs)} days.')
 
+    run_download_process_pipeline(jobs, download_job, process_job, output_file,
+                                  manifest_file=manifest_file,
+                                  download_workers=download_workers,
+                                  process_workers=process_workers,
+                                  key_func=job_key)
 
-logging.info('All images downloaded and processed.')
\ No newline at end of file
+    logging.info('All images downloaded and processed.')
@@ -0,0 +1,187 @@
+"""
+Functions to choose how each parallel stage runs: on a thread pool, a
+process pool, or inline in the calling thread. OpenCV, zlib and h5py
+release the GIL, so threads can avoid the start up and pickling cost of
+processes for some stages. Every backend is a concurrent.futures
+Executor, so calling code is the same whichever is picked.
+
+The backend of a stage comes from default_executors, overridden by the
+ASI_EXECUTORS environment variable, e.g.
+ASI_EXECUTORS="preprocess=thread,themis_hours=inline"
+or a json file of the same mapping given by ASI_EXECUTORS_FILE.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+import concurrent.futures
+import json
+import logging
+import math
+import multiprocessing
+import os
+
+executor_kinds = ['inline', 'thread', 'process']
+
+# Backend of each stage unless configured otherwise
+default_executors = {'preprocess':'process',     # all_tasks.py CLAHE and resize of each frame
+                     'themis_hours':'process',   # reading and CLAHE of THEMIS hours for h5 files
+                     'pfrr_images':'process',    # reading and CLAHE of PFRR images for h5 files
+                     'movie':'process',          # matplotlib movie chunks
+                     'keogram':'process'}        # matplotlib keogram pngs
+
+# Stages that use matplotlib's pyplot, which isn't thread safe
+no_thread_stages = ['movie', 'keogram']
+
+
+class InlineExecutor(concurrent.futures.Executor):
+    """Executor that runs each call in the calling thread, useful for
+    debugging and for stages too small to be worth a pool.
+    """
+
+    def __init__(self, initializer=None, initargs:tuple=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+        return future
+
+    def map(self, fn, *iterables, timeout=None, chunksize=1):
+        # Lazy like Pool.imap, so results are made as they are consumed
+        return map(fn, *iterables)
+
+
+class PoolExecutor(concurrent.futures.Executor):
+    """Executor around a multiprocessing Pool. map is Pool.imap, so results
+    come back in order as they finish, and maxtasksperchild works, which
+    ProcessPoolExecutor's max_tasks_per_child can hang on in python 3.11.
+    """
+
+    def __init__(self, workers:int, mp_context:str=None, initializer=None, initargs:tuple=(),
+                 max_tasks_per_child:int=None):
+        self.pool = multiprocessing.get_context(mp_context).Pool(processes=workers,
+                                                                 initializer=initializer,
+                                                                 initargs=initargs,
+                                                                 maxtasksperchild=max_tasks_per_child)
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self.pool.apply_async(fn, args, kwargs, callback=future.set_result,
+                              error_callback=future.set_exception)
+
+        return future
+
+    def map(self, fn, *iterables, timeout=None, chunksize=1):
+        if len(iterables) == 1:
+            return self.pool.imap(fn, iterables[0], chunksize=chunksize)
+
+        return iter(self.pool.starmap(fn, zip(*iterables), chunksize=chunksize))
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        # Close and join, I think not doing this may cause shared memory issues in /dev/shm
+        if cancel_futures:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+
+        if wait:
+            self.pool.join()
+
+
+def executor_config() -> dict:
+    """Function to get the backend of every stage, defaults overridden by the environment."""
+
+    config = dict(default_executors)
+
+    config_file = os.environ.get('ASI_EXECUTORS_FILE')
+    if config_file:
+        with open(config_file, 'r') as f:
+            config.update(json.load(f))
+
+    for entry in os.environ.get('ASI_EXECUTORS', '').split(','):
+        if '=' in entry:
+            stage, kind = entry.split('=', 1)
+            config[stage.strip()] = kind.strip()
+
+    return config
+
+
+def executor_kind(stage:str, kind:str=None) -> str:
+    """Function to get the backend a stage runs on.
+    INPUT
+    stage - name of the stage, see default_executors
+    kind - inline, thread or process to override the configuration
+    OUTPUT
+    kind - inline, thread or process
+    """
+
+    default = default_executors.get(stage, 'process')
+    kind = executor_config().get(stage, default) if kind is None else kind
+
+    if kind not in executor_kinds:
+        logging.warning('Unknown executor {} for {}, using {}.'.format(kind, stage, default))
+        kind = default
+
+    if (kind == 'thread') and (stage in no_thread_stages):
+        logging.warning('{} uses matplotlib and can\'t run on threads, using {}.'.format(stage,
+                                                                                      default))
+        kind = default
+
+    return kind
+
+
+def make_executor(kind:str, workers:int, mp_context:str=None, initializer=None,
+                  initargs:tuple=(), max_tasks_per_child:int=None) -> concurrent.futures.Executor:
+    """Function to make an executor of a given backend.
+    INPUT
+    kind - inline, thread or process
+    workers - threads or processes in the pool
+    mp_context - multiprocessing start method for process pools, None for the default
+    initializer, initargs - called once in each worker, or once inline
+    max_tasks_per_child - replace each process after this many tasks, None to keep them
+    OUTPUT
+    executor - concurrent.futures.Executor, use it as a context manager or call shutdown
+    """
+
+    if kind == 'inline':
+        return InlineExecutor(initializer=initializer, initargs=initargs)
+
+    if kind == 'thread':
+        return concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1),
+                                                     initializer=initializer, initargs=initargs)
+
+    return PoolExecutor(max(workers, 1), mp_context=mp_context, initializer=initializer,
+                        initargs=initargs, max_tasks_per_child=max_tasks_per_child)
+
+
+def stage_executor(stage:str, workers:int, kind:str=None, **kwargs) -> concurrent.futures.Executor:
+    """Function to make the executor a stage is configured to run on, e.g.
+    with stage_executor('preprocess', workers) as executor:
+        frames = list(executor.map(process_image_clahe, items, chunksize=8))
+    INPUT
+    stage - name of the stage, see default_executors
+    workers - threads or processes in the pool
+    kind - inline, thread or process to override the configuration
+    kwargs - passed to make_executor
+    OUTPUT
+    executor - concurrent.futures.Executor
+    """
+
+    kind = executor_kind(stage, kind)
+    logging.info('Running {} on {} with {} workers.'.format(stage, kind, workers))
+
+    return make_executor(kind, workers, **kwargs)
+
+
+def default_chunksize(n_items:int, workers:int) -> int:
+    """Function to get the chunk size multiprocessing's Pool.map would use,
+    Executor.map and Pool.imap send one item at a time unless told otherwise.
+    """
+
+    return max(math.ceil(n_items/(4*max(workers, 1))), 1)
@@ -0,0 +1,189 @@
+"""
+Functions for the layout of the interim image h5 files. Images are stored
+frame-major as (frame, row, column) with one chunk per frame and built-in
+compression, so reading a single frame only touches that frame's chunk.
+Also includes a tool to convert older (row, column, frame) files and a
+small read benchmark to compare the two layouts.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+import h5py
+import logging
+import numpy
+import os
+import time
+
+
+def create_images_dataset(h5f:h5py.File, n_frames:int, frame_shape:tuple,
+                          compression:str='lzf') -> h5py.Dataset:
+    """Function to create a frame-major uint8 images dataset.
+    INPUT
+    h5f - h5 file opened for writing
+    n_frames - estimated number of frames, dataset can be resized after
+    frame_shape - (rows, columns) of a single frame
+    compression - h5py compression filter, lzf, gzip or None
+    OUTPUT
+    img_ds - the created dataset
+    """
+
+    img_ds = h5f.create_dataset('images', shape=(n_frames,) + tuple(frame_shape),
+                                maxshape=(None,) + tuple(frame_shape),
+                                chunks=(1,) + tuple(frame_shape),
+                                compression=compression,
+                                dtype='uint8')
+    img_ds.attrs['frame_axis'] = 0
+
+    return img_ds
+
+
+def get_frame_axis(img_ds:h5py.Dataset) -> int:
+    """Function to find which axis of an images dataset indexes frames.
+    Files written before the frame-major layout don't have the frame_axis
+    attribute. For these THEMIS files were (256, 256, N) and PFRR files (N, 512, 512),
+    so the frame size is checked first, which also works when N is 256 or 512.
+    INPUT
+    img_ds - images dataset
+    OUTPUT
+    frame_axis - 0 for frame-major files and older PFRR files, 2 for older THEMIS files
+    """
+
+    if 'frame_axis' in img_ds.attrs:
+        return int(img_ds.attrs['frame_axis'])
+
+    # Older PFRR files
+    if img_ds.shape[1:] == (512, 512):
+        return 0
+
+    # Older THEMIS files
+    if img_ds.shape[:2] == (256, 256):
+        return 2
+
+    # Other frame sizes, frames are square
+    if (img_ds.shape[1] == img_ds.shape[2]) & (img_ds.shape[0] != img_ds.shape[1]):
+        return 0
+
+    return 2
+
+
+def read_frames(img_ds:h5py.Dataset, start:int, stop:int) -> numpy.ndarray:
+    """Function to read frames from an images dataset of either layout.
+    INPUT
+    img_ds - images dataset
+    start, stop - frame range to read
+    OUTPUT
+    images - array of shape (frames, rows, columns)
+    """
+
+    if get_frame_axis(img_ds) == 0:
+        return img_ds[start:stop]
+
+    return numpy.moveaxis(img_ds[:, :, start:stop], 2, 0)
+
+
+def migrate_h5_to_frame_major(h5file:str, compression:str='lzf',
+                              frames_per_read:int=1000) -> bool:
+    """Function to rewrite an interim h5 file with the frame-major layout.
+    All other datasets, links and attributes are copied unchanged.
+    The new file replaces the old one once it is fully written.
+    INPUT
+    h5file - h5 file to convert
+    compression - h5py compression filter, lzf, gzip or None
+    frames_per_read - how many frames to transpose at a time
+    OUTPUT
+    True if the file was converted, False if it already was frame-major
+    """
+
+    tmp_file = h5file + '.tmp'
+
+    with h5py.File(h5file, 'r') as old_h5f:
+
+        old_ds = old_h5f['images']
+        if get_frame_axis(old_ds) == 0 and old_ds.chunks == (1,) + old_ds.shape[1:]:
+            logging.info('{} is already frame-major, skipping.'.format(h5file))
+            return False
+
+        frame_axis = get_frame_axis(old_ds)
+        n_frames = old_ds.shape[frame_axis]
+        frame_shape = old_ds.shape[0:2] if frame_axis == 2 else old_ds.shape[1:]
+
+        with h5py.File(tmp_file, 'w') as new_h5f:
+
+            # Copy everything besides the images
+            for key, value in old_h5f.attrs.items():
+                new_h5f.attrs[key] = value
+
+            for name in old_h5f:
+                if name == 'images':
+                    continue
+
+                link = old_h5f.get(name, getlink=True)
+                if isinstance(link, h5py.ExternalLink):
+                    new_h5f[name] = h5py.ExternalLink(link.filename, link.path)
+                else:
+                    old_h5f.copy(name, new_h5f)
+
+            new_ds = create_images_dataset(new_h5f, n_frames, frame_shape,
+                                           compression=compression)
+
+            for key, value in old_ds.attrs.items():
+                new_ds.attrs[key] = value
+            new_ds.attrs['frame_axis'] = 0
+
+            for n in range(0, n_frames, frames_per_read):
+                new_ds[n:n+frames_per_read] = read_frames(old_ds, n, n+frames_per_read)
+
+    os.replace(tmp_file, h5file)
+
+    logging.info('Converted {} to frame-major layout.'.format(h5file))
+
+    return True
+
+
+def benchmark_frame_reads(h5file:str, n_reads:int=200, seed:int=0) -> dict:
+    """Function to time reading from an interim h5 file.
+    Times random single-frame reads and a sequential read of all frames.
+    INPUT
+    h5file - h5 file to benchmark
+    n_reads - how many random single frames to read
+    seed - seed for choosing the random frames
+    OUTPUT
+    results - dictionary with layout, frames, and read times
+    """
+
+    with h5py.File(h5file, 'r') as h5f:
+        img_ds = h5f['images']
+        frame_axis = get_frame_axis(img_ds)
+        n_frames = img_ds.shape[frame_axis]
+
+        frames = numpy.random.default_rng(seed).integers(0, n_frames, size=n_reads)
+
+        start_time = time.perf_counter()
+        for frame in frames:
+            read_frames(img_ds, frame, frame + 1)
+        random_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for n in range(0, n_frames, 1000):
+            read_frames(img_ds, n, n + 1000)
+        sequential_time = time.perf_counter() - start_time
+
+    return {'file':h5file,
+            'frame_axis':frame_axis,
+            'frames':int(n_frames),
+            'file_size_mb':os.path.getsize(h5file)/1e6,
+            'random_frame_ms':1000*random_time/max(n_reads, 1),
+            'sequential_frames_per_s':n_frames/max(sequential_time, 1e-9)}
+
+
+def iso_times_to_datetime64(iso_times:numpy.ndarray) -> numpy.ndarray:
+    """Function to convert S27 ISO timestamps, e.g. b'2020-01-04T00:02:06.053611Z',
+    to a numpy datetime64[us] array without parsing each one in python.
+    INPUT
+    iso_times - array of S27 byte strings
+    OUTPUT
+    times - datetime64[us] array
+    """
+
+    return numpy.char.rstrip(numpy.asarray(iso_times).astype('U27'), 'Z').astype('datetime64[us]')
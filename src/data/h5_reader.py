@@ -0,0 +1,199 @@
+"""
+Functions for time-indexed reading of the daily h5 image archive.
+Each file gets an int64 epoch_us dataset (microseconds since 1970-01-01 UTC)
+next to the iso_ut_time strings, so a time window can be found with a
+binary search instead of parsing every timestamp. A catalog of all daily
+files with their station, start, end and frame count turns reads across
+days into a direct lookup.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+from datetime import datetime
+import h5py
+import logging
+import numpy
+import os
+
+from src.data.h5_layout import iso_times_to_datetime64, read_frames
+
+
+def h5_station(h5file:str) -> str:
+    """Function to get the station of a daily h5 file, e.g. all-images-2020-01-04-atha.h5.
+    PFRR files end with the wavelength instead of a station.
+    """
+
+    station = os.path.splitext(os.path.basename(h5file))[0].split('-')[-1]
+
+    return 'pfrr' if station.isdigit() else station
+
+
+def _to_epoch_us(time) -> int:
+    """Function to turn a datetime or datetime64 into int64 microseconds since 1970."""
+
+    return int(numpy.datetime64(time, 'us').astype('int64'))
+
+
+def write_epoch_index(h5f:h5py.File, iso_times:numpy.ndarray=None) -> h5py.Dataset:
+    """Function to write the epoch_us dataset to an open h5 file.
+    INPUT
+    h5f - h5 file opened for writing
+    iso_times - S27 timestamps, read from iso_ut_time if not given
+    OUTPUT
+    epoch_ds - the epoch_us dataset
+    """
+
+    if iso_times is None:
+        iso_times = h5f['iso_ut_time'][:]
+
+    if 'epoch_us' in h5f:
+        del h5f['epoch_us']
+
+    epoch_ds = h5f.create_dataset('epoch_us', data=iso_times_to_datetime64(iso_times).astype('int64'))
+    epoch_ds.attrs['about'] = 'Frame time in integer microseconds since 1970-01-01 UTC.'
+
+    return epoch_ds
+
+
+def add_epoch_index(h5file:str) -> None:
+    """Function to add the epoch_us dataset to an existing h5 file if it doesn't have one."""
+
+    with h5py.File(h5file, 'a') as h5f:
+        if 'epoch_us' not in h5f:
+            write_epoch_index(h5f)
+
+
+def get_epoch_index(h5f:h5py.File) -> numpy.ndarray:
+    """Function to get the frame times of an open h5 file as int64 microseconds.
+    Uses the epoch_us dataset if there is one, otherwise derives it from iso_ut_time.
+    """
+
+    if 'epoch_us' in h5f:
+        return h5f['epoch_us'][:]
+
+    return iso_times_to_datetime64(h5f['iso_ut_time'][:]).astype('int64')
+
+
+def find_time_window(h5f:h5py.File, start, end) -> tuple:
+    """Function to find the frame range [first, last) with start <= time < end.
+    INPUT
+    h5f - open h5 file
+    start, end - datetimes or datetime64 for the window, UTC
+    OUTPUT
+    first, last - frame indices
+    """
+
+    epoch_us = get_epoch_index(h5f)
+    first, last = numpy.searchsorted(epoch_us, [_to_epoch_us(start), _to_epoch_us(end)])
+
+    return int(first), int(last)
+
+
+def read_time_window(h5file:str, start, end) -> tuple:
+    """Function to read only the frames of a file within a time window.
+    INPUT
+    h5file - daily h5 file
+    start, end - datetimes or datetime64 for the window, UTC
+    OUTPUT
+    images, times - (frame, row, column) uint8 array and datetime64[us] times
+    """
+
+    with h5py.File(h5file, 'r') as h5f:
+        first, last = find_time_window(h5f, start, end)
+        images = read_frames(h5f['images'], first, last)
+        times = get_epoch_index(h5f)[first:last].astype('datetime64[us]')
+
+    return images, times
+
+
+def build_catalog(h5_dir:str, catalog_file:str=None) -> dict:
+    """Function to build a catalog of all daily h5 files in a directory tree.
+    INPUT
+    h5_dir - base directory of the daily h5 files
+    catalog_file - h5 file to write the catalog to, defaults to h5_dir/catalog.h5
+    OUTPUT
+    catalog - dictionary of arrays: station, file, start_us, end_us, count, sorted
+              by station then start
+    """
+
+    if catalog_file is None:
+        catalog_file = os.path.join(h5_dir, 'catalog.h5')
+
+    entries = []
+    for root, dirs, files in os.walk(h5_dir):
+        for f in files:
+            if not (f.startswith('all-images-') and f.endswith('.h5')):
+                continue
+
+            # Names are all-images-YYYY-MM-DD-{station}.h5
+            h5file = os.path.join(root, f)
+            try:
+                with h5py.File(h5file, 'r') as h5f:
+                    epoch_us = get_epoch_index(h5f)
+            except Exception as e:
+                logging.warning('Unable to catalog {}: {}'.format(h5file, e))
+                continue
+
+            if len(epoch_us) == 0:
+                continue
+
+            entries.append((f[22:-3], os.path.relpath(h5file, h5_dir),
+                            epoch_us[0], epoch_us[-1], len(epoch_us)))
+
+    entries.sort(key=lambda e: (e[0], e[2]))
+
+    catalog = {'station':numpy.array([e[0] for e in entries], dtype='S'),
+               'file':numpy.array([e[1] for e in entries], dtype='S'),
+               'start_us':numpy.array([e[2] for e in entries], dtype='int64'),
+               'end_us':numpy.array([e[3] for e in entries], dtype='int64'),
+               'count':numpy.array([e[4] for e in entries], dtype='int64')}
+
+    with h5py.File(catalog_file, 'w') as h5f:
+        for name, data in catalog.items():
+            h5f.create_dataset(name, data=data)
+        h5f.attrs['h5_dir'] = os.path.abspath(h5_dir)
+        h5f.attrs['created'] = datetime.now().isoformat()
+
+    logging.info('Cataloged {} files in {}.'.format(len(entries), catalog_file))
+
+    return catalog
+
+
+def read_catalog(catalog_file:str) -> dict:
+    """Function to read a catalog written by build_catalog."""
+
+    with h5py.File(catalog_file, 'r') as h5f:
+        catalog = {name:h5f[name][:] for name in h5f}
+        catalog['h5_dir'] = h5f.attrs['h5_dir']
+
+    return catalog
+
+
+def read_station_range(catalog:dict, station:str, start, end) -> tuple:
+    """Function to read all frames of a station within a time window, across days.
+    INPUT
+    catalog - catalog from read_catalog or build_catalog
+    station - 4 letter station code, or wavelength for PFRR files
+    start, end - datetimes or datetime64 for the window, UTC
+    OUTPUT
+    images, times - (frame, row, column) uint8 array and datetime64[us] times
+    """
+
+    start_us, end_us = _to_epoch_us(start), _to_epoch_us(end)
+
+    # Files of the station that overlap the window
+    use = ((catalog['station'] == station.encode())
+           & (catalog['start_us'] < end_us) & (catalog['end_us'] >= start_us))
+
+    images, times = [], []
+    for f in catalog['file'][use]:
+        h5file = os.path.join(catalog.get('h5_dir', ''), f.decode())
+        file_images, file_times = read_time_window(h5file, start, end)
+        images.append(file_images)
+        times.append(file_times)
+
+    if len(images) == 0:
+        return numpy.empty((0, 0, 0), dtype='uint8'), numpy.empty(0, dtype='datetime64[us]')
+
+    return numpy.concatenate(images), numpy.concatenate(times)
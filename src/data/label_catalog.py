@@ -0,0 +1,456 @@
+"""
+Functions to compile the human classification spreadsheets in
+docs/classifications/ into one cached label catalog. The spreadsheets use
+different column names, date formats, and comma-joined camera lists, so
+they are normalized once into typed columns (station, start, end, class,
+confidence, ...) and stored in an h5 file. The catalog is only rebuilt
+when a spreadsheet is added or changed, and labels are found for any
+station and time with a binary search.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+from datetime import datetime
+import glob
+import h5py
+import json
+import logging
+import numpy
+import os
+import pandas
+
+# Spreadsheet classifications to model classes. np (non-pulsating but good
+# viewing) mixes clear sky and other aurora so it isn't given a class.
+label_codes = {'p':'pulsating', 'ps':'pulsating', 'pa':'pulsating',
+               'pulsating':'pulsating', 'pulasting':'pulsating',
+               'dis':'other_aurora', 'sub':'other_aurora', 'diff':'other_aurora',
+               'dis-sub':'other_aurora', 'discrete':'other_aurora',
+               'substorm':'other_aurora', 'diffuse':'other_aurora',
+               'diffuse, discrete':'other_aurora', 'patchy aurora':'other_aurora',
+               'cs':'no_aurora', 'cm':'no_aurora', 'co':'no_aurora',
+               'co, cm':'no_aurora', 'no aurora':'no_aurora',
+               'bv':'bad_viewing', 'cl':'bad_viewing', 's':'bad_viewing',
+               'clouds':'bad_viewing', 'sunrise':'bad_viewing',
+               'sunset':'bad_viewing', 'sunsrise':'bad_viewing'}
+
+# Sheets with classifications in each spreadsheet
+label_sheets = ['themis', 'poker flat', 'pfrr', 'classification-updated']
+
+# Different spreadsheets use different column names
+_column_names = {'date':'date', 'camera':'station', 'station':'station',
+                 'start time':'start_time', 'end time':'end_time',
+                 'classification':'code', 'type':'code',
+                 'confidence':'confidence',
+                 'start frame':'start_frame', 'start_frame':'start_frame',
+                 'end frame':'end_frame', 'end_frame':'end_frame'}
+
+# Catalog columns and their types
+_catalog_dtypes = {'station':'S', 'date_us':'int64', 'start_us':'int64', 'end_us':'int64',
+                   'start_frame':'int64', 'end_frame':'int64', 'code':'S', 'label':'S',
+                   'confidence':'float32', 'source':'S'}
+
+# int64 value of numpy.datetime64('NaT'), used for labels without times
+nat_us = numpy.iinfo('int64').min
+
+
+def _parse_dates(dates:pandas.Series) -> pandas.Series:
+    """Function to parse the different date formats in the spreadsheets:
+    datetimes, 2012-12-17 strings, 20200101 integers and Excel serial days.
+    """
+
+    def _parse(d):
+        if isinstance(d, datetime):
+            return pandas.Timestamp(d).normalize()
+        d = str(d).strip()
+        if d.isdigit() and len(d) == 8:
+            return pandas.Timestamp(datetime.strptime(d, '%Y%m%d'))
+        if d.isdigit():
+            return pandas.Timestamp('1899-12-30') + pandas.Timedelta(days=int(d))
+        return pandas.Timestamp(d).normalize()
+
+    return dates.map(_parse)
+
+
+def _parse_times(times:pandas.Series) -> pandas.Series:
+    """Function to parse times of day like 08:19:18 or 10.00.22 into timedeltas."""
+
+    return pandas.to_timedelta(times.astype(str).str.strip().str.replace('.', ':', regex=False),
+                               errors='coerce')
+
+
+def _read_label_sheet(sheet:pandas.DataFrame, source:str) -> pandas.DataFrame:
+    """Function to normalize one classification sheet into label intervals."""
+
+    # Some sheets have a title row above the header
+    if not any(str(c).strip().lower() == 'date' for c in sheet.columns):
+        header = sheet.index[sheet.apply(lambda row: row.astype(str).str.strip()
+                                         .str.lower().eq('date').any(), axis=1)]
+        if len(header) == 0:
+            return pandas.DataFrame()
+        sheet.columns = sheet.loc[header[0]]
+        sheet = sheet.loc[header[0] + 1:]
+
+    sheet = sheet.rename(columns=lambda c: _column_names.get(str(c).strip().lower(), c))
+    sheet = sheet.dropna(subset=['date', 'code'])
+
+    # PFRR sheets have no camera column, some rows list several cameras
+    if 'station' not in sheet:
+        sheet = sheet.assign(station='pfrr')
+    sheet = sheet.assign(station=sheet['station'].astype(str).str.lower().str.split(','))
+    sheet = sheet.explode('station')
+
+    labels = pandas.DataFrame({'station':sheet['station'].str.strip(),
+                               'date':_parse_dates(sheet['date']),
+                               'code':sheet['code'].astype(str).str.strip().str.lower()})
+
+    for column in ['start_time', 'end_time']:
+        labels[column] = (_parse_times(sheet[column]) if column in sheet
+                          else pandas.Series(pandas.NaT, index=sheet.index, dtype='timedelta64[ns]'))
+
+    for column in ['start_frame', 'end_frame', 'confidence']:
+        labels[column] = (pandas.to_numeric(sheet[column].astype(str).str.strip(), errors='coerce')
+                          if column in sheet else numpy.nan)
+
+    labels['start'] = labels['date'] + labels['start_time']
+    labels['end'] = labels['date'] + labels['end_time']
+
+    # Intervals that cross midnight
+    labels.loc[labels['end'] < labels['start'], 'end'] += pandas.Timedelta(days=1)
+
+    labels['label'] = labels['code'].map(label_codes).fillna('')
+    labels['source'] = source
+
+    return labels
+
+
+def read_label_spreadsheets(label_files:list, label_dir:str='') -> pandas.DataFrame:
+    """Function to read classification spreadsheets into one table of label intervals.
+    Rows without times (e.g. final-test-classifications.xlsx) keep only their frame range.
+    INPUT
+    label_files - xlsx files in docs/classifications/
+    label_dir - source names are stored relative to this directory
+    OUTPUT
+    labels - dataframe with station, date, start, end, start_frame, end_frame,
+             code, label (model class or empty), confidence and source file
+    """
+
+    tables = []
+    for label_file in label_files:
+        source = os.path.relpath(label_file, label_dir) if label_dir else os.path.basename(label_file)
+
+        sheets = pandas.read_excel(label_file, sheet_name=None)
+        for name, sheet in sheets.items():
+            if name.strip().lower() not in label_sheets:
+                continue
+            tables.append(_read_label_sheet(sheet, source))
+
+    labels = pandas.concat(tables, ignore_index=True)
+
+    unknown = labels.loc[labels['label'] == '', 'code'].unique()
+    if len(unknown) > 0:
+        logging.info('Classifications without a model class: {}'.format(list(unknown)))
+
+    return labels
+
+
+def read_camera_dates(label_file:str, sheet_name:str='camera dates') -> list:
+    """Function to read the camera-days listed in the camera dates sheet of a
+    THEMIS spreadsheet, which has year, month, date and comma-joined camera
+    columns and includes days without rows in the classification sheets.
+    INPUT
+    label_file - xlsx file, e.g. docs/classifications/themis/classification-03022023.xlsx
+    sheet_name - sheet with the camera-days
+    OUTPUT
+    days - sorted list of (datetime, station)
+    """
+
+    sheet = pandas.read_excel(label_file, sheet_name=sheet_name, header=None, dtype=str)
+
+    # The header row is below a title row
+    header = sheet.index[sheet.apply(lambda row: row.astype(str).str.strip()
+                                     .str.lower().eq('year').any(), axis=1)][0]
+    sheet.columns = sheet.loc[header].astype(str).str.strip().str.lower()
+    sheet = sheet.loc[header + 1:].dropna(subset=['year', 'month', 'date', 'camera'])
+
+    days = set()
+    for year, month, day, cameras in zip(sheet['year'], sheet['month'], sheet['date'], sheet['camera']):
+        date = datetime(int(year), int(month), int(day))
+        for camera in cameras.split(','):
+            days.add((date, camera.strip().lower()))
+
+    return sorted(days)
+
+
+def _spreadsheet_state(label_dir:str) -> dict:
+    """Function to get the size and modification time of every spreadsheet in label_dir."""
+
+    state = {}
+    for label_file in sorted(glob.glob(os.path.join(label_dir, '**', '*.xlsx'), recursive=True)):
+        # Excel lock files
+        if os.path.basename(label_file).startswith('~$'):
+            continue
+        stat = os.stat(label_file)
+        state[os.path.relpath(label_file, label_dir)] = [stat.st_size, stat.st_mtime_ns]
+
+    return state
+
+
+def _to_us(times:pandas.Series) -> numpy.ndarray:
+    """Function to convert a datetime series to int64 microseconds, NaT stays NaT."""
+
+    return times.to_numpy().astype('datetime64[us]').astype('int64')
+
+
+def compile_label_catalog(label_dir:str='docs/classifications/',
+                          catalog_file:str='data/interim/label-catalog.h5') -> dict:
+    """Function to compile all classification spreadsheets into a label catalog.
+    INPUT
+    label_dir - directory with the xlsx files, searched recursively
+    catalog_file - h5 file to write the catalog to
+    OUTPUT
+    catalog - dictionary of arrays sorted by station then start: station, date_us,
+              start_us, end_us (NaT if the row only has frames), start_frame,
+              end_frame (-1 if not given), code, label, confidence (nan if not given), source
+    """
+
+    state = _spreadsheet_state(label_dir)
+    labels = read_label_spreadsheets([os.path.join(label_dir, f) for f in state],
+                                     label_dir=label_dir)
+
+    catalog = {'station':labels['station'].to_numpy(dtype='S'),
+               'date_us':_to_us(labels['date']),
+               'start_us':_to_us(labels['start']),
+               'end_us':_to_us(labels['end']),
+               'start_frame':labels['start_frame'].fillna(-1).to_numpy(dtype='int64'),
+               'end_frame':labels['end_frame'].fillna(-1).to_numpy(dtype='int64'),
+               'code':labels['code'].to_numpy(dtype='S'),
+               'label':labels['label'].to_numpy(dtype='S'),
+               'confidence':labels['confidence'].to_numpy(dtype='float32'),
+               'source':labels['source'].to_numpy(dtype='S')}
+
+    order = numpy.lexsort((catalog['start_us'], catalog['station']))
+    catalog = {name:data[order] for name, data in catalog.items()}
+
+    catalog_dir = os.path.dirname(catalog_file)
+    if (catalog_dir != '') and (not os.path.exists(catalog_dir)):
+        os.makedirs(catalog_dir)
+
+    # Write to a temporary file so readers never see a partial catalog
+    tmp_file = catalog_file + '.tmp'
+    with h5py.File(tmp_file, 'w') as h5f:
+        for name, data in catalog.items():
+            h5f.create_dataset(name, data=data, compression='gzip')
+        h5f.attrs['spreadsheets'] = json.dumps(state)
+        h5f.attrs['created'] = datetime.now().isoformat()
+    os.replace(tmp_file, catalog_file)
+
+    logging.info('Compiled {} labels from {} spreadsheets into {}.'.format(len(order), len(state),
+                                                                          catalog_file))
+
+    return catalog
+
+
+def read_label_catalog(catalog_file:str) -> dict:
+    """Function to read a catalog written by compile_label_catalog."""
+
+    with h5py.File(catalog_file, 'r') as h5f:
+        return {name:h5f[name][:].astype(_catalog_dtypes[name]) for name in h5f}
+
+
+def get_label_catalog(label_dir:str='docs/classifications/',
+                      catalog_file:str='data/interim/label-catalog.h5') -> dict:
+    """Function to read the label catalog, compiling it first if it doesn't exist
+    or a spreadsheet in label_dir was added, removed or changed since it was built.
+    INPUT
+    label_dir - directory with the xlsx files
+    catalog_file - h5 file of the catalog
+    OUTPUT
+    catalog - see compile_label_catalog
+    """
+
+    if os.path.exists(catalog_file):
+        with h5py.File(catalog_file, 'r') as h5f:
+            built_state = json.loads(h5f.attrs.get('spreadsheets', '{}'))
+
+        if built_state == _spreadsheet_state(label_dir):
+            return read_label_catalog(catalog_file)
+
+        logging.info('Classification spreadsheets changed, recompiling {}.'.format(catalog_file))
+
+    return compile_label_catalog(label_dir, catalog_file)
+
+
+def select_labels(catalog:dict, use:numpy.ndarray) -> dict:
+    """Function to select rows of a label catalog with a boolean or index array."""
+
+    return {name:data[use] for name, data in catalog.items()}
+
+
+def _label_keys(catalog:dict) -> list:
+    """Function to get the (station, date, start, end, start frame, end frame) key of each row."""
+
+    return list(zip(catalog['station'].tolist(), catalog['date_us'].tolist(),
+                    catalog['start_us'].tolist(), catalog['end_us'].tolist(),
+                    catalog['start_frame'].tolist(), catalog['end_frame'].tolist()))
+
+
+def exclude_labels(catalog:dict, source:str) -> dict:
+    """Function to drop the labels of a spreadsheet, and any copies of them in
+    other spreadsheets, from a catalog. Rows are matched on station, date and
+    time or frame range, since e.g. classification-03022023.xlsx repeats every
+    row of final-test-classifications.xlsx.
+    INPUT
+    catalog - label catalog, see get_label_catalog
+    source - spreadsheet relative to the label directory,
+             e.g. themis/final-test-classifications.xlsx
+    OUTPUT
+    catalog - label catalog without those rows
+    """
+
+    excluded = set(key for key, row_source in zip(_label_keys(catalog), catalog['source'])
+                   if row_source == source.encode())
+    use = numpy.array([key not in excluded for key in _label_keys(catalog)], dtype=bool)
+
+    logging.info('Excluded {} labels matching {}.'.format(int((~use).sum()), source))
+
+    return select_labels(catalog, use)
+
+
+def lookup_labels(catalog:dict, station:str, times) -> tuple:
+    """Function to find the label of a station at many times with a binary search.
+    Where intervals overlap the one that started last is used, including
+    times inside a longer interval after a later nested one has ended. Rows
+    that only have a frame range aren't matched, see catalog_frame_labels for those.
+
+    >>> catalog = {'station':numpy.array([b'atha', b'atha']),
+    ...            'start_us':numpy.array([0, 100]), 'end_us':numpy.array([1000, 200])}
+    >>> lookup_labels(catalog, 'atha', numpy.array([50, 150, 500, 1500]))
+    array([ 0,  1,  0, -1])
+
+    INPUT
+    catalog - label catalog, see get_label_catalog
+    station - station code, pfrr for Poker Flat
+    times - datetime64 array, or int64 microseconds since 1970
+    OUTPUT
+    rows - catalog row of the label for each time, -1 if unlabeled
+    """
+
+    times = numpy.asarray(times)
+    if times.dtype.kind == 'M':
+        times = times.astype('datetime64[us]').astype('int64')
+
+    # Rows of this station, the catalog is sorted by station then start
+    first = numpy.searchsorted(catalog['station'], station.encode(), side='left')
+    last = numpy.searchsorted(catalog['station'], station.encode(), side='right')
+    starts = catalog['start_us'][first:last]
+    ends = catalog['end_us'][first:last]
+
+    rows = numpy.full(times.shape, -1, dtype='int64')
+    if last == first:
+        return rows
+
+    # Latest end of the intervals starting up to each row, rows without
+    # times end at NaT which is the smallest int64 so they never reach a time
+    reach = numpy.maximum.accumulate(ends)
+
+    # Latest starting interval at or before each time, stepping back to
+    # earlier intervals while one of them could still reach the time
+    n = numpy.searchsorted(starts, times, side='right') - 1
+    pending = n >= 0
+
+    while True:
+        pending[pending] = (n[pending] >= 0) & (reach[numpy.maximum(n[pending], 0)] >= times[pending])
+        if not pending.any():
+            break
+
+        inside = numpy.zeros(times.shape, dtype=bool)
+        inside[pending] = ((starts[n[pending]] != nat_us) & (times[pending] <= ends[n[pending]]))
+        rows[inside] = first + n[inside]
+
+        pending &= ~inside
+        n[pending] -= 1
+
+    return rows
+
+
+def catalog_frame_labels(catalog:dict, station:str, date) -> list:
+    """Function to get the rows of a station and day that only give a frame range.
+    INPUT
+    catalog - label catalog, see get_label_catalog
+    station - station code
+    date - day as a datetime or datetime64
+    OUTPUT
+    rows - catalog rows
+    """
+
+    date_us = int(numpy.datetime64(date, 'D').astype('datetime64[us]').astype('int64'))
+
+    use = ((catalog['station'] == station.encode()) & (catalog['date_us'] == date_us)
+           & (catalog['start_us'] == nat_us) & (catalog['start_frame'] >= 0))
+
+    return list(numpy.nonzero(use)[0])
+
+
+def resolve_frame_times(catalog:dict, h5_catalog:dict) -> dict:
+    """Function to fill in the start and end times of labels that only give a
+    frame range, using the frame times of the daily h5 files they refer to.
+    Labels without a matching h5 file are left as they are.
+    INPUT
+    catalog - label catalog, see get_label_catalog
+    h5_catalog - catalog of daily h5 files, see src.data.h5_reader.read_catalog
+    OUTPUT
+    catalog - new label catalog, sorted by station then start
+    """
+
+    # Only needed here, reading the labels doesn't need any h5 files
+    from src.data.h5_reader import get_epoch_index
+
+    catalog = {name:data.copy() for name, data in catalog.items()}
+    untimed = numpy.nonzero((catalog['start_us'] == nat_us) & (catalog['start_frame'] >= 0))[0]
+
+    # PFRR files are named by wavelength instead of station
+    h5_stations = numpy.array([b'pfrr' if s.isdigit() else s for s in h5_catalog['station']],
+                              dtype='S')
+    h5_days = h5_catalog['start_us'].astype('datetime64[us]').astype('datetime64[D]')
+
+    for station, date_us in set(zip(catalog['station'][untimed], catalog['date_us'][untimed])):
+        rows = untimed[(catalog['station'][untimed] == station)
+                       & (catalog['date_us'][untimed] == date_us)]
+        match = numpy.nonzero((h5_stations == station)
+                              & (h5_days == numpy.datetime64(date_us, 'us').astype('datetime64[D]')))[0]
+        if len(match) == 0:
+            continue
+
+        h5file = os.path.join(h5_catalog.get('h5_dir', ''), h5_catalog['file'][match[0]].decode())
+        with h5py.File(h5file, 'r') as h5f:
+            epoch_us = get_epoch_index(h5f)
+        if len(epoch_us) == 0:
+            continue
+
+        start_frame = numpy.clip(catalog['start_frame'][rows], 0, len(epoch_us) - 1)
+        end_frame = numpy.clip(catalog['end_frame'][rows], 0, len(epoch_us) - 1)
+        catalog['start_us'][rows] = epoch_us[start_frame]
+        catalog['end_us'][rows] = epoch_us[end_frame]
+
+    order = numpy.lexsort((catalog['start_us'], catalog['station']))
+
+    return {name:data[order] for name, data in catalog.items()}
+
+
+def catalog_days(catalog:dict, sources:list=None) -> list:
+    """Function to get the unique (date, station) pairs with labels.
+    INPUT
+    catalog - label catalog, see get_label_catalog
+    sources - only use labels from these spreadsheets, relative to the label directory
+    OUTPUT
+    days - sorted list of (datetime, station)
+    """
+
+    use = numpy.ones(len(catalog['station']), dtype=bool)
+    if sources is not None:
+        use = numpy.isin(catalog['source'], numpy.array(sources, dtype='S'))
+
+    pairs = set(zip(catalog['date_us'][use].tolist(), catalog['station'][use].tolist()))
+
+    return sorted((numpy.datetime64(d, 'us').astype(datetime), s.decode()) for d, s in pairs)
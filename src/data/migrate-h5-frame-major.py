@@ -0,0 +1,69 @@
+"""
+Script to convert interim h5 image files to the frame-major layout.
+Older files store THEMIS images as (256, 256, N) with no chunking or compression.
+This rewrites them as (N, 256, 256) with one compressed chunk per frame.
+Read speed of each file is benchmarked before and after conversion.
+
+Run from the base directory with:
+python3 src/data/migrate-h5-frame-major.py data/interim/training/themis/ [gzip|lzf]
+
+Written by Riley Troyer
+science@rileytroyer.com
+"""
+# Import needed libraries
+from datetime import datetime
+from pathlib import Path
+import logging
+import os
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+from src.data.h5_layout import benchmark_frame_reads, migrate_h5_to_frame_major
+
+# Important directories
+logs_dir = 'logs/'
+
+# Initiate logging
+logging.basicConfig(filename=logs_dir + f'migrate-h5-frame-major-{datetime.today().date()}.log',
+                    encoding='utf-8',
+                    format='%(asctime)s %(levelname)-8s %(message)s',
+                    level=logging.INFO,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+#------------------------------Initializing done------------------------------
+
+h5_dir = sys.argv[1]
+compression = sys.argv[2] if len(sys.argv) > 2 else 'lzf'
+
+# Find all h5 files in the directory tree
+h5_files = sorted([os.path.join(root, f) for root, dirs, files in os.walk(h5_dir)
+                   for f in files if f.endswith('.h5')])
+
+logging.info(f'Converting {len(h5_files)} files in {h5_dir} with {compression} compression.')
+
+for h5_file in h5_files:
+
+    try:
+        before = benchmark_frame_reads(h5_file)
+
+        if migrate_h5_to_frame_major(h5_file, compression=compression) == False:
+            continue
+
+        after = benchmark_frame_reads(h5_file)
+
+    except Exception as e:
+        logging.critical(f'Unable to convert {h5_file}. Stopped with error {e}')
+        continue
+
+    summary = (f'{h5_file}: {before["frames"]} frames, '
+               f'size {before["file_size_mb"]:.1f} -> {after["file_size_mb"]:.1f} MB, '
+               f'random frame read {before["random_frame_ms"]:.2f} -> {after["random_frame_ms"]:.2f} ms, '
+               f'sequential {before["sequential_frames_per_s"]:.0f} -> '
+               f'{after["sequential_frames_per_s"]:.0f} frames/s')
+    logging.info(summary)
+    print(summary)
+
+logging.info('Finished converting files.')
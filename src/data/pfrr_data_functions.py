@@ -5,123 +5,246 @@ Functions used to download and process PFRR ASI Images
 """
 
 from astropy.io import fits
+import concurrent.futures
+import contextlib
 import cv2
 from datetime import datetime
 import ftplib
 import h5py
+import json
 import logging
-import multiprocessing
 import numpy as np
 import os
+import queue
 import shutil
-import wget
+import threading
+import time
 
-def get_pfrr_asi_filenames(date:datetime.date) -> list:
+from src.data.executors import stage_executor
+from src.data.h5_layout import create_images_dataset
+from src.data.h5_reader import write_epoch_index
+
+# Public ftp server with the PFRR all-sky camera images
+ftp_host = 'optics.gi.alaska.edu'
+ftp_port = 21
+
+
+class FTPConnectionPool:
+    """Small pool of logged-in ftp connections that can be shared by threads.
+    Connections are created as needed, up to size, and reused after that.
+    A connection that raised an error is closed instead of being returned.
+    """
+
+    def __init__(self, host:str=ftp_host, port:int=ftp_port, size:int=4,
+                 user:str='', passwd:str='', timeout:float=60):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self) -> ftplib.FTP:
+        ftp = ftplib.FTP()
+        ftp.connect(self.host, self.port, timeout=self.timeout)
+        ftp.login(self.user, self.passwd)
+        return ftp
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager that lends out a logged-in connection."""
+        self._slots.acquire()
+        try:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                ftp = self._connect()
+
+            try:
+                yield ftp
+            except Exception:
+                try:
+                    ftp.close()
+                except Exception:
+                    pass
+                raise
+            else:
+                self._idle.put(ftp)
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        """Close all idle connections."""
+        while not self._idle.empty():
+            ftp = self._idle.get_nowait()
+            try:
+                ftp.quit()
+            except Exception:
+                ftp.close()
+
+
+def _with_retries(func, retries:int=5, backoff:float=1.0, max_backoff:float=60.0):
+    """Function to call func, retrying with exponential backoff if it raises.
+    INPUT
+    func - function with no arguments to call
+    retries - how many times to retry after the first attempt
+    backoff - seconds to wait before the first retry, doubled after each retry
+    max_backoff - longest time to wait between retries
+    OUTPUT
+    whatever func returns, the last exception is raised if every attempt fails
+    """
+
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            wait = min(backoff * 2**attempt, max_backoff)
+            logging.warning(f'FTP request failed with {e}. Retrying in {wait} s.')
+            time.sleep(wait)
+
+
+def _pfrr_day_dir(date:datetime.date) -> str:
+    """Function to get the ftp directory of the images for a day."""
+
+    return ('/PKR/DASC/RAW/' 
+            + str(date.year).zfill(4) + '/'
+            + str(date.year).zfill(4) + str(date.month).zfill(2)
+            + str(date.day).zfill(2) + '/')
+
+
+def get_pfrr_asi_filenames(date:datetime.date, ftp_pool:FTPConnectionPool=None,
+                           retries:int=5, backoff:float=1.0) -> list:
 
     """Function to get file pathnames for pfrr asi
     INPUT
     date - date to get pathnames for
+    ftp_pool - pool of ftp connections to use, one is created if not given
+    retries - how many times to retry listing the directory
+    backoff - seconds to wait before the first retry, doubled after each retry
     OUTPUT
-    filenames- list of all file pathnames
+    filenames- list of all file pathnames, empty if the directory couldn't be listed
     """
-    
-    # Login to the ftp as public
-    ftp_link = 'optics.gi.alaska.edu'
-    ftp = ftplib.FTP(ftp_link)
-    ftp.login()
+
+    close_pool = ftp_pool is None
+    if ftp_pool is None:
+        ftp_pool = FTPConnectionPool(size=1)
+
     #...access the imager directory (DASC - digital all sky camera)
-    rel_imager_dir = ('/PKR/DASC/RAW/' 
-                      + str(date.year).zfill(4) + '/'
-                      + str(date.year).zfill(4) + str(date.month).zfill(2)
-                      + str(date.day).zfill(2) + '/')
+    rel_imager_dir = _pfrr_day_dir(date)
 
+    def _list():
+        with ftp_pool.connection() as ftp:
+            return ftp.nlst(rel_imager_dir)
 
-    # Find which years there is data for
-    #...try until it works, the server often returns an error
+    # Find which files there are, the server often returns an error
     try:
-         # Set current working directory to the ftp directory
-        ftp.cwd(rel_imager_dir)
-        #...store directories in dictionary
-        filenames = ['ftp://' + ftp_link + rel_imager_dir 
-                     + f for f in ftp.nlst()]
+        filenames = _with_retries(_list, retries=retries, backoff=backoff)
+        filenames = ['ftp://' + ftp_pool.host + rel_imager_dir
+                     + os.path.basename(f) for f in filenames]
 
     except Exception as e:
-        logging.warning(f'Could not get image filepaths. Stopped with error {e}')
-        result = None
-        counter = 0
-        while result is None:
+        logging.error(f'Unable to get data from: ftp://{ftp_pool.host}{rel_imager_dir},'
+                      f' skipping. Stopped with error {e}')
+        filenames = []
 
-            # Break out of loop after 10 iterations
-            if counter > 10:
-                logging.error(f'Unable to get data from: ftp://{ftp_link}{rel_imager_dir}, skipping.')
-                break
+    if close_pool:
+        ftp_pool.close()
 
-            try:
-                # Set current working directory to the ftp directory
-                ftp = ftplib.FTP(ftp_link)
-                ftp.login()
-                ftp.cwd(rel_imager_dir)
-                #...store directories in dictionary
-                filenames = ['ftp://' + ftp_link + rel_imager_dir 
-                             + f + '/' for f in ftp.nlst()]
-                result = True
-
-            except:
-                pass
-
-            counter = counter + 1
-            
     return filenames
 
-def _download_job(job_input:str) -> None:
-    """Function to pass to thread process to download file
+
+def _download_ftp_file(ftp_pool:FTPConnectionPool, remote_path:str, local_file:str) -> int:
+    """Function to download one file from the ftp server.
+    A local_file that is already the size of the remote file is kept as it
+    is, or kept if the server doesn't give a size. Otherwise data is written
+    to local_file.part first, and if that already exists the download
+    resumes from the end of it. The finished file is renamed.
     INPUT
-    job_input - string that contains the local directory to store
-                the downloaded files and the file url to download
-                these are seperated by the ### characters
+    ftp_pool - pool of ftp connections to use
+    remote_path - path of the file on the server
+    local_file - where to save the file
     OUTPUT
-    logging information
+    size - size of the downloaded file in bytes
     """
-    day_dir, file_url = job_input.split('###')
-    
-    # Check if file is already downloaded
-    if os.path.exists(day_dir + file_url[54:]):
-        return
-    
-    result = None
-    counter = 0
-    while result is None:
-        # Break out of loop after 10 iterations
-        if counter > 10:
-            logging.error(f'Unable to download image from: {file_url}, skipping.')
-            break
+
+    part_file = local_file + '.part'
+
+    with ftp_pool.connection() as ftp:
+        ftp.voidcmd('TYPE I')
         try:
-            wget.download(file_url, day_dir 
-                          + file_url[54:], bar=None)
+            remote_size = ftp.size(remote_path)
+        except ftplib.error_perm:
+            remote_size = None
 
-            result = True
-        except:
-            pass
-        counter = counter + 1
+        # Already downloaded, e.g. before there was a manifest
+        if os.path.exists(local_file):
+            size = os.path.getsize(local_file)
+            if (remote_size is None) or (size == remote_size):
+                return size
 
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        if (remote_size is not None) and (offset > remote_size):
+            offset = 0
 
-def download_pfrr_images(date:datetime.date, save_dir:str, wavelength:str = '558', processes:int=1) -> None:
+        with open(part_file, 'ab' if offset > 0 else 'wb') as f:
+            if (remote_size is None) or (offset < remote_size):
+                ftp.retrbinary('RETR ' + remote_path, f.write,
+                               rest=offset if offset > 0 else None)
+
+    size = os.path.getsize(part_file)
+    if (remote_size is not None) and (size != remote_size):
+        raise IOError(f'Downloaded {size} of {remote_size} bytes for {remote_path}.')
+
+    os.replace(part_file, local_file)
+
+    return size
+
+
+def _save_manifest(manifest:dict, manifest_file:str) -> None:
+    """Function to write the download manifest, replacing the old one in one step
+    so a crash while writing never leaves a partial file.
+    """
+
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def download_pfrr_images(date:datetime.date, save_dir:str, wavelength:str = '558', processes:int=4,
+                         ftp_pool:FTPConnectionPool=None, retries:int=5,
+                         backoff:float=1.0) -> None:
     """Function to download image files from the
     Poker Flat Research Range (PFRR) all-sky imager images.
+    Files are downloaded by threads that share a pool of ftp connections.
+    Partial files are resumed and the status of each file is saved to
+    manifest.json in the day directory as it finishes, so finished files,
+    and files already on disk with the right size, are skipped on a rerun.
     INPUT
     date - day to download files for
     save_dir - where to save the images, program will create
                separate directories for each day within this.
     wavelength - which wavelength images are being used
-    processes - how many multiprocessing process to download images with
+    processes - how many threads, and ftp connections, to download images with
+    ftp_pool - pool of ftp connections to use, one is created if not given
+    retries - how many times to retry each file
+    backoff - seconds to wait before the first retry, doubled after each retry
     OUTPUT
     logging information
     """
 
     logging.info(f'Starting to download files for {date} and {wavelength}.')
 
+    close_pool = ftp_pool is None
+    if ftp_pool is None:
+        ftp_pool = FTPConnectionPool(size=processes)
+
     # Select files for day and wavelength
-    file_urls = get_pfrr_asi_filenames(date)
+    file_urls = get_pfrr_asi_filenames(date, ftp_pool=ftp_pool,
+                                       retries=retries, backoff=backoff)
     
     # Filter to wavelength if available
     if date.year > 2009:
@@ -134,28 +257,49 @@ def download_pfrr_images(date:datetime.date, save_dir:str, wavelength:str = '558
     if not os.path.exists(day_dir):
         os.makedirs(day_dir)
 
-    # Create a string to input into job, include url and dir
-    download_job_input = [day_dir + '###' + f for f in file_urls]
-    
-    # Keep trying to download if all files aren't downloaded
-    finished = False
-    while finished == False:
-        
-        # Use download function in threads to download all files
-        #...not sure how many processes are possible, but 25 
-        #...seems to work, 50 does not on my computer.
-        with multiprocessing.Pool(processes=processes) as pool:
-            pool.map(_download_job, download_job_input)
-
-        # As a last step check to make sure all files were downloaded
-        finished_check = []
-        for file_url in file_urls:
-            finished_check.append(os.path.exists(day_dir 
-                                                 + file_url[54:]))
-        if False not in finished_check:
-            finished = True
-
-    logging.info('Finished downloading images.')
+    # Manifest of files already downloaded
+    manifest_file = day_dir + 'manifest.json'
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+    lock = threading.Lock()
+
+    def _job(file_url:str) -> bool:
+        filename = os.path.basename(file_url)
+        local_file = day_dir + filename
+
+        if (manifest.get(filename, {}).get('status') == 'done') and os.path.exists(local_file):
+            return True
+
+        remote_path = _pfrr_day_dir(date) + filename
+        try:
+            size = _with_retries(lambda: _download_ftp_file(ftp_pool, remote_path, local_file),
+                                 retries=retries, backoff=backoff)
+            entry = {'status':'done', 'size':size}
+        except Exception as e:
+            logging.error(f'Unable to download image from: {file_url}, skipping. Error {e}')
+            entry = {'status':'failed', 'error':str(e)}
+
+        # Saved after every file so a crash doesn't lose what already finished
+        with lock:
+            manifest[filename] = entry
+            _save_manifest(manifest, manifest_file)
+
+        return entry['status'] == 'done'
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=processes) as executor:
+        downloaded = list(executor.map(_job, file_urls))
+
+    if close_pool:
+        ftp_pool.close()
+
+    logging.info(f'Finished downloading images. {sum(downloaded)} of {len(file_urls)}'
+                 ' files are available.')
+
+# CLAHE object and read buffer for each worker process or thread, reused for every image it processes
+_worker_state = threading.local()
+
 
 def read_process_img_clahe(filename:str) -> np.array:
     """Function to use astropy.io.fits to read in fits file,
@@ -167,14 +311,24 @@ def read_process_img_clahe(filename:str) -> np.array:
     image- numpy array. processed image data array
     """
 
-    # Read in the image
-    fits_file = fits.open(filename)
-    image = fits_file[0].data.astype('uint16')
-    fits_file.close()
+    # Read in the image, into this process's buffer if the shape matches
+    with fits.open(filename) as fits_file:
+        data = fits_file[0].data
+
+        buffer = getattr(_worker_state, 'buffer', None)
+        if (buffer is None) or (buffer.shape != data.shape):
+            buffer = np.empty(data.shape, dtype='uint16')
+            _worker_state.buffer = buffer
+
+        np.copyto(buffer, data, casting='unsafe')
 
     # Image processing
-    clahe = cv2.createCLAHE(clipLimit=300, tileGridSize=(4, 4))
-    image = clahe.apply(image)
+    clahe = getattr(_worker_state, 'clahe', None)
+    if clahe is None:
+        clahe = cv2.createCLAHE(clipLimit=300, tileGridSize=(4, 4))
+        _worker_state.clahe = clahe
+
+    image = clahe.apply(buffer)
 
     # Scale back to 0 to 255 values and 8-bit
     image = cv2.convertScaleAbs(image, alpha=(255.0/np.max(image)))
@@ -182,9 +336,14 @@ def read_process_img_clahe(filename:str) -> np.array:
     return image
 
 def pfrr_asi_to_hdf5_8bit_clahe(date:datetime.date, save_dir:str, h5_dir:str,
-                                wavelength:str='558', del_files:bool = False, processes:int=1):
+                                wavelength:str='558', del_files:bool = False, processes:int=1,
+                                compression:str='lzf', write_batch:int=100,
+                                max_tasks_per_child:int=500):
     """Function to convert 428, 558, 630 nm PFRR images for an entire
     night to an 8-bit grayscale image and then write them to an h5 file.
+    Files are read and processed by one pool for the whole night, processes
+    unless the pfrr_images stage is configured otherwise in executors.py, and
+    streamed back in order, then written to the file in batches.
     INPUT
     date - date to perform image conversion and storage for
     h5_dir - about: base directory to save the images to
@@ -192,8 +351,13 @@ def pfrr_asi_to_hdf5_8bit_clahe(date:datetime.date, save_dir:str, h5_dir:str,
     wavelength - which wavelength to use. White combines all three.
                Options: 428, 558, 630
     del_files - whether to delete the individual files after program runs
+    processes - how many workers to read and process the images with
+    compression - h5py compression filter for the images, lzf, gzip or None
+    write_batch - how many images to collect before writing to the file
+    max_tasks_per_child - replace each process after this many chunks of 8 images
+                          so memory it doesn't give back is released, None to keep them
     OUTPUT
-    none
+    none, raises IOError if there are no images for the day
     """
     
     # Get directory where images are stored
@@ -203,6 +367,10 @@ def pfrr_asi_to_hdf5_8bit_clahe(date:datetime.date, save_dir:str, h5_dir:str,
     files_wavelength = sorted(os.listdir(dir_wavelength))
     # Make sure these are only .fits files
     files_wavelength = [f for f in files_wavelength if f.endswith('.FITS')]
+
+    # Don't write a file without images, so an empty or failed download isn't taken as done
+    if len(files_wavelength) == 0:
+        raise IOError(f'No images in {dir_wavelength}, not writing an h5 file for {date}.')
     
     # Extract times from filenames
     times_wavelength = np.array([datetime(int(f[14:18]), int(f[18:20]), int(f[20:22]),
@@ -222,51 +390,59 @@ def pfrr_asi_to_hdf5_8bit_clahe(date:datetime.date, save_dir:str, h5_dir:str,
     # Write images to h5 dataset
     h5file = h5_dir + 'all-images-' + str(date) + '-' + wavelength + '.h5'
 
-    # Read in a sample image to get correct size for dataset
-    sample_image = read_process_img_clahe(files_wavelength[0])
-    image_data_shape = (len(files_wavelength), sample_image.shape[0], sample_image.shape[1])
-
-    with h5py.File(h5file, 'w') as h5f:
-
-        # Initialize the datasets for images and timestamps
-        img_ds = h5f.create_dataset('images', shape=image_data_shape,
-                                    dtype='uint8')
+    # Spawn the workers, this can be called from a pipeline thread while download
+    # threads hold locks and sockets, and forking a multithreaded process can deadlock
+    with h5py.File(h5file, 'w') as h5f, \
+         stage_executor('pfrr_images', processes, mp_context='spawn',
+                        max_tasks_per_child=max_tasks_per_child) as executor:
 
         time_ds = h5f.create_dataset('iso_ut_time', shape=iso_time.shape,
                                          dtype='S27', data=iso_time)
 
         # Add attributes to datasets
         time_ds.attrs['about'] = ('ISO 8601 formatted timestamp in byte string.')
-        img_ds.attrs['wavelength'] = wavelength
+
+        # Integer times for binary search of time windows
+        write_epoch_index(h5f, iso_time)
 
         logging.info(f'Initialized h5 file: {h5file}. Starting to write data.')
 
-        # Loop through 100 images at a time
-        chunk_size = 100
+        # Images come back in file order, the dataset and write buffer are
+        # created from the shape of the first one
+        img_ds = None
+        buffer = None
+        n_buffered = 0
+        n_written = 0
+
+        for image in executor.map(read_process_img_clahe, files_wavelength, chunksize=8):
+
+            if img_ds is None:
+                img_ds = create_images_dataset(h5f, len(files_wavelength), image.shape,
+                                               compression=compression)
+                img_ds.attrs['wavelength'] = wavelength
+                buffer = np.empty((write_batch,) + image.shape, dtype='uint8')
 
-        for n_chunk, files in enumerate(files_wavelength[0::chunk_size]):
+            buffer[n_buffered] = image
+            n_buffered = n_buffered + 1
 
-            files = files_wavelength[n_chunk*chunk_size : n_chunk*chunk_size+chunk_size]
-            
-            # Read and process files using multiprocessing
-            with multiprocessing.Pool(processes=processes) as pool:
-                processed_images = pool.map(read_process_img_clahe, files)
+            # Write the buffer to the dataset when it is full
+            if n_buffered == write_batch:
+                img_ds[n_written:n_written + n_buffered] = buffer
+                n_written = n_written + n_buffered
+                n_buffered = 0
 
-            # Close and join pools, I think not doing this may cause shared memory issues in /dev/shm
-            pool.close()
-            pool.join()
+                logging.info(f'Finished writing {n_written} of {len(files_wavelength)} images.')
 
-            # Stack the images into a numpy array
-            processed_images_array = np.stack(processed_images, axis=0)
+        if n_buffered > 0:
+            img_ds[n_written:n_written + n_buffered] = buffer[:n_buffered]
+            n_written = n_written + n_buffered
 
-            # Write image to dataset
-            img_ds[n_chunk*chunk_size:
-                   n_chunk*chunk_size+chunk_size:, :, :] = processed_images_array
+        # Close and join the pool before the file closes, I think not doing this may
+        # cause shared memory issues in /dev/shm
+        executor.shutdown()
 
-            logging.info(f'Finished writing {n_chunk*chunk_size} of {len(files_wavelength)} images.')
-            
-        # If specified to delete files, remove individual images
-        if del_files == True:
-            shutil.rmtree(dir_wavelength)
+    # If specified to delete files, remove individual images
+    if del_files == True:
+        shutil.rmtree(dir_wavelength)
     
-    logging.info(f'Finished writing data to h5 file.')
\ No newline at end of file
+    logging.info(f'Finished writing data to h5 file.')
@@ -1,6 +1,15 @@
 from datetime import datetime
-import pandas as pd
+import logging
 import os
+from pathlib import Path
+import subprocess
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+from src.data.label_catalog import read_camera_dates
 
 if __name__ == '__main__':
     # img_folder_path = ''
@@ -15,37 +24,10 @@ if __name__ == '__main__':
     logging.info('MiniVideoGenerator test code start ' +
                  datetime.now().strftime("%H:%M:%S"))
 
-    # import files
-    objects = 'docs/classifications/classification-03022023.xlsx'
-
-    # preview files
-    file = pd.read_excel(objects, header=0, skiprows=1)
-    file.columns = file.columns.str.lower()
-
-    # take out dates and camera name
-    dcs = []  # set for camera-datetime object pairs
-    ds = [] # set for datetimes
-
-    camerass = file.loc[:, "camera"]
-    years = file.loc[:, "year"]
-    months = file.loc[:, "month"]
-    days = file.loc[:, "date"]
-
-    for i in range(len(years)):
-        cameras = camerass[i].split(',')
-        year = years[i]
-        month = months[i]
-        day = days[i]
-        date = f'{year}-{month}-{day}'
-        ds.append(datetime.strptime(date, '%Y-%m-%d'))
-
-        for camera in cameras:
-            tempdcs = (camera.strip(), datetime.strptime(date, '%Y-%m-%d'))
-            dcs.append(tempdcs)
-            
-
-    dcs=list(set(dcs))
-    ds=list(set(ds))
+    # camera-date pairs from the camera dates sheet, it has days without classification rows
+    dcs = [(station, date) for date, station
+           in read_camera_dates('docs/classifications/themis/classification-03022023.xlsx')]
+    ds = sorted(set(date for station, date in dcs))
 
     # print(len(ds))
     # print(len(dcs))
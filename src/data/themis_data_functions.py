@@ -7,51 +7,42 @@ science@rileytroyer.com
 
 import cv2
 from datetime import datetime
+import functools
 import gc
 import h5py
 import logging
 import numpy
 import os
+import re
 from scipy.io import readsav
 import shutil
 import subprocess
 import themis_imager_readfile
+import time
 
+from src.data.executors import stage_executor
+from src.data.h5_layout import create_images_dataset
+from src.data.h5_reader import write_epoch_index
+from src.data.themis_skymap_store import find_skymap, has_skymap, link_skymap, store_skymap
 
-def download_themis_images(date:datetime, asi:str, save_dir:str):
-    """Function to download raw .pgm.gz files from stream0 of THEMIS
-    ASIs. Data is downloaded from https://data.phys.ucalgary.ca/
+
+# URL for entire THEMIS ASI project
+themis_url = 'data.phys.ucalgary.ca/data/sort_by_project/THEMIS/asi/'
+
+
+@functools.lru_cache(maxsize=None)
+def get_themis_skymap_dirs(asi:str) -> tuple:
+    """Function to list the skymap directories available for a THEMIS ASI.
+    The result is cached per station so that downloading many days for
+    the same camera only requires one rsync listing of the skymap server.
     INPUT
-    date - which date to download images for
-    asi - 4 letter code for station to download images for
-    save_dir - where to save images files
+    asi - 4 letter code for station to get skymap directories for
     OUTPUT
-    logging. I recommend writing to file by running this at the start of the code:
-    
-    logging.basicConfig(filename='themis-script.log',
-                    encoding='utf-8',
-                    format='%(asctime)s %(levelname)-8s %(message)s',
-                    level=logging.INFO,
-                    datefmt='%Y-%m-%d %H:%M:%S')
+    skymap_dirs - tuple of skymap directory names, e.g. atha_20190101
     """
-    
-    logging.info('Starting download script for {} and {}.'.format(asi, date.date()))
-    
-    date_string = (str(date.year).zfill(4) + '/' 
-                   + str(date.month).zfill(2) + '/'
-                   + str(date.day).zfill(2) + '/')
 
-    # URL for entire THEMIS ASI project
-    themis_url = 'data.phys.ucalgary.ca/data/sort_by_project/THEMIS/asi/'
-
-    # URL for skymap
     skymap_url = themis_url + 'skymaps/' + asi + '/'
 
-    # URL for images
-    img_url = themis_url + 'stream0/' + date_string + asi + '*/'
-
-    # Get the matched skymap for the date
-
     # Get output of sync to find the directories
     try:
         skymap_dirs = subprocess.check_output(['rsync', 
@@ -64,6 +55,21 @@ def download_themis_images(date:datetime, asi:str, save_dir:str):
         logging.critical('Exception: {}'.format(e))
         raise
 
+    return tuple(skymap_dirs)
+
+
+def get_themis_skymap_dir(date:datetime, asi:str) -> str:
+    """Function to find the skymap directory that applies to a date.
+    This is the most recent skymap that was created before the date.
+    INPUT
+    date - which date to find the skymap for
+    asi - 4 letter code for station
+    OUTPUT
+    skymap_dir - name of the skymap directory on the server
+    """
+
+    skymap_dirs = get_themis_skymap_dirs(asi)
+
     # Convert to datetimes
     skymap_dates = [d.split('_')[1] for d in skymap_dirs]
     skymap_dates = [datetime.strptime(d, '%Y%m%d') for d in skymap_dates]
@@ -72,10 +78,79 @@ def download_themis_images(date:datetime, asi:str, save_dir:str):
     time_diffs = numpy.array([(date - d).total_seconds() for d in skymap_dates])
 
     # Find the closest map
-    skymap_dir = skymap_dirs[numpy.where(time_diffs > 0,
-                                         time_diffs, numpy.inf).argmin()]
+    return skymap_dirs[numpy.where(time_diffs > 0,
+                                   time_diffs, numpy.inf).argmin()]
+
 
-    skymap_url = skymap_url + skymap_dir + '/'
+def _rsync_with_retries(src_url:str, dest_dir:str, retries:int=3, backoff:float=5.0) -> int:
+    """Function to run an rsync transfer, retrying with exponential backoff.
+    INPUT
+    src_url - rsync url to download, without the rsync:// prefix
+    dest_dir - local directory to download into
+    retries - how many times to retry a failed transfer
+    backoff - seconds to wait before the first retry, doubled after each retry
+    OUTPUT
+    received - bytes rsync received, from its --stats summary, raises the
+               last exception if every attempt fails
+    """
+
+    for attempt in range(retries + 1):
+        try:
+            output = subprocess.run(['rsync', '-vzrt', '--stats', 'rsync://' + src_url,
+                                     dest_dir], stdout=subprocess.PIPE, check=True).stdout
+            received = re.search(rb'Total bytes received: ([\d,]+)', output)
+            return int(received.group(1).replace(b',', b'')) if received else 0
+
+        except Exception as e:
+            if attempt == retries:
+                raise
+
+            wait = backoff * 2**attempt
+            logging.warning('rsync of {} failed with {}. Retrying in {} s.'.format(src_url,
+                                                                                  e, wait))
+            time.sleep(wait)
+
+
+def download_themis_images(date:datetime, asi:str, save_dir:str,
+                           retries:int=3, backoff:float=5.0, skymap_store_dir:str=None) -> int:
+    """Function to download raw .pgm.gz files from stream0 of THEMIS
+    ASIs. Data is downloaded from https://data.phys.ucalgary.ca/
+    INPUT
+    date - which date to download images for
+    asi - 4 letter code for station to download images for
+    save_dir - where to save images files
+    retries - how many times to retry a failed rsync transfer
+    backoff - seconds to wait before the first retry, doubled after each retry
+    skymap_store_dir - base directory of a skymap store, see themis_skymap_store.py. If
+                       the matched skymap is already stored it isn't downloaded again.
+    OUTPUT
+    received - bytes received by rsync for the skymap and images, 0 if the
+               images were already downloaded
+    logging. I recommend writing to file by running this at the start of the code:
+    
+    logging.basicConfig(filename='themis-script.log',
+                    encoding='utf-8',
+                    format='%(asctime)s %(levelname)-8s %(message)s',
+                    level=logging.INFO,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+    """
+    
+    logging.info('Starting download script for {} and {}.'.format(asi, date.date()))
+    
+    date_string = (str(date.year).zfill(4) + '/' 
+                   + str(date.month).zfill(2) + '/'
+                   + str(date.day).zfill(2) + '/')
+
+    # URL for images
+    img_url = themis_url + 'stream0/' + date_string + asi + '*/'
+
+    # Get the matched skymap for the date, listing is cached per station
+    skymap_dir = get_themis_skymap_dir(date, asi)
+    skymap_url = themis_url + 'skymaps/' + asi + '/' + skymap_dir + '/'
+
+    # Is the skymap already parsed into the store?
+    download_skymap = not ((skymap_store_dir is not None)
+                           and has_skymap(skymap_store_dir, skymap_dir))
 
     # Create directories to store data
 
@@ -98,38 +173,119 @@ def download_themis_images(date:datetime, asi:str, save_dir:str):
                      ' so will not download.'.format(date.date()))
         download_imgs = False
 
+    received = 0
+
     # Do the images need to be downloaded?
     if download_imgs == True:
         
         # Download skymap
-        logging.info('Downloading skymap from {}...'.format(skymap_url))
-        try:
-            subprocess.run(['rsync', '-vzrt', 'rsync://' + skymap_url + '*.sav',
-                             tmp_img_dir], stdout=subprocess.DEVNULL)
-            logging.info('Successfully downloaded skymap.'
-                             ' It is saved at {}.'.format(tmp_img_dir))
-        except Exception as e:
-            logging.critical('Unable to download skymap:{}. Stopping.'.format(skymap_url))
-            logging.critical('Exception: {}'.format(e))
-            raise
+        if download_skymap == False:
+            logging.info('Skymap {} is already in the store.'.format(skymap_dir))
+        else:
+            logging.info('Downloading skymap from {}...'.format(skymap_url))
+            try:
+                received += _rsync_with_retries(skymap_url + '*.sav', tmp_img_dir,
+                                                retries=retries, backoff=backoff)
+                logging.info('Successfully downloaded skymap.'
+                                 ' It is saved at {}.'.format(tmp_img_dir))
+            except Exception as e:
+                logging.critical('Unable to download skymap:{}. Stopping.'.format(skymap_url))
+                logging.critical('Exception: {}'.format(e))
+                # Remove partial directory so a rerun tries again
+                shutil.rmtree(tmp_img_dir, ignore_errors=True)
+                raise
 
         # Download images
         logging.info('Downloading images from {}...'.format(img_url))
         try:
-            subprocess.run(['rsync', '-vzrt', 'rsync://' + img_url,
-                             tmp_img_dir], stdout=subprocess.DEVNULL)
-            logging.info('Successfully downloaded images.'
-                         ' They are saved at {}.'.format(tmp_img_dir))
+            start_time = time.monotonic()
+            img_received = _rsync_with_retries(img_url, tmp_img_dir,
+                                               retries=retries, backoff=backoff)
+            elapsed = time.monotonic() - start_time
+            received += img_received
+            logging.info('Successfully downloaded images, {:.1f} MB in {:.1f} s, {:.2f} MB/s.'
+                         ' They are saved at {}.'.format(img_received/1e6, elapsed,
+                                                         img_received/1e6/max(elapsed, 1e-9),
+                                                         tmp_img_dir))
         except Exception as e:
             logging.critical('Unable to download images:{}. Stopping.'.format(img_url))
             logging.critical('Exception: {}'.format(e))
+            shutil.rmtree(tmp_img_dir, ignore_errors=True)
             raise
             
     logging.info('Finished download script for {} and {}.'.format(asi, date.date()))
 
+    return received
+
+
+def plan_themis_downloads(dates:list, asis:list) -> list:
+    """Function to turn lists of dates and cameras into a list of unique
+    download jobs. Order of first appearance is kept.
+    INPUT
+    dates - list of datetimes
+    asis - list of 4 letter station codes, same length as dates
+    OUTPUT
+    jobs - list of (datetime, asi) tuples with no duplicate days for a station
+    """
+
+    jobs = {}
+    for date, asi in zip(dates, asis):
+        date = datetime(date.year, date.month, date.day)
+        jobs.setdefault((date, asi), None)
+
+    return list(jobs)
+
+
+def _process_themis_image(image:numpy.ndarray) -> numpy.ndarray:
+    """CLAHE processing of 16-bit image and downscale to 8-bit"""
+    # process the image using clahe
+    clahe = cv2.createCLAHE(clipLimit=3, tileGridSize=(8, 8))
+    image = clahe.apply(image)
+
+    return cv2.convertScaleAbs(image, alpha=(255.0/65536.0))
+
+
+def _read_process_themis_hour(hour_filepathnames:list, workers:int=1) -> tuple:
+    """Function to read and CLAHE process one hour of THEMIS images.
+    Top level so it can be run by a multiprocessing pool.
+    INPUT
+    hour_filepathnames - list of .pgm.gz files for the hour
+    workers - how many workers themis_imager_readfile should use
+    OUTPUT
+    images, timestamps, latitude, longitude - uint8 (frame, row, column) images,
+        S27 ISO timestamps and station location. None if there are no images.
+    """
+
+    # Read the data files
+    images, meta, problematic_files = themis_imager_readfile.read(hour_filepathnames,
+                                                                  workers=workers)
+
+    # Check if images exists
+    if images.shape[2] == 0:
+        return None
+
+    latitude = float(meta[0]['Geodetic latitude'])
+    longitude = float(meta[0]['Geodetic Longitude'])
+
+    # Extract datetimes from file
+    datetimes = [datetime.strptime(m['Image request start'],
+                                     '%Y-%m-%d %H:%M:%S.%f %Z') for m in meta]
+
+    # Convert times to integer format
+    timestamps = numpy.array([t.isoformat() + 'Z' for t in datetimes]).astype('S27')
+
+    # Process the images, frames first
+    processed = numpy.empty((images.shape[2], images.shape[0], images.shape[1]), dtype='uint8')
+    for n in range(images.shape[2]):
+        processed[n] = _process_themis_image(images[:, :, n])
+
+    return processed, timestamps, latitude, longitude
+
 
 def themis_asi_to_hdf5_8bit_clahe(date:datetime, asi:str, save_dir:str, h5_dir:str,
-                                  del_files:bool = False, workers:int=1):
+                                  del_files:bool = False, workers:int=1,
+                                  skymap_store_dir:str=None, compression:str='lzf',
+                                  hour_workers:int=1, max_tasks_per_child:int=6):
     """Function to convert themis asi images
     to 8-bit grayscale images and then write them to an h5 file using
     contrast limited adaptive historgram equalization (CLAHE).
@@ -142,6 +298,15 @@ def themis_asi_to_hdf5_8bit_clahe(date:datetime, asi:str, save_dir:str, h5_dir:s
               be aware there is a memory leak issue in the themis_imager_readfile code
               as of the writting of this. When calling this function many times with multiprocessing
               the code doesn't close out the multiprocessing pool correctly causing the issue.
+    skymap_store_dir - base directory of a skymap store, see themis_skymap_store.py. If
+                       specified the skymap is parsed once into the store and the h5 file
+                       links to it instead of holding its own copy.
+    compression - h5py compression filter for the images, lzf, gzip or None
+    hour_workers - how many workers to read and CLAHE process hours with, processes
+                   unless configured otherwise in executors.py. Hours are
+                   written to the h5 file in time order by this process only.
+    max_tasks_per_child - replace each hour process after this many hours so memory
+                          it doesn't give back is released, None to keep them
     OUTPUT
     logging. I recommend writing to file by running this at the start of the code:
     
@@ -152,14 +317,6 @@ def themis_asi_to_hdf5_8bit_clahe(date:datetime, asi:str, save_dir:str, h5_dir:s
                     datefmt='%Y-%m-%d %H:%M:%S')
     """
 
-    def process_image(image:numpy.ndarray) -> numpy.ndarray:
-        """CLAHE processing of 16-bit image and downscale to 8-bit"""
-        # process the image using clahe
-        clahe = cv2.createCLAHE(clipLimit=3, tileGridSize=(8, 8))
-        image = clahe.apply(image)
- 
-        return cv2.convertScaleAbs(image, alpha=(255.0/65536.0))
-    
     # Write images to h5 dataset
     logging.info('Starting h5 file creation script for {} and {}...'.format(asi,
                                                                             date.date()))
@@ -177,31 +334,49 @@ def themis_asi_to_hdf5_8bit_clahe(date:datetime, asi:str, save_dir:str, h5_dir:s
         logging.critical('Images are not downloaded. Try running download_themis_images.')
     
     # Read in skymap
-    skymap_file = [f for f in os.listdir(tmp_img_dir) if f.endswith('.sav')][0]
+    skymap_files = [f for f in os.listdir(tmp_img_dir) if f.endswith('.sav')]
+    skymap_file = skymap_files[0] if len(skymap_files) > 0 else ''
 
-    try:
-        # Try reading IDL save file
-        skymap = readsav(tmp_img_dir + skymap_file, python_dict=True)['skymap']
-
-        # Get arrays
-        skymap_alt = skymap['FULL_MAP_ALTITUDE'][0]
-        skymap_glat = skymap['FULL_MAP_LATITUDE'][0][:, 0:-1, 0:-1]
-        skymap_glon = skymap['FULL_MAP_LONGITUDE'][0][:, 0:-1, 0:-1]
-        skymap_elev = skymap['FULL_ELEVATION'][0]
-        skymap_azim = skymap['FULL_AZIMUTH'][0]
+    # Use the skymap store if specified
+    skymap_store_file = None
+    if skymap_store_dir is not None:
+        try:
+            if skymap_file != '':
+                skymap_store_file = store_skymap(tmp_img_dir + skymap_file, skymap_store_dir)
+            else:
+                skymap_store_file = find_skymap(skymap_store_dir, asi, date)
+
+        except Exception as e:
+            logging.error('Unable to use skymap store: {}.'.format(skymap_store_dir))
+            logging.error('Exception: {}'.format(e))
+
+    if skymap_store_file is not None:
+        logging.info('Using stored skymap: {}'.format(skymap_store_file))
+
+    else:
+        try:
+            # Try reading IDL save file
+            skymap = readsav(tmp_img_dir + skymap_file, python_dict=True)['skymap']
+
+            # Get arrays
+            skymap_alt = skymap['FULL_MAP_ALTITUDE'][0]
+            skymap_glat = skymap['FULL_MAP_LATITUDE'][0][:, 0:-1, 0:-1]
+            skymap_glon = skymap['FULL_MAP_LONGITUDE'][0][:, 0:-1, 0:-1]
+            skymap_elev = skymap['FULL_ELEVATION'][0]
+            skymap_azim = skymap['FULL_AZIMUTH'][0]
         
-        logging.info('Read in skymap file from: {}'.format(skymap_file))
+            logging.info('Read in skymap file from: {}'.format(skymap_file))
         
-    except Exception as e:
-        logging.error('Unable to read skymap file: {}.'
-                         ' Creating file without it.'.format(tmp_img_dir + skymap_file))
-        logging.error('Exception: {}'.format(e))
+        except Exception as e:
+            logging.error('Unable to read skymap file: {}.'
+                             ' Creating file without it.'.format(tmp_img_dir + skymap_file))
+            logging.error('Exception: {}'.format(e))
         
-        skymap_alt = numpy.array(['Unavailable'])
-        skymap_glat = numpy.array(['Unavailable'])
-        skymap_glon = numpy.array(['Unavailable'])
-        skymap_elev = numpy.array(['Unavailable'])
-        skymap_azim = numpy.array(['Unavailable'])
+            skymap_alt = numpy.array(['Unavailable'])
+            skymap_glat = numpy.array(['Unavailable'])
+            skymap_glon = numpy.array(['Unavailable'])
+            skymap_elev = numpy.array(['Unavailable'])
+            skymap_azim = numpy.array(['Unavailable'])
 
     # Does the downloaded image directory exists?
     if not os.path.exists(tmp_img_dir):
@@ -225,73 +400,96 @@ def themis_asi_to_hdf5_8bit_clahe(date:datetime, asi:str, save_dir:str, h5_dir:s
     with h5py.File(h5file, 'w') as h5f:
 
         # Initialize the datasets for images and timestamps
-        img_ds = h5f.create_dataset('images', shape=(256, 256, 0),
-                                    maxshape=(256, 256, None),
-                                    dtype='uint8')
+        # preallocated from the number of files and trimmed at the end
+        n_files = sum(len(f) for f in filepathnames)
+        img_ds = create_images_dataset(h5f, n_files, (256, 256),
+                                       compression=compression)
 
-        time_ds = h5f.create_dataset('iso_ut_time', shape=(0,),
+        time_ds = h5f.create_dataset('iso_ut_time', shape=(n_files,),
                                      maxshape=(None,),
                                      dtype='S27')
 
-        alt_ds = h5f.create_dataset('skymap_alt', shape=skymap_alt.shape,
-                                     dtype='float', data=skymap_alt)        
-        
-        glat_ds = h5f.create_dataset('skymap_glat', shape=skymap_glat.shape,
-                                     dtype='float', data=skymap_glat)
+        if skymap_store_file is not None:
+            # Link to the stored skymap rather than copying it
+            link_skymap(h5f, skymap_store_file)
+
+        else:
+            alt_ds = h5f.create_dataset('skymap_alt', shape=skymap_alt.shape,
+                                         dtype='float', data=skymap_alt)        
+            
+            glat_ds = h5f.create_dataset('skymap_glat', shape=skymap_glat.shape,
+                                         dtype='float', data=skymap_glat)
 
-        glon_ds = h5f.create_dataset('skymap_glon', shape=skymap_glon.shape,
-                                     dtype='float', data=skymap_glon)
+            glon_ds = h5f.create_dataset('skymap_glon', shape=skymap_glon.shape,
+                                         dtype='float', data=skymap_glon)
 
-        elev_ds = h5f.create_dataset('skymap_elev', shape=skymap_elev.shape,
-                                     dtype='float', data=skymap_elev)
+            elev_ds = h5f.create_dataset('skymap_elev', shape=skymap_elev.shape,
+                                         dtype='float', data=skymap_elev)
 
-        azim_ds = h5f.create_dataset('skymap_azim', shape=skymap_azim.shape,
-                                     dtype='float', data=skymap_azim)
+            azim_ds = h5f.create_dataset('skymap_azim', shape=skymap_azim.shape,
+                                         dtype='float', data=skymap_azim)
+
+            alt_ds.attrs['about'] = 'Altitudes for different skymaps.'
+            glat_ds.attrs['about'] = 'Geographic latitude at pixel corner, excluding last.'
+            glon_ds.attrs['about'] = 'Geographic longitude at pixel corner, excluding last.'
+            elev_ds.attrs['about'] = 'Elevation angle of pixel center.'
+            azim_ds.attrs['about'] = 'Azimuthal angle of pixel center.'
 
         # Loop through each hour, process and write images to file
         logging.info('Processing and writing images to file...')
 
-        # Create dictionary to store images in
-        camera_dict = {}
+        # Number of frames written so far
+        n_written = 0
+
+        # Hours are read and processed by a pool of workers if specified, processes
+        # unless the themis_hours stage is configured otherwise (see executors.py),
+        # map returns them in order so this process is the only writer
+        executor = None
+        if hour_workers > 1:
+            executor = stage_executor('themis_hours', hour_workers, mp_context='spawn',
+                                      max_tasks_per_child=max_tasks_per_child)
+            hour_results = executor.map(_read_process_themis_hour, filepathnames)
+        else:
+            hour_results = (_read_process_themis_hour(f, workers=workers)
+                            for f in filepathnames)
 
         try:
-            for hour_filepathnames in filepathnames:
-                # logging.info('file name is {}'.format(hour_filepathnames))
-
-                # Read the data files
-                images, meta, problematic_files = themis_imager_readfile.read(hour_filepathnames,
-                                                                              workers=workers)
+            for hour_result in hour_results:
 
                 # Check if images exists
-                if images.shape[2] == 0:
+                if hour_result is None:
                     logging.warning(f'No images for hour, skipping.')
                     continue
-                else:
-                    latitude = float(meta[0]['Geodetic latitude'])
-                    longitude = float(meta[0]['Geodetic Longitude'])
 
-                # Extract datetimes from file
-                datetimes = [datetime.strptime(m['Image request start'],
-                                                 '%Y-%m-%d %H:%M:%S.%f %Z') for m in meta]
+                images, timestamps, latitude, longitude = hour_result
 
-                # Convert times to integer format
-                timestamps = numpy.array([t.isoformat() + 'Z' for t in datetimes]).astype('S27')
+                # Write image to dataset
+                n_frames = images.shape[0]
+                if n_written + n_frames > img_ds.shape[0]:
+                    img_ds.resize(n_written + n_frames, axis=0)
+                    time_ds.resize(n_written + n_frames, axis=0)
 
-                # Process the images
-                for n in range(images.shape[2]):
-                    images[:, :, n] = process_image(images[:, :, n])
+                img_ds[n_written:n_written + n_frames] = images
 
+                # Write timestamp to dataset
+                time_ds[n_written:n_written + n_frames] = timestamps
 
-                # Write image to dataset. This requires resizing
-                # logging.info("img shape {}".format(img.shape))
-                img_ds.resize(img_ds.shape[2] + images.shape[2], axis=2)
-                img_ds[:, :, -images.shape[2]:] = images
+                n_written = n_written + n_frames
 
-                # Write timestamp to dataset
-                time_ds.resize(time_ds.shape[0] + timestamps.shape[0], axis=0)
-                time_ds[-timestamps.shape[0]:] = timestamps
+            if executor is not None:
+                executor.shutdown()
+
+            # Trim any unused preallocated frames
+            img_ds.resize(n_written, axis=0)
+            time_ds.resize(n_written, axis=0)
+
+            # Integer times for binary search of time windows
+            write_epoch_index(h5f, time_ds[:])
 
         except Exception as e:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+
             logging.critical('Unable to write images to file. Stopping.'
                              ' Deleting h5 file and, if specified, images.')
             logging.critical('Exception: {}'.format(e))
@@ -310,11 +508,6 @@ def themis_asi_to_hdf5_8bit_clahe(date:datetime, asi:str, save_dir:str, h5_dir:s
         img_ds.attrs['wavelength'] = 'white'
         img_ds.attrs['station_latitude'] = latitude
         img_ds.attrs['station_longitude'] = longitude
-        alt_ds.attrs['about'] = 'Altitudes for different skymaps.'
-        glat_ds.attrs['about'] = 'Geographic latitude at pixel corner, excluding last.'
-        glon_ds.attrs['about'] = 'Geographic longitude at pixel corner, excluding last.'
-        elev_ds.attrs['about'] = 'Elevation angle of pixel center.'
-        azim_ds.attrs['about'] = 'Azimuthal angle of pixel center.'
         
     # Delete the raw image files if specified
     if del_files == True:
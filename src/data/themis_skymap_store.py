@@ -0,0 +1,178 @@
+"""
+Functions to keep a persistent store of parsed THEMIS ASI skymaps.
+Each skymap version is parsed from its IDL .sav file once and written to a
+small h5 file at {store_dir}/{asi}/{asi}_{YYYYMMDD}.h5. Daily image h5 files
+then link to these arrays instead of each carrying a full copy.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+from datetime import datetime
+import h5py
+import logging
+import os
+import re
+from scipy.io import readsav
+import tempfile
+
+# Datasets written for each skymap, matching the names used in the daily h5 files
+skymap_datasets = {'skymap_alt':'Altitudes for different skymaps.',
+                   'skymap_glat':'Geographic latitude at pixel corner, excluding last.',
+                   'skymap_glon':'Geographic longitude at pixel corner, excluding last.',
+                   'skymap_elev':'Elevation angle of pixel center.',
+                   'skymap_azim':'Azimuthal angle of pixel center.'}
+
+
+def parse_skymap_name(name:str) -> tuple:
+    """Function to get the station and start date from a skymap directory
+    or file name, e.g. atha_20181106 or themis_skymap_atha_20181106-+_v02.sav
+    INPUT
+    name - skymap directory or file name
+    OUTPUT
+    asi, valid_from - 4 letter station code and datetime the skymap starts at
+    """
+
+    match = re.search(r'([a-z]{4})_(\d{8})', os.path.basename(name.rstrip('/')))
+
+    if match is None:
+        raise ValueError('Could not find station and date in skymap name: {}'.format(name))
+
+    return match.group(1), datetime.strptime(match.group(2), '%Y%m%d')
+
+
+def skymap_store_file(store_dir:str, asi:str, valid_from:datetime) -> str:
+    """Function to get the path of a skymap in the store."""
+
+    return os.path.join(store_dir, asi, asi + '_' + valid_from.strftime('%Y%m%d') + '.h5')
+
+
+def has_skymap(store_dir:str, skymap_name:str) -> bool:
+    """Function to check if a skymap version is already in the store.
+    INPUT
+    store_dir - base directory of the skymap store
+    skymap_name - skymap directory or file name, see parse_skymap_name
+    OUTPUT
+    True if the skymap has already been parsed and stored
+    """
+
+    asi, valid_from = parse_skymap_name(skymap_name)
+
+    return os.path.exists(skymap_store_file(store_dir, asi, valid_from))
+
+
+def store_skymap(sav_file:str, store_dir:str) -> str:
+    """Function to parse a THEMIS skymap .sav file into the store.
+    If the skymap version is already stored the file isn't read again.
+    INPUT
+    sav_file - path to the IDL save skymap file
+    store_dir - base directory of the skymap store
+    OUTPUT
+    store_file - path to the h5 file with the parsed skymap
+    """
+
+    asi, valid_from = parse_skymap_name(sav_file)
+    store_file = skymap_store_file(store_dir, asi, valid_from)
+
+    if os.path.exists(store_file):
+        return store_file
+
+    os.makedirs(os.path.dirname(store_file), exist_ok=True)
+
+    # Read IDL save file
+    skymap = readsav(sav_file, python_dict=True)['skymap']
+
+    arrays = {'skymap_alt':skymap['FULL_MAP_ALTITUDE'][0],
+              'skymap_glat':skymap['FULL_MAP_LATITUDE'][0][:, 0:-1, 0:-1],
+              'skymap_glon':skymap['FULL_MAP_LONGITUDE'][0][:, 0:-1, 0:-1],
+              'skymap_elev':skymap['FULL_ELEVATION'][0],
+              'skymap_azim':skymap['FULL_AZIMUTH'][0]}
+
+    # Write to a temporary file first so a crash doesn't leave a partial skymap,
+    # unique to this call since several workers can store the same skymap at once
+    tmp_fd, tmp_file = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(store_file) + '.',
+                                        dir=os.path.dirname(store_file))
+    os.close(tmp_fd)
+
+    try:
+        with h5py.File(tmp_file, 'w') as h5f:
+
+            for name, data in arrays.items():
+                # Altitudes are tiny, keep them full precision
+                dtype = 'float' if name == 'skymap_alt' else 'float32'
+                ds = h5f.create_dataset(name, data=data.astype(dtype),
+                                        compression='gzip', shuffle=True)
+                ds.attrs['about'] = skymap_datasets[name]
+
+            h5f.attrs['station'] = asi
+            h5f.attrs['valid_from'] = valid_from.isoformat() + 'Z'
+            h5f.attrs['source_file'] = os.path.basename(sav_file)
+
+        # Whichever worker finishes last replaces an identical file
+        os.replace(tmp_file, store_file)
+
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    logging.info('Stored skymap {} at {}.'.format(os.path.basename(sav_file), store_file))
+
+    return store_file
+
+
+def list_skymaps(store_dir:str, asi:str) -> list:
+    """Function to list all stored skymaps for a station with their validity interval.
+    INPUT
+    store_dir - base directory of the skymap store
+    asi - 4 letter station code
+    OUTPUT
+    skymaps - list of (valid_from, valid_until, store_file) sorted by time.
+              valid_until is None for the newest skymap.
+    """
+
+    asi_dir = os.path.join(store_dir, asi)
+    if not os.path.exists(asi_dir):
+        return []
+
+    starts = sorted((parse_skymap_name(f)[1], os.path.join(asi_dir, f))
+                    for f in os.listdir(asi_dir) if f.endswith('.h5'))
+
+    return [(start, starts[n+1][0] if n+1 < len(starts) else None, f)
+            for n, (start, f) in enumerate(starts)]
+
+
+def find_skymap(store_dir:str, asi:str, date:datetime) -> str:
+    """Function to find the stored skymap that is valid for a date.
+    INPUT
+    store_dir - base directory of the skymap store
+    asi - 4 letter station code
+    date - date to find skymap for
+    OUTPUT
+    store_file - path to the h5 file with the parsed skymap, None if there isn't one
+    """
+
+    for valid_from, valid_until, store_file in list_skymaps(store_dir, asi):
+        if (valid_from < date) & ((valid_until is None) or (date <= valid_until)):
+            return store_file
+
+    return None
+
+
+def link_skymap(h5f:h5py.File, store_file:str) -> None:
+    """Function to add links in an open h5 file to the datasets of a stored
+    skymap. The links are relative to the h5 file so the data directory can
+    be moved as a whole.
+    INPUT
+    h5f - h5 file opened for writing
+    store_file - path to the h5 file with the parsed skymap
+    OUTPUT
+    none
+    """
+
+    rel_file = os.path.relpath(os.path.abspath(store_file),
+                               os.path.dirname(os.path.abspath(h5f.filename)))
+
+    for name in skymap_datasets:
+        h5f[name] = h5py.ExternalLink(rel_file, '/' + name)
+
+    h5f.attrs['skymap_file'] = rel_file
@@ -0,0 +1,253 @@
+"""
+Functions to build a per-day index of frame times without decoding images.
+THEMIS times come from the comment block of each frame in the .pgm.gz files
+and PFRR times from the primary FITS header (or the filename if the header
+doesn't have them). The index is a small h5 file that can be used for
+time-window selection, gap detection, and job planning.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+import concurrent.futures
+from datetime import datetime
+import gzip
+import h5py
+import logging
+import numpy
+import os
+import re
+
+# Matches the timestamp in a THEMIS comment like: "Image request start" 2020-01-04 00:02:06.053611 UTC
+_time_regex = re.compile(rb'(\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:\.\d+)?)')
+
+
+def _to_epoch_ns(times:list) -> numpy.ndarray:
+    """Function to convert a list of naive UTC datetimes to int64 ns since 1970."""
+
+    return numpy.array(times, dtype='datetime64[ns]').astype('int64')
+
+
+def read_pgm_times(filename:str) -> list:
+    """Function to get the image request start time of every frame in a THEMIS
+    .pgm or .pgm.gz file from the comment blocks only. Pixel data is skipped
+    over rather than decoded, although gzip files still need to be inflated.
+    INPUT
+    filename - THEMIS pgm file
+    OUTPUT
+    times - list of datetimes, one per frame
+    """
+
+    opener = gzip.open if filename.endswith('.gz') else open
+    times = []
+
+    with opener(filename, 'rb') as f:
+        while True:
+            magic = f.readline()
+            if not magic:
+                break
+            if not magic.startswith(b'P5'):
+                raise ValueError('Unexpected pgm frame header in {}'.format(filename))
+
+            # Tokens after the magic number are width, height, and maxval,
+            # comments can be between them
+            tokens = magic.split()[1:]
+            frame_time = None
+
+            while len(tokens) < 3:
+                line = f.readline()
+                if not line:
+                    raise ValueError('Truncated pgm header in {}'.format(filename))
+
+                if line.startswith(b'#'):
+                    if (frame_time is None) and (b'Image request start' in line):
+                        match = _time_regex.search(line)
+                        if match is not None:
+                            frame_time = datetime.fromisoformat(match.group(1).decode().replace(' ', 'T'))
+                    continue
+
+                tokens.extend(line.split())
+
+            width, height, maxval = [int(t) for t in tokens[0:3]]
+
+            # Skip the pixel data
+            f.seek(width*height*(2 if maxval > 255 else 1), os.SEEK_CUR)
+
+            times.append(frame_time)
+
+    return times
+
+
+def read_fits_time(filename:str) -> datetime:
+    """Function to get the time of a PFRR FITS image from its primary header.
+    Falls back to the time in the filename, e.g. PKR_DASC_0558_20120101_050230.000.FITS
+    INPUT
+    filename - fits file
+    OUTPUT
+    time - datetime of the image
+    """
+
+    # Only needed for PFRR so THEMIS indexing works without astropy
+    from astropy.io import fits
+
+    header = fits.getheader(filename, 0)
+
+    for key in ['DATE-OBS', 'OBSDATE']:
+        value = header.get(key)
+        if (value is None) or ('T' not in str(value)):
+            continue
+        try:
+            return datetime.fromisoformat(str(value).rstrip('Z'))
+        except ValueError:
+            pass
+
+    match = re.search(r'_(\d{8})_(\d{6})', os.path.basename(filename))
+
+    return datetime.strptime(match.group(1) + match.group(2), '%Y%m%d%H%M%S')
+
+
+def _write_index(index_file:str, files:list, file_times:list) -> dict:
+    """Function to write the time index for a list of files and their frame times."""
+
+    epoch_ns, file_index, frame_index = [], [], []
+
+    for n, times in enumerate(file_times):
+        for m, t in enumerate(times):
+            if t is None:
+                continue
+            epoch_ns.append(t)
+            file_index.append(n)
+            frame_index.append(m)
+
+    epoch_ns = _to_epoch_ns(epoch_ns)
+    order = numpy.argsort(epoch_ns, kind='stable')
+
+    index = {'epoch_ns':epoch_ns[order],
+             'file_index':numpy.array(file_index, dtype='int32')[order],
+             'frame_in_file':numpy.array(frame_index, dtype='int16')[order],
+             'files':numpy.array(files, dtype='S')}
+
+    index_dir = os.path.dirname(index_file)
+    if (index_dir != '') and (not os.path.exists(index_dir)):
+        os.makedirs(index_dir)
+
+    with h5py.File(index_file, 'w') as h5f:
+        for name, data in index.items():
+            h5f.create_dataset(name, data=data, compression='gzip')
+        h5f['epoch_ns'].attrs['about'] = 'Frame time in integer nanoseconds since 1970-01-01 UTC, sorted.'
+        h5f['file_index'].attrs['about'] = 'Index into files of the file each frame is in.'
+        h5f['frame_in_file'].attrs['about'] = 'Position of the frame within its file.'
+
+    return index
+
+
+def build_themis_time_index(asi_dir:str, index_file:str, workers:int=4) -> dict:
+    """Function to build the time index for one THEMIS camera and day.
+    INPUT
+    asi_dir - camera directory for a day, e.g. stream0/2020/01/04/atha_themis02/
+    index_file - h5 file to write the index to
+    workers - how many threads to read files with
+    OUTPUT
+    index - dictionary with the same arrays as are written to the file
+    """
+
+    files = []
+    for hour_dir in sorted(d for d in os.listdir(asi_dir) if d.startswith('ut')):
+        hour_path = os.path.join(asi_dir, hour_dir)
+        files.extend(sorted(os.path.join(hour_path, f) for f in os.listdir(hour_path)
+                            if ('full' in f) and not f.startswith('.')))
+
+    def _read(filename):
+        try:
+            return read_pgm_times(filename)
+        except Exception as e:
+            logging.warning('Unable to index {}: {}'.format(filename, e))
+            return []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        file_times = list(executor.map(_read, files))
+
+    logging.info('Indexed {} frames from {} files in {}.'.format(sum(len(t) for t in file_times),
+                                                                len(files), asi_dir))
+
+    return _write_index(index_file, files, file_times)
+
+
+def build_pfrr_time_index(day_dir:str, index_file:str, workers:int=4) -> dict:
+    """Function to build the time index for one day of PFRR FITS images.
+    INPUT
+    day_dir - directory with the FITS files for a day, e.g. pfrr/2012-01-01-558/
+    index_file - h5 file to write the index to
+    workers - how many threads to read headers with
+    OUTPUT
+    index - dictionary with the same arrays as are written to the file
+    """
+
+    files = sorted(os.path.join(day_dir, f) for f in os.listdir(day_dir) if f.endswith('.FITS'))
+
+    def _read(filename):
+        try:
+            return [read_fits_time(filename)]
+        except Exception as e:
+            logging.warning('Unable to index {}: {}'.format(filename, e))
+            return []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        file_times = list(executor.map(_read, files))
+
+    logging.info('Indexed {} files in {}.'.format(len(files), day_dir))
+
+    return _write_index(index_file, files, file_times)
+
+
+def read_time_index(index_file:str) -> dict:
+    """Function to read a time index written by one of the build functions."""
+
+    with h5py.File(index_file, 'r') as h5f:
+        return {name:h5f[name][:] for name in h5f}
+
+
+def select_time_window(index:dict, start:datetime, end:datetime) -> dict:
+    """Function to select the frames in [start, end) with a binary search.
+    file_index of the selection points into its own files list.
+
+    >>> index = {'epoch_ns':_to_epoch_ns([datetime(2020, 1, 4, h) for h in range(4)]),
+    ...          'file_index':numpy.array([0, 1, 2, 2]),
+    ...          'frame_in_file':numpy.array([0, 0, 0, 1]),
+    ...          'files':numpy.array([b'ut00', b'ut01', b'ut02'])}
+    >>> selection = select_time_window(index, datetime(2020, 1, 4, 1), datetime(2020, 1, 4, 3, 30))
+    >>> [selection['files'][n] for n in selection['file_index']]
+    ['ut01', 'ut02', 'ut02']
+
+    INPUT
+    index - time index, see read_time_index
+    start, end - naive UTC datetimes for the window
+    OUTPUT
+    selection - dictionary with the files and frame positions in the window
+    """
+
+    first, last = numpy.searchsorted(index['epoch_ns'], _to_epoch_ns([start, end]))
+
+    # Files with frames in the window, and each frame's position in that list
+    used, file_index = numpy.unique(index['file_index'][first:last], return_inverse=True)
+
+    return {'epoch_ns':index['epoch_ns'][first:last],
+            'file_index':file_index,
+            'frame_in_file':index['frame_in_file'][first:last],
+            'files':[f.decode() for f in index['files'][used]]}
+
+
+def find_gaps(index:dict, max_gap_s:float=10) -> list:
+    """Function to find gaps between consecutive frames longer than max_gap_s.
+    INPUT
+    index - time index, see read_time_index
+    max_gap_s - longest time between frames that isn't a gap
+    OUTPUT
+    gaps - list of (start, end) numpy datetime64 pairs for each gap
+    """
+
+    epoch_ns = index['epoch_ns']
+    gap_positions = numpy.nonzero(numpy.diff(epoch_ns) > max_gap_s*1e9)[0]
+
+    return [(epoch_ns[n].astype('datetime64[ns]'), epoch_ns[n+1].astype('datetime64[ns]'))
+            for n in gap_positions]
@@ -0,0 +1,162 @@
+"""
+Functions to run the download and processing of training data as two
+overlapping stages. While one day is being converted to an h5 file the next
+days are already downloading. Progress is kept in a json manifest so a
+restarted run skips days that already have a finished h5 file.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+import concurrent.futures
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+
+def load_manifest(manifest_file:str) -> dict:
+    """Function to read a job manifest, empty if it doesn't exist yet."""
+
+    if not os.path.exists(manifest_file):
+        return {}
+
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest:dict, manifest_file:str) -> None:
+    """Function to write a job manifest, replacing the old one in one step."""
+
+    manifest_dir = os.path.dirname(manifest_file)
+    if (manifest_dir != '') and (not os.path.exists(manifest_dir)):
+        os.makedirs(manifest_dir)
+
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    os.replace(tmp_file, manifest_file)
+
+
+def run_download_process_pipeline(jobs:list, download_func, process_func, output_func,
+                                  manifest_file:str, download_workers:int=1,
+                                  process_workers:int=1, max_ahead:int=2,
+                                  key_func=str) -> dict:
+    """Function to download and process jobs with the two stages overlapped.
+    A job is processed as soon as its download finishes, while later jobs
+    keep downloading. At most download_workers + max_ahead jobs are
+    downloaded but not yet processed at any time, which bounds the raw data on disk.
+    INPUT
+    jobs - list of jobs, e.g. (datetime, asi) tuples
+    download_func - function that takes a job and downloads it, raises on failure,
+                    can return the bytes it received to count the download throughput
+    process_func - function that takes a job and processes it, raises on failure
+    output_func - function that takes a job and returns the path of its finished output
+    manifest_file - json file to keep the status of each job in
+    download_workers - how many jobs to download at once
+    process_workers - how many jobs to process at once
+    max_ahead - how many extra downloaded jobs can wait for processing
+    key_func - function to turn a job into a manifest key
+    OUTPUT
+    summary - dictionary with counts, busy time and utilization of each stage,
+              and the bytes and MB/s of all downloads together
+    """
+
+    manifest = load_manifest(manifest_file)
+    lock = threading.Lock()
+
+    # Skip jobs that were finished in an earlier run
+    pending = []
+    for job in jobs:
+        entry = manifest.get(key_func(job), {})
+        if (entry.get('status') == 'processed') and os.path.exists(output_func(job)):
+            continue
+        pending.append(job)
+
+    logging.info('{} of {} jobs already processed. Starting pipeline for {} jobs with'
+                 ' {} download and {} process workers.'.format(len(jobs) - len(pending),
+                                                             len(jobs), len(pending),
+                                                             download_workers, process_workers))
+
+    stats = {stage:{'busy_s':0.0, 'done':0, 'failed':0} for stage in ['download', 'process']}
+    stats['download']['bytes'] = 0
+    ahead = threading.BoundedSemaphore(download_workers + max_ahead)
+
+    def _update(job, stage:str, status:str, seconds:float, received=None) -> None:
+        """Record the result of a stage in the stats and manifest."""
+        with lock:
+            stats[stage]['busy_s'] += seconds
+            stats[stage]['done' if status != 'failed' else 'failed'] += 1
+
+            entry = manifest.setdefault(key_func(job), {})
+            entry['status'] = status
+            entry[stage + '_s'] = round(seconds, 3)
+            if (stage == 'download') and isinstance(received, (int, float)):
+                stats[stage]['bytes'] += received
+                entry['download_bytes'] = received
+            entry['updated'] = datetime.now().isoformat()
+            save_manifest(manifest, manifest_file)
+
+    def _run_stage(job, stage:str, func, done_status:str) -> bool:
+        """Run one stage for a job and record it, True if it worked."""
+        start_time = time.monotonic()
+        try:
+            result = func(job)
+        except Exception as e:
+            logging.critical('Unable to {} {}. Stopped with error {}'.format(stage, job, e))
+            _update(job, stage, 'failed', time.monotonic() - start_time)
+            return False
+
+        _update(job, stage, done_status, time.monotonic() - start_time, result)
+        return True
+
+    def _process(job) -> None:
+        try:
+            _run_stage(job, 'process', process_func, 'processed')
+        finally:
+            ahead.release()
+
+    start_time = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=process_workers) as process_executor:
+
+        def _download(job) -> None:
+            if _run_stage(job, 'download', download_func, 'downloaded'):
+                process_executor.submit(_process, job)
+            else:
+                ahead.release()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=download_workers) as download_executor:
+            for job in pending:
+                # Wait here if too many jobs are waiting to be processed
+                ahead.acquire()
+                download_executor.submit(_download, job)
+
+    # Summarize how busy each stage was
+    elapsed = time.monotonic() - start_time
+    summary = {'jobs':len(jobs), 'skipped':len(jobs) - len(pending), 'elapsed_s':elapsed}
+
+    # Throughput of all the downloads together, over the whole run
+    stats['download']['MB_per_s'] = stats['download']['bytes']/1e6/max(elapsed, 1e-9)
+
+    for stage, workers in [('download', download_workers), ('process', process_workers)]:
+        stats[stage]['utilization'] = stats[stage]['busy_s']/max(elapsed*workers, 1e-9)
+        summary[stage] = stats[stage]
+
+        throughput = ''
+        if stage == 'download':
+            throughput = ', {:.1f} MB at {:.2f} MB/s'.format(stats[stage]['bytes']/1e6,
+                                                           stats[stage]['MB_per_s'])
+
+        logging.info('{} stage: {} done, {} failed, busy {:.0f} s,'
+                     ' utilization {:.0%}{}.'.format(stage, stats[stage]['done'],
+                                                     stats[stage]['failed'],
+                                                     stats[stage]['busy_s'],
+                                                     stats[stage]['utilization'], throughput))
+
+    logging.info('Pipeline finished in {:.0f} s.'.format(elapsed))
+
+    return summary
@@ -0,0 +1,61 @@
+"""
+Script to create keogram and ewogram pngs for all daily h5 files in a directory.
+If a matching model classification file exists it is plotted underneath.
+
+Run from the base directory with:
+python3 src/features/create-keograms.py data/interim/training/themis/ reports/figures/keograms/ [workers]
+
+Written by Riley Troyer
+science@rileytroyer.com
+"""
+# Import needed libraries
+from datetime import datetime
+from pathlib import Path
+import logging
+import os
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+from src.features.keogram_functions import create_keograms
+
+# Important directories
+logs_dir = 'logs/'
+classification_dir = 'data/processed/ml-classifications/'
+
+#------------------------------Initializing done------------------------------
+
+if __name__ == '__main__':
+
+    # Initiate logging
+    logging.basicConfig(filename=logs_dir + f'create-keograms-{datetime.today().date()}.log',
+                        encoding='utf-8',
+                        format='%(asctime)s %(levelname)-8s %(message)s',
+                        level=logging.INFO,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    h5_dir, png_dir = sys.argv[1], sys.argv[2]
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+
+    h5_files = sorted([os.path.join(root, f) for root, dirs, files in os.walk(h5_dir)
+                       for f in files if f.startswith('all-images-') and f.endswith('.h5')])
+
+    # Matching classification files, e.g. all-images-2020-01-04-atha.h5 to
+    # data/processed/ml-classifications/2020/01/04/20200104_atha_themis*_classifications.txt
+    classification_files = []
+    for h5_file in h5_files:
+        date_str, asi = os.path.basename(h5_file)[11:21], os.path.basename(h5_file)[22:-3]
+        day_dir = classification_dir + date_str.replace('-', '/') + '/'
+
+        matches = []
+        if os.path.exists(day_dir):
+            matches = sorted(f for f in os.listdir(day_dir)
+                             if f.startswith(date_str.replace('-', '') + '_' + asi))
+
+        classification_files.append(day_dir + matches[0] if matches else None)
+
+    logging.info(f'Creating keograms for {len(h5_files)} files.')
+
+    create_keograms(h5_files, png_dir, classification_files, workers=workers)
@@ -0,0 +1,209 @@
+"""
+Functions to create keograms and ewograms from the daily h5 image files.
+A keogram is the north-south meridian slice of every image stacked in
+time, an ewogram the east-west slice. Meridian pixels are found from the
+skymap_azim and skymap_elev arrays stored with the images. This gives a
+quick look at a whole day in one image, much faster than making a movie.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+import h5py
+import logging
+from matplotlib import pyplot
+import numpy
+import os
+import pandas
+
+from src.data.executors import stage_executor
+from src.data.h5_layout import get_frame_axis, iso_times_to_datetime64, read_frames
+
+# Colors for each class in the classification timeline
+class_colors = {'pulsating':'tab:green', 'other_aurora':'tab:olive',
+                'no_aurora':'tab:gray', 'bad_viewing':'tab:blue'}
+
+
+def get_meridian_pixels(azim:numpy.ndarray, elev:numpy.ndarray, direction:str='ns',
+                        min_elev:float=10) -> tuple:
+    """Function to find the pixels along the north-south or east-west meridian.
+    For every image row (ns) or column (ew) the pixel whose azimuth is closest
+    to the meridian is picked, then pixels are ordered by signed zenith angle.
+    INPUT
+    azim - azimuth angle of each pixel center in degrees
+    elev - elevation angle of each pixel center in degrees
+    direction - ns for a keogram, ew for an ewogram
+    min_elev - lowest elevation to include
+    OUTPUT
+    rows, cols, angles - pixel indices and zenith angle, positive to the north or east
+    """
+
+    azim_rad = numpy.deg2rad(numpy.nan_to_num(azim, nan=0))
+    valid = numpy.nan_to_num(elev, nan=-90) >= min_elev
+
+    # Distance from the meridian and which side of zenith a pixel is on
+    if direction == 'ns':
+        off_meridian = numpy.where(valid, numpy.abs(numpy.sin(azim_rad)), numpy.inf)
+        side = numpy.sign(numpy.cos(azim_rad))
+        rows = numpy.arange(azim.shape[0])
+        cols = off_meridian.argmin(axis=1)
+    else:
+        off_meridian = numpy.where(valid, numpy.abs(numpy.cos(azim_rad)), numpy.inf)
+        side = numpy.sign(numpy.sin(azim_rad))
+        cols = numpy.arange(azim.shape[1])
+        rows = off_meridian.argmin(axis=0)
+
+    # Keep only pixels that are actually close to the meridian
+    keep = off_meridian[rows, cols] < numpy.sin(numpy.deg2rad(5))
+    rows, cols = rows[keep], cols[keep]
+
+    angles = side[rows, cols]*(90 - elev[rows, cols])
+    order = numpy.argsort(angles)
+
+    return rows[order], cols[order], angles[order]
+
+
+def extract_keogram(h5file:str, direction:str='ns', min_elev:float=10,
+                    block:int=2000) -> tuple:
+    """Function to extract a keogram or ewogram from a daily h5 file.
+    Images are read in blocks and sliced with vectorized indexing.
+    INPUT
+    h5file - h5 file with images, iso_ut_time, skymap_azim, and skymap_elev
+    direction - ns for a keogram, ew for an ewogram
+    min_elev - lowest elevation to include
+    block - how many frames to read at a time
+    OUTPUT
+    keogram, times, angles - (frames, pixels) uint8 array, datetime64 times,
+                             and zenith angle of each pixel
+    """
+
+    with h5py.File(h5file, 'r') as h5f:
+        img_ds = h5f['images']
+        frame_axis = get_frame_axis(img_ds)
+        n_frames = img_ds.shape[frame_axis]
+        rows, cols = img_ds.shape[0:2] if frame_axis == 2 else img_ds.shape[1:]
+
+        try:
+            azim = h5f['skymap_azim'][:].astype('float')
+            elev = h5f['skymap_elev'][:].astype('float')
+            pixel_rows, pixel_cols, angles = get_meridian_pixels(azim, elev, direction=direction,
+                                                                 min_elev=min_elev)
+        except Exception as e:
+            # No usable skymap, use the center row or column of the image
+            logging.warning('No usable skymap in {}, using image center. {}'.format(h5file, e))
+            if direction == 'ns':
+                pixel_rows, pixel_cols = numpy.arange(rows), numpy.full(rows, cols//2)
+            else:
+                pixel_rows, pixel_cols = numpy.full(cols, rows//2), numpy.arange(cols)
+            angles = numpy.linspace(-90, 90, len(pixel_rows))
+
+        keogram = numpy.empty((n_frames, len(pixel_rows)), dtype='uint8')
+        for n in range(0, n_frames, block):
+            images = read_frames(img_ds, n, n + block)
+            keogram[n:n + images.shape[0]] = images[:, pixel_rows, pixel_cols]
+
+        times = iso_times_to_datetime64(h5f['iso_ut_time'][:])
+
+    return keogram, times, angles
+
+
+def read_classifications(classification_file:str) -> pandas.DataFrame:
+    """Function to read a model classification file written by all_tasks.py.
+    INPUT
+    classification_file - text file with date, time, prediction, prediction_str, confidence
+    OUTPUT
+    classifications - dataframe with a datetime64 time column added
+    """
+
+    classifications = pandas.read_csv(classification_file, comment='#')
+    classifications['time'] = pandas.to_datetime(classifications['date'].astype(str) + ' '
+                                                 + classifications['time'],
+                                                 format='%Y%m%d %H:%M:%S')
+
+    return classifications
+
+
+def plot_keogram(h5file:str, png_file:str, classification_file:str=None,
+                 min_elev:float=10) -> None:
+    """Function to plot the keogram and ewogram for a station-day to a png.
+    INPUT
+    h5file - daily h5 file with images
+    png_file - png file to write
+    classification_file - optional model classification file to plot underneath
+    min_elev - lowest elevation to include
+    OUTPUT
+    none
+    """
+
+    panels = ['ns', 'ew'] + (['classes'] if classification_file is not None else [])
+    heights = [3, 3] + ([0.6] if classification_file is not None else [])
+
+    fig, axes = pyplot.subplots(len(panels), 1, sharex=True, figsize=(12, 6),
+                                gridspec_kw={'height_ratios':heights})
+
+    for ax, direction in zip(axes, ['ns', 'ew']):
+        keogram, times, angles = extract_keogram(h5file, direction=direction, min_elev=min_elev)
+
+        if len(times) == 0:
+            continue
+
+        ax.pcolormesh(times, angles, keogram.T, cmap='gray', shading='nearest',
+                      vmin=0, vmax=255, rasterized=True)
+        ax.set_ylabel('N-S zenith angle' if direction == 'ns' else 'E-W zenith angle')
+
+    if classification_file is not None:
+        ax = axes[2]
+        classifications = read_classifications(classification_file)
+
+        for name, group in classifications.groupby('prediction_str'):
+            ax.scatter(group['time'], numpy.zeros(len(group)), marker='|', s=200,
+                       color=class_colors.get(name, 'black'), label=name)
+
+        ax.set_yticks([])
+        ax.legend(loc='upper right', ncol=len(class_colors), fontsize='small')
+
+    axes[0].set_title(os.path.basename(h5file))
+    axes[-1].set_xlabel('Time (UT)')
+
+    fig.tight_layout()
+
+    png_dir = os.path.dirname(png_file)
+    if (png_dir != '') and (not os.path.exists(png_dir)):
+        os.makedirs(png_dir)
+
+    fig.savefig(png_file, dpi=100)
+    pyplot.close(fig)
+
+
+def _keogram_job(job_input:list) -> None:
+    """Function to pass to a process pool, job_input is [h5file, png_file, classification_file]"""
+
+    try:
+        plot_keogram(*job_input)
+    except Exception as e:
+        logging.error('Unable to create keogram for {}: {}'.format(job_input[0], e))
+
+
+def create_keograms(h5_files:list, png_dir:str, classification_files:list=None,
+                    workers:int=1) -> None:
+    """Function to create keogram pngs for many h5 files with a process pool.
+    INPUT
+    h5_files - list of daily h5 files
+    png_dir - where to write pngs, named like the h5 file
+    classification_files - optional list of classification files, same order as h5_files
+    workers - how many processes to use
+    OUTPUT
+    none
+    """
+
+    if classification_files is None:
+        classification_files = [None]*len(h5_files)
+
+    job_input = [[f, os.path.join(png_dir, os.path.basename(f).replace('.h5', '-keogram.png')), c]
+                 for f, c in zip(h5_files, classification_files)]
+
+    # Processes unless the keogram stage is set to inline, matplotlib can't run on threads
+    with stage_executor('keogram', workers) as executor:
+        list(executor.map(_keogram_job, job_input))
+
+    logging.info('Created {} keograms in {}.'.format(len(job_input), png_dir))
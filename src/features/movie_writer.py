@@ -0,0 +1,138 @@
+"""
+Functions to quickly write timestamped movies from h5 image files.
+Frames are read straight from the h5 file as uint8, the frame number and
+timestamp are drawn with OpenCV, and raw frames are piped into ffmpeg.
+This skips matplotlib entirely and is much faster than FuncAnimation.
+If ffmpeg isn't installed cv2.VideoWriter is used instead.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+import cv2
+import h5py
+import logging
+import numpy
+import shutil
+import subprocess
+
+from src.data.h5_layout import get_frame_axis, read_frames
+
+
+def iso_bytes_to_label(iso_time:bytes) -> str:
+    """Function to turn an S27 ISO timestamp into the label used on movies,
+    e.g. b'2020-01-04T00:02:06.053611Z' to '2020-01-04 00:02:06.053611+00:00'
+    """
+
+    return iso_time.decode().rstrip('Z').replace('T', ' ') + '+00:00'
+
+
+class _FrameSink:
+    """Writes BGR uint8 frames to an ffmpeg pipe, or cv2.VideoWriter without ffmpeg."""
+
+    def __init__(self, movie_file:str, width:int, height:int, fps:float):
+        self.process = None
+        self.writer = None
+
+        if shutil.which('ffmpeg') is not None:
+            self.process = subprocess.Popen(['ffmpeg', '-y', '-loglevel', 'error',
+                                             '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+                                             '-s', '{}x{}'.format(width, height),
+                                             '-r', str(fps), '-i', '-',
+                                             '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+                                             '-crf', '20', movie_file],
+                                            stdin=subprocess.PIPE)
+        else:
+            logging.warning('ffmpeg not found, writing movie with cv2.VideoWriter.')
+            self.writer = cv2.VideoWriter(movie_file, cv2.VideoWriter_fourcc(*'mp4v'),
+                                          fps, (width, height))
+            # VideoWriter doesn't raise, e.g. when the directory doesn't exist, and
+            # would silently drop every frame
+            if not self.writer.isOpened():
+                raise IOError('Unable to open {} with cv2.VideoWriter.'.format(movie_file))
+
+    def write(self, frame:numpy.ndarray) -> None:
+        if self.process is not None:
+            self.process.stdin.write(frame.tobytes())
+        else:
+            self.writer.write(frame)
+
+    def close(self) -> None:
+        if self.process is not None:
+            self.process.stdin.close()
+            if self.process.wait() != 0:
+                raise RuntimeError('ffmpeg exited with code {}'.format(self.process.returncode))
+        else:
+            self.writer.release()
+
+
+def write_timestamped_movie(h5file:str, movie_file:str, fps:float=20.0, flip:bool=False,
+                            frame_digits:int=5, scale:int=2, start:int=0, stop:int=None,
+                            frame_offset:int=None, block:int=500) -> int:
+    """Function to write a movie with frame number and timestamp from an h5 file.
+    INPUT
+    h5file - h5 file with images and iso_ut_time datasets
+    movie_file - mp4 file to write
+    fps - frames per second of the movie
+    flip - whether to flip images upside down, THEMIS images need this
+    frame_digits - how many digits to pad the frame number to
+    scale - integer upscaling of the frames so the text is readable
+    start, stop - range of frames to include, stop=None goes to the end
+    frame_offset - number the first frame starts at, defaults to start
+    block - how many frames to read from the file at a time
+    OUTPUT
+    frames - number of frames written
+    """
+
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    color = (0, 0, 255)
+    frame_offset = start if frame_offset is None else frame_offset
+
+    with h5py.File(h5file, 'r') as h5f:
+        img_ds = h5f['images']
+        time_ds = h5f['iso_ut_time']
+
+        frame_axis = get_frame_axis(img_ds)
+        n_frames = img_ds.shape[frame_axis]
+        stop = n_frames if stop is None else min(stop, n_frames)
+        rows, cols = img_ds.shape[0:2] if frame_axis == 2 else img_ds.shape[1:]
+
+        height, width = rows*scale, cols*scale
+
+        # Place and size text like the matplotlib version relative to the image
+        size = cols/256
+        text_y = int((rows - 6*size)*scale)
+        time_x = int(120*size*scale)
+        font_scale = 0.4*size*scale
+        thickness = max(int(size*scale), 1)
+
+        sink = _FrameSink(movie_file, width, height, fps)
+        frame = numpy.empty((height, width, 3), dtype='uint8')
+
+        try:
+            for n in range(start, stop, block):
+                images = read_frames(img_ds, n, min(n + block, stop))
+                times = time_ds[n:n + images.shape[0]]
+
+                for m in range(images.shape[0]):
+                    image = cv2.flip(images[m], 0) if flip else images[m]
+
+                    # Upscale into the reused frame buffer and draw text
+                    cv2.cvtColor(cv2.resize(image, (width, height),
+                                            interpolation=cv2.INTER_NEAREST),
+                                 cv2.COLOR_GRAY2BGR, dst=frame)
+
+                    cv2.putText(frame, str(n + m - start + frame_offset).zfill(frame_digits),
+                                (int(10*size*scale), text_y), font, font_scale, color,
+                                thickness, cv2.LINE_AA)
+                    cv2.putText(frame, iso_bytes_to_label(times[m]), (time_x, text_y),
+                                font, font_scale, color, thickness, cv2.LINE_AA)
+
+                    sink.write(frame)
+
+        finally:
+            sink.close()
+
+    logging.info('Wrote {} frames to {}.'.format(stop - start, movie_file))
+
+    return stop - start
@@ -5,15 +5,17 @@ Functions used to visualize PFRR ASI Images such as creating movies
 """
 
 from datetime import datetime
-from dateutil import parser
 import h5py
 import logging
 from matplotlib import animation
 from matplotlib import pyplot as plt
 import os
 
+from src.features.movie_writer import iso_bytes_to_label, write_timestamped_movie
 
-def create_timestamped_movie(date:datetime.date, save_dir:str, movie_dir:str, wavelength:str='558') -> None:
+
+def create_timestamped_movie(date:datetime.date, save_dir:str, movie_dir:str, wavelength:str='558',
+                             renderer:str='matplotlib') -> None:
     
     """Function to create a movie from PFRR ASI files with a timestamp and frame number.
     Includes a timestamp, and frame number.
@@ -22,6 +24,8 @@ def create_timestamped_movie(date:datetime.date, save_dir:str, movie_dir:str, wa
     movie_dir - base directory to store keogram image
     save_dir - base directory to where raw images are stored.
     wavelength - which wavelength images are being used. 428, 558, or 630
+    renderer - matplotlib, or opencv to draw text with OpenCV and pipe frames straight
+               into ffmpeg, which is much faster
     OUTPUT
     logging information
     """
@@ -30,10 +34,18 @@ def create_timestamped_movie(date:datetime.date, save_dir:str, movie_dir:str, wa
     img_file = (save_dir + '/all-images-'
                 + str(date) + '-' + wavelength + '.h5')
 
+    if renderer == 'opencv':
+        if not os.path.exists(movie_dir):
+            os.makedirs(movie_dir)
+
+        write_timestamped_movie(img_file, movie_dir + str(date) + '-' + wavelength + '.mp4',
+                                fps=20.0, flip=False, frame_digits=4)
+        return
+
     pfrr_file = h5py.File(img_file, "r")
 
     # Get times from file
-    all_times = [parser.isoparse(d) for d in pfrr_file['iso_ut_time']]
+    all_times = [iso_bytes_to_label(d) for d in pfrr_file['iso_ut_time']]
 
     # Get all the images too
     all_images = pfrr_file['images']
@@ -0,0 +1,229 @@
+"""
+Functions to project all-sky images onto a geographic latitude/longitude grid
+and combine stations into time-synchronized mosaics.
+The mapping from grid points to image pixels is computed once per station,
+skymap version, altitude and grid, cached to disk, and then applied to
+whole batches of frames with cv2.remap, a single lookup pass per frame.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+import cv2
+import h5py
+import hashlib
+import logging
+import numpy
+import os
+from scipy.interpolate import griddata
+
+from src.data.h5_layout import iso_times_to_datetime64, read_frames
+from src.data.h5_reader import h5_station
+
+# Remap tables already loaded in this process
+_remap_cache = {}
+
+
+def make_grid(lat_min:float, lat_max:float, lon_min:float, lon_max:float,
+              n_lat:int=500, n_lon:int=1000) -> dict:
+    """Function to define an output latitude/longitude grid.
+    INPUT
+    lat_min, lat_max - latitude range in degrees
+    lon_min, lon_max - longitude range in degrees, -180 to 180
+    n_lat, n_lon - number of grid points in each direction
+    OUTPUT
+    grid - dictionary with the grid definition and 1D lat and lon arrays
+    """
+
+    return {'lat_min':lat_min, 'lat_max':lat_max, 'lon_min':lon_min, 'lon_max':lon_max,
+            'n_lat':n_lat, 'n_lon':n_lon,
+            'lat':numpy.linspace(lat_max, lat_min, n_lat),
+            'lon':numpy.linspace(lon_min, lon_max, n_lon)}
+
+
+def _grid_key(grid:dict) -> str:
+    """Function to turn a grid definition into a short string for cache filenames."""
+
+    definition = '{lat_min}_{lat_max}_{lon_min}_{lon_max}_{n_lat}_{n_lon}'.format(**grid)
+
+    return hashlib.sha1(definition.encode()).hexdigest()[0:10]
+
+
+def _skymap_version(h5f:h5py.File) -> str:
+    """Function to get an identifier of the skymap used by a daily h5 file.
+    This is the stored skymap name if the file links to the skymap store,
+    otherwise a hash of the latitude array.
+    """
+
+    if 'skymap_file' in h5f.attrs:
+        return os.path.splitext(os.path.basename(h5f.attrs['skymap_file']))[0]
+
+    return hashlib.sha1(h5f['skymap_glat'][:].tobytes()).hexdigest()[0:10]
+
+
+def build_remap_table(glat:numpy.ndarray, glon:numpy.ndarray, elev:numpy.ndarray,
+                      grid:dict, min_elev:float=10) -> dict:
+    """Function to compute the cv2.remap tables from a grid to image pixels.
+    INPUT
+    glat, glon - geographic latitude and longitude of each pixel at one altitude
+    elev - elevation angle of each pixel in degrees
+    grid - output grid, see make_grid
+    min_elev - lowest elevation to include
+    OUTPUT
+    table - dictionary with map_x and map_y float32 arrays of the grid shape giving
+            the image column and row for each grid point (-1 outside the image), and
+            the elevation at each grid point (nan outside the image)
+    """
+
+    rows, cols = numpy.mgrid[0:glat.shape[0], 0:glat.shape[1]]
+    glon = (glon + 180) % 360 - 180
+
+    valid = (numpy.isfinite(glat) & numpy.isfinite(glon)
+             & (numpy.nan_to_num(elev, nan=-90) >= min_elev))
+
+    grid_lon, grid_lat = numpy.meshgrid(grid['lon'], grid['lat'])
+    points = numpy.column_stack([glon[valid], glat[valid]])
+
+    map_x = griddata(points, cols[valid].astype('float32'), (grid_lon, grid_lat),
+                     method='linear', fill_value=-1)
+    map_y = griddata(points, rows[valid].astype('float32'), (grid_lon, grid_lat),
+                     method='linear', fill_value=-1)
+    grid_elev = griddata(points, elev[valid], (grid_lon, grid_lat),
+                         method='linear', fill_value=numpy.nan)
+
+    return {'map_x':map_x.astype('float32'), 'map_y':map_y.astype('float32'),
+            'elev':grid_elev.astype('float32')}
+
+
+def get_remap_table(h5file:str, grid:dict, altitude:float=110, min_elev:float=10,
+                    cache_dir:str='data/interim/remap-tables/') -> dict:
+    """Function to get the remap table for a daily h5 file, computing and
+    caching it if it doesn't exist for this station, skymap, altitude and grid yet.
+    INPUT
+    h5file - daily h5 file with skymap_glat, skymap_glon, skymap_elev and skymap_alt
+    grid - output grid, see make_grid
+    altitude - altitude in km to project to, the closest skymap altitude is used
+    min_elev - lowest elevation to include
+    cache_dir - where to store remap tables
+    OUTPUT
+    table - remap table, see build_remap_table
+    """
+
+    with h5py.File(h5file, 'r') as h5f:
+        asi = h5_station(h5file)
+        alts = h5f['skymap_alt'][:]
+
+        # Altitudes are stored in m in the THEMIS skymaps
+        alt_km = alts/1000 if alts.max() > 1000 else alts
+        n_alt = int(numpy.argmin(numpy.abs(alt_km - altitude)))
+
+        key = '{}_{}_{:.0f}km_{}deg_{}'.format(asi, _skymap_version(h5f), alt_km[n_alt],
+                                             min_elev, _grid_key(grid))
+
+        if key in _remap_cache:
+            return _remap_cache[key]
+
+        cache_file = os.path.join(cache_dir, key + '.npz')
+
+        if os.path.exists(cache_file):
+            with numpy.load(cache_file) as cached:
+                table = {name:cached[name] for name in cached.files}
+
+        else:
+            logging.info('Building remap table {}.'.format(key))
+            table = build_remap_table(h5f['skymap_glat'][n_alt], h5f['skymap_glon'][n_alt],
+                                      h5f['skymap_elev'][:], grid, min_elev=min_elev)
+
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            numpy.savez(cache_file, **table)
+
+    _remap_cache[key] = table
+
+    return table
+
+
+def project_frames(frames:numpy.ndarray, table:dict) -> numpy.ndarray:
+    """Function to project a batch of frames onto the grid of a remap table.
+    INPUT
+    frames - uint8 array of shape (frames, rows, columns)
+    table - remap table, see get_remap_table
+    OUTPUT
+    projected - uint8 array of shape (frames, n_lat, n_lon), 0 outside the image
+    """
+
+    projected = numpy.empty((frames.shape[0],) + table['map_x'].shape, dtype=frames.dtype)
+
+    for n in range(frames.shape[0]):
+        cv2.remap(frames[n], table['map_x'], table['map_y'], cv2.INTER_LINEAR,
+                  dst=projected[n], borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    return projected
+
+
+def create_mosaics(h5_files:list, times:numpy.ndarray, grid:dict, altitude:float=110,
+                   min_elev:float=10, max_dt_s:float=3,
+                   cache_dir:str='data/interim/remap-tables/') -> numpy.ndarray:
+    """Function to create multi-station mosaics at a list of times.
+    For each time the closest frame of every station within max_dt_s is projected.
+    Where stations overlap the one seeing the grid point at the highest elevation is used.
+    INPUT
+    h5_files - daily h5 files, one per station
+    times - datetime64 array of mosaic times
+    grid - output grid, see make_grid
+    altitude - altitude in km to project to
+    min_elev - lowest elevation to include
+    max_dt_s - largest time difference between a mosaic time and a frame
+    cache_dir - where to store remap tables
+    OUTPUT
+    mosaics - uint8 array of shape (times, n_lat, n_lon)
+    """
+
+    times = numpy.asarray(times).astype('datetime64[us]')
+
+    mosaics = numpy.zeros((len(times), grid['n_lat'], grid['n_lon']), dtype='uint8')
+
+    # Highest elevation filled in so far at each mosaic time, a station only
+    # claims grid points at times it has a frame for
+    best_elev = numpy.full((len(times), grid['n_lat'], grid['n_lon']), -numpy.inf, dtype='float32')
+
+    for h5file in h5_files:
+        try:
+            table = get_remap_table(h5file, grid, altitude=altitude, min_elev=min_elev,
+                                    cache_dir=cache_dir)
+        except Exception as e:
+            logging.warning('Unable to project {}, skipping. {}'.format(h5file, e))
+            continue
+
+        station_elev = numpy.nan_to_num(table['elev'], nan=-numpy.inf)
+        if not numpy.isfinite(station_elev).any():
+            continue
+
+        with h5py.File(h5file, 'r') as h5f:
+            frame_times = iso_times_to_datetime64(h5f['iso_ut_time'][:])
+            if len(frame_times) == 0:
+                continue
+
+            # Closest frame to each mosaic time
+            nearest = numpy.clip(numpy.searchsorted(frame_times, times), 0, len(frame_times) - 1)
+            previous = numpy.maximum(nearest - 1, 0)
+            before = numpy.abs(times - frame_times[previous]) <= numpy.abs(frame_times[nearest] - times)
+            nearest = numpy.where(before, previous, nearest)
+            in_range = numpy.abs(frame_times[nearest] - times) <= numpy.timedelta64(int(max_dt_s*1e6), 'us')
+
+            # Project each needed frame once as a batch
+            needed, positions = numpy.unique(nearest[in_range], return_inverse=True)
+            if len(needed) == 0:
+                continue
+
+            img_ds = h5f['images']
+            frames = numpy.concatenate([read_frames(img_ds, f, f + 1) for f in needed])
+            projected = project_frames(frames, table)
+
+            # Grid points this station is the best view of at each time
+            for n, position in zip(numpy.nonzero(in_range)[0], positions):
+                use = station_elev > best_elev[n]
+                best_elev[n][use] = station_elev[use]
+                mosaics[n][use] = projected[position][use]
+
+    return mosaics
@@ -6,36 +6,37 @@ science@rileytroyer.com
 """
 
 from datetime import datetime
-import gc
-from dateutil import parser
 import h5py
 import logging
 import math
 from matplotlib import animation
 from matplotlib import pyplot
-from moviepy.editor import *
-import multiprocessing
-from multiprocessing import Pool
 import numpy
 import os
-import re
+import subprocess
+
+from src.data.executors import stage_executor
+from src.data.h5_layout import read_frames
+from src.features.movie_writer import iso_bytes_to_label, write_timestamped_movie
 
 def movie_job(job_input:list):
     """Function to create timestamped movie from input images and times. 
     Outputs to .mp4 file with specified filename.
     INPUT
-    job_input - [filepathname.mp4, list of datetimes, array of images]
+    job_input - [filepathname.mp4, h5 filepathname, first frame, last frame + 1]
+                each worker reads only its own frames from the h5 file
     OUTPUT
     None
     """
-    # Get times from input
-    all_times = job_input[1]
+    movie_fn, img_file, start_frame, stop_frame = job_input
 
-    # Get all the images too
-    all_images = job_input[2]
+    # Read this chunk's times and images from the h5 file
+    with h5py.File(img_file, 'r') as themis_file:
+        all_times = [iso_bytes_to_label(d) for d in themis_file['iso_ut_time'][start_frame:stop_frame]]
+        all_images = read_frames(themis_file['images'], start_frame, stop_frame)
 
     # CREATE MOVIE
-    img_num = all_images.shape[2]
+    img_num = all_images.shape[0]
     fps = 20.0
 
 
@@ -47,7 +48,7 @@ def movie_job(job_input:list):
     axpic.axis('off')
 
     # Plot the image
-    img = axpic.imshow(numpy.flipud(all_images[:, :, 0]),
+    img = axpic.imshow(numpy.flipud(all_images[0]),
                        cmap='gray', animated=True)
 
     # Add frame number and timestamp to video
@@ -65,9 +66,8 @@ def movie_job(job_input:list):
         """Function to update the animation"""
 
         # Set new image data
-        img.set_data(numpy.flipud(all_images[:, :, frame]))
+        img.set_data(numpy.flipud(all_images[frame]))
         # And the frame number
-        start_frame = int(job_input[0].split('/')[-1].split('.')[0][11:])
         frame_num.set_text(str(frame + start_frame).zfill(5))
         #...and time
         time_str = str(all_times[frame])
@@ -86,12 +86,13 @@ def movie_job(job_input:list):
 
 
     # Use ffmpeg writer to save animation
-    event_movie_fn = (job_input[0])
+    event_movie_fn = movie_fn
     writer = animation.writers['ffmpeg'](fps=fps)
     anim.save(event_movie_fn,
               writer=writer, dpi=150)
 
-def create_timestamped_movie(date:datetime, asi:str, save_dir:str, workers:int=1):
+def create_timestamped_movie(date:datetime, asi:str, save_dir:str, workers:int=1,
+                             renderer:str='matplotlib'):
     """Function to create a movie from THEMIS ASI files with a timestamp and frame number.
     Includes a timestamp, and frame number. 
     INPUT
@@ -99,6 +100,8 @@ def create_timestamped_movie(date:datetime, asi:str, save_dir:str, workers:int=1
     asi - 4 letter themis asi location
     save_dir - where h5 file images are stored.
     workers - how many processes to create movies with.
+    renderer - matplotlib, or opencv to draw text with OpenCV and pipe frames straight
+               into ffmpeg. opencv is much faster and doesn't need workers.
     OUTPUT
     none
     """
@@ -110,17 +113,27 @@ def create_timestamped_movie(date:datetime, asi:str, save_dir:str, workers:int=1
     img_file = (save_dir + asi + '/all-images-'
                 + str(date.date()) + '-' + asi + '.h5')
 
-    logging.info('Reading in h5 file: {}'.format(img_file))
+    if renderer == 'opencv':
+        movie_dir = save_dir + asi + '/movies/'
+        if not os.path.exists(movie_dir):
+            os.makedirs(movie_dir)
 
-    try:
-        # Read in h5 file
-        themis_file = h5py.File(img_file, "r")
+        full_movie_pathname = movie_dir + 'full-movie-' + str(date.date()) + '-' + asi + '.mp4'
+        logging.info('Writing movie with OpenCV to: {}'.format(full_movie_pathname))
+
+        write_timestamped_movie(img_file, full_movie_pathname, fps=20.0, flip=True,
+                                frame_digits=5)
 
-        # Get times from file
-        all_times = [parser.isoparse(d) for d in pfrr_file['iso_ut_time']]
+        logging.info('Finished timestamped movie script for {} and {}.'.format(asi,
+                                                                               date.date()))
+        return
 
-        # Get all the images
-        all_images = themis_file['images']
+    logging.info('Reading in h5 file: {}'.format(img_file))
+
+    try:
+        # Only the number of frames is needed here, workers read their own frames
+        with h5py.File(img_file, "r") as themis_file:
+            n_frames = themis_file['iso_ut_time'].shape[0]
 
     except Exception as e:
         logging.critical('There was an issue reading in the h5 file. Stopping.')
@@ -133,8 +146,9 @@ def create_timestamped_movie(date:datetime, asi:str, save_dir:str, workers:int=1
         os.makedirs(movie_dir)
 
     # Check if directory to store temporary frames exists
-    if not os.path.exists(save_dir + 'tmp-frames/'):
-        os.makedirs(save_dir + 'tmp-frames/')
+    tmp_dir = save_dir + 'tmp-frames/'
+    if not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)
 
 
     # Split images and times into smaller portions
@@ -142,38 +156,25 @@ def create_timestamped_movie(date:datetime, asi:str, save_dir:str, workers:int=1
 
     # How many smaller movies to make, these will get combined into 1 at the end
     bins = 10
-    chunk_size = math.ceil(len(all_times)/bins)
+    chunk_size = math.ceil(n_frames/bins)
 
     # Define a list to be able to input into the parallelization job
+    # each job only gets the h5 file and its frame range, so memory stays flat
     job_input = []
-
-    # Loop through each chunk and set as one job input
-    for n in range(0, len(all_times), chunk_size):
+    for n in range(0, n_frames, chunk_size):
 
         # Filename for movie chunk
-        filename = save_dir + 'tmp-frames/tmp-frames-' + str(n) + '.mp4'
+        filename = tmp_dir + 'tmp-frames-' + asi + '-' + str(n) + '.mp4'
 
-        # Append to job input, need filename, times, and images
-        job_input.append([filename, all_times[n:n+chunk_size],
-                          all_images[:, :, n:n+chunk_size]])
+        job_input.append([filename, img_file, n, min(n + chunk_size, n_frames)])
 
-    # Delete first image array to save ram as this is pretty big
-    del all_images, all_times
-    gc.collect()
-
-    # Start multiprocessing
-    # be aware this can use a fairly large amount of RAM.
-    # I often see around 5GB used.
     logging.info('Starting {} movie creating processes.'
                  ' Tmp movies will be combined into one at the end.'.format(workers))
 
     try:
-        with multiprocessing.get_context("forkserver").Pool(processes=workers) as pool:
-            pool.map(movie_job, job_input)
-
-        # Terminate threads when finished
-        pool.terminate()
-        pool.join()
+        # Processes unless the movie stage is set to inline, matplotlib can't run on threads
+        with stage_executor('movie', workers, mp_context='forkserver') as executor:
+            list(executor.map(movie_job, job_input))
 
     except Exception as e:
         logging.critical('There was an issue creating the tmp movie files. Stopping.')
@@ -182,37 +183,30 @@ def create_timestamped_movie(date:datetime, asi:str, save_dir:str, workers:int=1
 
     logging.info('Finished creating tmp movies.')
 
-    # List of all tmp movies
-    tmp_movie_files = [f for f in os.listdir(save_dir + 'tmp-frames/')
-                       if f.startswith('tmp') & f.endswith('.mp4')]
-
-    # Make sure files are sorted properly
-    def num_sort(string):
-        return list(map(int, re.findall(r'\d+', string)))[0]
-
-    tmp_movie_files.sort(key=num_sort)
-
-    # Add in path
-    tmp_movie_files = [save_dir + 'tmp-frames/' + f for f in tmp_movie_files]
+    # Tmp movies in frame order
+    tmp_movie_files = [job[0] for job in job_input]
 
     # File to write
     full_movie_pathname = movie_dir + 'full-movie-' + str(date.date()) + '-' + asi + '.mp4'
 
-    # Concatenate smaller tmp movies into a full one
+    # Concatenate smaller tmp movies into a full one. The chunks all have the same
+    # encoding so ffmpeg's concat demuxer can copy the streams without re-encoding
     logging.info('Combining tmp movies into one file at: {}.'.format(full_movie_pathname))
+    concat_list = tmp_dir + 'concat-' + asi + '-' + str(date.date()) + '.txt'
     try:
-        clips = []
-
-        for filename in tmp_movie_files:
-            clips.append(VideoFileClip(filename))
+        with open(concat_list, 'w') as f:
+            for filename in tmp_movie_files:
+                f.write("file '{}'\n".format(os.path.abspath(filename)))
 
-        video = concatenate_videoclips(clips, method='chain')
-        video.write_videofile(full_movie_pathname)
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                        '-i', concat_list, '-c', 'copy', full_movie_pathname], check=True)
 
     except Exception as e:
         logging.warning('There was an issue creating the full movie file. Stopping.')
         logging.warning('Exception: {}'.format(e))
 
+    tmp_movie_files.append(concat_list)
+
     logging.info('Full movie file created. Deleting tmp files.')
 
     try:
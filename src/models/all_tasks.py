@@ -1,14 +1,37 @@
 #from video_generator import *
+import multiprocessing as mp
+from pathlib import Path
+import sys
+
+# Add root to path so src can be imported, also in spawned workers
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+from src.models.resource_governor import (init_worker, limit_stage, plan_allocation,
+                                          publish_allocation, worker_environment)
+
+# split the core budget (NUM_PROCESSES, default all cores) between reading, preprocessing
+# and the model before numpy, opencv and tensorflow start their thread pools, the batcher
+# predicts while the next hour is read and preprocessed so the stages overlap
+allocation = plan_allocation(int(sys.argv[3]) if len(sys.argv) > 3 and sys.argv[3].isdigit() else None,
+                             overlap=True)
+if mp.current_process().name == 'MainProcess':
+    limit_stage(allocation, 'inference')
+
 from all_tasks_func import *
 from datetime import datetime
-import sys
 import logging
 import numpy as np
 import os
 import pandas as pd
 from multiprocessing import Pool, cpu_count, get_context
-import multiprocessing as mp
-import gc
+from functools import partial
+
+from src.data.executors import default_chunksize, executor_kind, stage_executor
+from src.models.inference_batcher import ClassificationWriter, InferenceBatcher
+from src.models.memory_watchdog import IsolatedPredictor, MemoryWatchdog
+from src.models.run_metrics import RunMetrics, timed_call
+from src.models.tracing import merge_traces, tracing_enabled
 
 # get args from command line
 if len(sys.argv) > 1:
@@ -59,6 +82,24 @@ if __name__ == '__main__':
         logging.critical(f'Number of processors not valid, Exception: {e}')
         sys.exit()
 
+    # per-stage timings to logs/all_tasks-metrics.jsonl and a Prometheus textfile
+    metrics = RunMetrics('all_tasks', metrics_dir='logs/', total=len(subfolder_paths))
+
+    # log the core allocation and save it to logs/ next to the metrics
+    publish_allocation(allocation, metrics)
+
+    # sample memory of this process, the pool workers and /dev/shm into the metrics,
+    # if this process keeps growing prediction is moved to a subprocess that is restarted
+    watchdog = MemoryWatchdog(metrics=metrics, interval_s=60)
+    watchdog.start()
+    predictor = None
+
+    # frames from every hour and camera are packed into full model.predict batches by a
+    # background thread and the predictions routed back to each camera's file
+    batcher = InferenceBatcher(predict_frames, batch_size=240,
+                               max_latency_s=30, metrics=metrics)
+    batcher.start()
+
     # decompress the images to a dictionary
     # address example: stream0/2011/08/08/mcgr_themis11/ut09/
     # iterate through date folders
@@ -91,10 +132,6 @@ if __name__ == '__main__':
                 comment = f"# File created on {now}\n# This file contains the predictions generated by the model.\n\n"
                 f.write(comment)
                 
-            # init a dataframe to store information
-            df = pd.DataFrame(
-                columns=['date', 'time', 'prediction', 'prediction_str', 'confidence'])
-
             # get the path of each hour
             hours = []
             for hour_name in os.listdir(asi_folder_path):  # /ut09 get hour folders
@@ -110,13 +147,22 @@ if __name__ == '__main__':
                     f'DATE SKIPPED: camera_dict empty, asi_name = {asi_name}, date = {date_folder_path}')
                 continue
 
+            # predictions for this camera day come back from the batcher and are
+            # written to txt_path once all of its frames are predicted
+            batcher.open(txt_path, ClassificationWriter(txt_path, lb.classes_, metrics, asi=asi_name))
+
             # for each hour, decompress, predict, and write into txt
             for hour in sorted(hours)[0:1]:
             
                 logging.info(f'Reading in images at {hour}.')
                 # camera_dict example k-v pair: {'atha20200104000206':img[:,:,:]}
                 camera_dict = {}
-                decompress_pgm_files_to_dict(hour, camera_dict, num_workers=num_workers)
+                with metrics.stage('read', asi=asi_name, hour=hour[-4:]) as record:
+                    decompress_pgm_files_to_dict(hour, camera_dict,
+                                                 num_workers=allocation['workers']['reader'])
+                    record['frames'] = len(camera_dict)
+                    record['bytes'] = sum(os.path.getsize(os.path.join(hour, f)) for f in os.listdir(hour)
+                                          if 'full' in f and not f.startswith('.'))
                 
                 try:
                     if not camera_dict:
@@ -131,18 +177,34 @@ if __name__ == '__main__':
                 # try multiprocessing steps
                 try: 
                     logging.info(f'Images read in. Starting processing via multiprocessing.')
-                    # Create a pool of worker processes
-                    num_workers = num_workers
-                    pool = get_context("spawn").Pool(processes=num_workers)
-                    logging.info(f'Pool generated, num_workers = {num_workers}.')
+                    # Create a pool of workers, processes unless ASI_EXECUTORS picks threads or inline
+                    preprocess_kind = executor_kind('preprocess')
+                    num_workers = allocation['workers']['preprocess'] if preprocess_kind != 'inline' else 1
+                    with metrics.stage('preprocess', asi=asi_name, hour=hour[-4:]) as record:
+                        # start the workers single threaded so they don't each start
+                        # opencv and openmp pools the size of the machine, inline runs
+                        # in this process so it keeps the inference limits
+                        with worker_environment(allocation, 'preprocess'), \
+                             stage_executor('preprocess', num_workers, kind=preprocess_kind,
+                                            mp_context='spawn',
+                                            initializer=init_worker if preprocess_kind != 'inline' else None,
+                                            initargs=(allocation, 'preprocess')) as executor:
+                            logging.info(f'Pool generated, num_workers = {num_workers}.')
 
-                    # Map the process_image function to each item in camera_dict using multiprocessing
-                    results = pool.map(process_image_clahe, camera_dict.items())
-                    
-                    # Close the multiprocessing pool
-                    pool.close()
-                    pool.join()
-                    logging.info('Pool joined.')
+                            # Map the process_image function to each item in camera_dict,
+                            # timing each call to see how busy the workers are
+                            results = list(executor.map(partial(timed_call, process_image_clahe),
+                                                        camera_dict.items(),
+                                                        chunksize=default_chunksize(len(camera_dict),
+                                                                                    num_workers)))
+
+                        # The pool is shut down and joined when the with block ends
+                        logging.info('Pool joined.')
+
+                        # frames still waiting for the model, it falls behind when this grows
+                        record.update(frames=len(results), queue_depth=batcher.pending_frames,
+                                      workers=num_workers, busy_s=sum(r[1] for r in results))
+                        results = [r[0] for r in results]
                     
                     # Assign output to empty lists
                     frames, directory_paths, ymd_strs, time_strs = [], [], [], []
@@ -161,23 +223,16 @@ if __name__ == '__main__':
                     continue
                     
                 try:  
-                    # Convert model input into array
-                    frames = np.array(frames)
-                    preds = model.predict(frames, batch_size=30)
-                    
-                    # Garbage collection to deal with memory leak from model.predict
-                    _ = gc.collect()
-                    
-                    # Write model results into dataframe
-                    prediction_nums = list(map(np.argmax, preds))
-                    confidences = list(map(np.max, preds))
-                    prediction_strs = [lb.classes_[item] for item in prediction_nums]
-                    new_rows = pd.DataFrame({'date': ymd_strs, 'time': time_strs, 'prediction': prediction_nums, 'prediction_str': prediction_strs, 'confidence': confidences}) 
-                    # Close the pool of worker processes
-                    logging.info(f'Model prediction finished.')
-                    # Append the processed rows to the DataFrame
-                    df = pd.concat([df, new_rows], ignore_index=True)
-        
+                    if (predictor is None) and watchdog.growing():
+                        logging.warning(f'Memory growing {watchdog.growth_mb_per_day():.0f} MB/day,'
+                                        ' moving model prediction to a subprocess.')
+                        predictor = IsolatedPredictor(model_file, max_tasks=200)
+                        batcher.predict = partial(predictor.predict, batch_size=30, cut_mask=cut_mask)
+
+                    # Convert model input into array and queue it for prediction with the
+                    # date and time each prediction is written with
+                    batcher.submit(txt_path, np.array(frames), list(zip(ymd_strs, time_strs)))
+                    logging.info(f'Frames queued for model prediction.')
 
                 except Exception as e:
                     logging.CRITICAL(f'Issue with model prediction: {e}.')
@@ -185,11 +240,23 @@ if __name__ == '__main__':
                         f'DATE SKIPPED: asi_name = {asi_name}, date = {date_folder_path}')
                     continue  # if exception, go to next asi camera
 
-            # Write dataframe to csv file
-            df.to_csv(txt_path, mode='a', index=False, header=True)
-                    
-            logging.info(f'Predictions written to file and available at {txt_path}.')
+            # No more frames for this camera day, the batcher writes txt_path once the
+            # rest of them are predicted
+            batcher.finish(txt_path)
         
         
             logging.info(f'date_folder_path={date_folder_path}, asi={asi_name} results generated, time = {datetime.now().strftime("%H:%M:%S")}')
 
+        metrics.unit_done()
+
+    # predict the last partial batch and write the remaining files
+    batcher.close()
+
+    if predictor is not None:
+        predictor.close()
+    watchdog.stop()
+    metrics.close()
+
+    # combine the spans of this process and the pool workers, set ASI_TRACE_DIR to turn tracing on
+    if tracing_enabled():
+        merge_traces(trace_file=f'logs/all_tasks-trace-{datetime.now().strftime("%Y%m%d-%H%M%S")}.json')
@@ -1,13 +1,24 @@
 #from video_generator import *
 from datetime import datetime, timedelta
 import logging
-from tensorflow.keras.models import load_model
+import multiprocessing
 from collections import deque
 import numpy as np
 import pickle
 import cv2
 import os
 import themis_imager_readfile
+import sys
+from pathlib import Path
+
+# Add root to path so src can be imported
+path_root = Path(__file__).parents[2]
+if str(path_root) not in sys.path:
+    sys.path.append(str(path_root))
+
+from src.models.inference_server import InferenceClient, connect_inference_server
+from src.models.memory_watchdog import model_input
+from src.models.tracing import span
 
 # set the folder path for stream0
 stream0_path = 'data/raw/testing/stream0'
@@ -16,8 +27,17 @@ stream0_path = 'data/raw/testing/stream0'
 # load trained model
 model_path = 'models/CNN_model'
 # model_path = 'F:\pa_sample_models\CNN model'
-model = load_model(
-    os.path.join(model_path, 'model', 'CNN_0524.model'))
+model_file = os.path.join(model_path, 'model', 'CNN_0524.model')
+
+# use the inference server if one is running (src/models/inference-server.py),
+# its predict works the same, otherwise import tensorflow and load the model here
+# spawned pool workers import this module too but only preprocess, so they skip the model
+model = None
+if multiprocessing.current_process().name == 'MainProcess':
+    model = connect_inference_server()
+    if model is None:
+        from tensorflow.keras.models import load_model
+        model = load_model(model_file)
 
 # load the binarized class labels
 lb_path = os.path.join(model_path, "model/lb_4c.pickle")
@@ -31,6 +51,17 @@ Q = deque(maxlen=20)
 elev_angle = np.load(os.path.join(model_path, "T_angle.npy"))
 angle = 15
 
+# the workers send uint8 frames, the boundary is cut and the frames converted
+# to float32 where the model runs, see model_input
+cut_mask = elev_angle < angle
+
+def predict_frames(frames, batch_size=30):
+    # the inference server converts the uint8 frames itself, a model loaded
+    # here needs them turned into float32 model inputs first
+    if isinstance(model, InferenceClient):
+        return model.predict(frames, batch_size=batch_size, cut_mask=cut_mask)
+    return model.predict(model_input(frames, cut_mask), batch_size=batch_size)
+
 # get the dates available between start_date and end_date in folder_path that points to stream0 folder
 def get_subfolders_in_range(start_date, end_date, folder_path=stream0_path):
     subfolder_paths = []
@@ -57,7 +88,8 @@ def decompress_pgm_files_to_dict(folder_path, img_dict, num_workers=1):
 
     # read the images using themis_imager_readfile - input is the list of absolute paths to compressed images
     try:
-        img, meta, problematic_files = themis_imager_readfile.read(file_names, workers=num_workers)
+        with span('themis_imager_readfile.read', files=len(file_names)):
+            img, meta, problematic_files = themis_imager_readfile.read(file_names, workers=num_workers)
         frame_num = img.shape[2]
     except Exception as e:
         logging.critical(f'Issue reading in compressed images: {e}.')
@@ -90,10 +122,9 @@ def process_image_clahe(item):
         # process the image using clahe
         clahe = cv2.createCLAHE(clipLimit=3, tileGridSize=(8, 8))
         image = cv2.convertScaleAbs(clahe.apply(value), alpha=(255.0/65535.0))
-        frame = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) # convert the frame to RGB color
-        frame = cv2.resize(frame, (256, 256)).astype("float32") # resize the frame to 256 by 256 to cut the boundary
-        frame[elev_angle < angle] = 0 #cut the boundary
-        frame = cv2.resize(frame, (224, 224)).astype("float32") # resize the frame to 224 by 224 for prediction
+        frame = cv2.resize(image, (256, 256)) # resize the frame to 256 by 256 to cut the boundary
+        # the boundary is cut, the frame resized to 224 by 224 and converted to
+        # RGB float32 for prediction by model_input
         return frame, directory_path, ymd_str, time_str
     except Exception as e:
         logging.critical(f'Issue processing image: {e}.')
@@ -1,12 +1,24 @@
 from astropy.io import fits
 from datetime import datetime, timedelta
 import logging
-from tensorflow.keras.models import load_model
-from collections import deque
+import multiprocessing
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pickle
 import cv2
 import os
+import re
+import sys
+from pathlib import Path
+
+# Add root to path so src can be imported
+path_root = Path(__file__).parents[2]
+if str(path_root) not in sys.path:
+    sys.path.append(str(path_root))
+
+from src.models.inference_server import InferenceClient, connect_inference_server
+from src.models.memory_watchdog import model_input
 
 # set the folder path for stream0
 stream0_path = 'data/raw/example/pfrr'
@@ -15,8 +27,17 @@ stream0_path = 'data/raw/example/pfrr'
 # load trained model
 model_path = 'models/CNN_model'
 # model_path = 'F:\pa_sample_models\CNN model'
-model = load_model(
-    os.path.join(model_path, 'model', 'CNN_0524.model'))
+model_file = os.path.join(model_path, 'model', 'CNN_0524.model')
+
+# use the inference server if one is running (src/models/inference-server.py),
+# its predict works the same, otherwise import tensorflow and load the model here
+# spawned pool workers import this module too but only preprocess, so they skip the model
+model = None
+if multiprocessing.current_process().name == 'MainProcess':
+    model = connect_inference_server()
+    if model is None:
+        from tensorflow.keras.models import load_model
+        model = load_model(model_file)
 
 # load the binarized class labels
 lb_path = os.path.join(model_path, "model/lb_4c.pickle")
@@ -30,6 +51,17 @@ Q = deque(maxlen=20)
 elev_angle = np.load(os.path.join(model_path, "T_angle.npy"))
 angle = 15
 
+# the workers send uint8 frames that are converted to float32 where the model
+# runs, see model_input, the boundary isn't cut for PFRR
+cut_mask = None
+
+def predict_frames(frames, batch_size=30):
+    # the inference server converts the uint8 frames itself, a model loaded
+    # here needs them turned into float32 model inputs first
+    if isinstance(model, InferenceClient):
+        return model.predict(frames, batch_size=batch_size, cut_mask=cut_mask)
+    return model.predict(model_input(frames, cut_mask), batch_size=batch_size)
+
 # get the dates available between start_date and end_date in folder_path that points to stream0 folder
 def get_subfolders_in_range(start_date, end_date, folder_path=stream0_path, wavelength='558'):
     subfolder_paths = []
@@ -43,28 +75,71 @@ def get_subfolders_in_range(start_date, end_date, folder_path=stream0_path, wave
     return subfolder_paths
 
 
-# helper function that decompress one folder
-def decompress_pgm_files_to_dict(file_names, img_dict, num_workers=1):
-    logging.info('Reading in images.')
+# get the frame time from a pfrr filename, e.g. PKR_DASC_0558_20120101_050230.000.FITS
+def get_fits_time(file_name):
+    match = re.search(r'_(\d{8})_(\d{6})', os.path.basename(file_name))
+    return datetime.strptime(match.group(1) + match.group(2), '%Y%m%d%H%M%S')
 
-    # Loop through each image and read into dictionary
-    for file_name in file_names:
 
-        try:
-            fits_file = fits.open(file_name)
-            image = fits_file[0].data.astype('uint16')
-            fits_file.close()
-            dt = datetime(int(file_name[-24:-20]), int(file_name[-20:-18]), int(file_name[-18:-16]),
-                          int(file_name[-15:-13]), int(file_name[-13:-11]), int(file_name[-11:-9]))
+# read one fits image as uint16 using a memory map of the file
+def read_fits_uint16(file_name):
+    with fits.open(file_name, memmap=True, do_not_scale_image_data=True) as fits_file:
+        hdu = fits_file[0]
+        raw = hdu.data
+        bzero = hdu.header.get('BZERO', 0)
+        bscale = hdu.header.get('BSCALE', 1)
+
+        # unsigned 16 bit data is stored as signed with an offset of 32768,
+        # flipping the sign bit of the raw data gives the same values without scaling
+        if raw.dtype.kind == 'i' and raw.dtype.itemsize == 2 and bzero == 32768 and bscale == 1:
+            image = np.bitwise_xor(raw.view(raw.dtype.byteorder + 'u2'), 0x8000, dtype='uint16')
+        elif raw.dtype.kind == 'u' and raw.dtype.itemsize == 2 and bzero == 0 and bscale == 1:
+            image = raw.astype('uint16')
+        else:
+            image = (raw * bscale + bzero).astype('uint16')
 
-            # '20200104000206'
-            dt = dt.strftime('%Y%m%d%H%M%S')
-            key = 'pfrr'+dt
-            img_dict[key] = image
+    return image
 
+
+# read many fits images with a pool of threads, fits reading and copying release the GIL
+def read_fits_frames(file_names, num_workers=1):
+    def _read(file_name):
+        try:
+            return read_fits_uint16(file_name), get_fits_time(file_name), file_name
         except Exception as e:
-            logging.warning(f'Issue reading in image: {e}.')
-            continue
+            logging.warning(f'Issue reading in image {file_name}: {e}.')
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        results = [r for r in executor.map(_read, file_names) if r is not None]
+
+    if not results:
+        return np.empty((0, 0, 0), dtype='uint16'), []
+
+    # skip images that aren't the usual size instead of losing the whole hour when stacking
+    shape = Counter(r[0].shape for r in results).most_common(1)[0][0]
+    for r in results:
+        if r[0].shape != shape:
+            logging.warning(f'Issue reading in image {r[2]}: shape {r[0].shape} instead of {shape}, skipping.')
+    results = [r for r in results if r[0].shape == shape]
+
+    # batched frame stack (frame, row, column) and times in file order
+    frames = np.stack([r[0] for r in results], axis=0)
+    times = [r[1] for r in results]
+
+    return frames, times
+
+
+# helper function that decompress one folder
+def decompress_pgm_files_to_dict(file_names, img_dict, num_workers=1):
+    logging.info('Reading in images.')
+
+    frames, times = read_fits_frames(file_names, num_workers=num_workers)
+
+    for frame, dt in enumerate(times):
+        # '20200104000206'
+        key = 'pfrr'+dt.strftime('%Y%m%d%H%M%S')
+        img_dict[key] = frames[frame]
 
     return
 
@@ -82,10 +157,9 @@ def process_image_clahe(item):
         # process the image using clahe
         clahe = cv2.createCLAHE(clipLimit=300, tileGridSize=(4, 4))
         image = cv2.convertScaleAbs(clahe.apply(value), alpha=(255.0/65535.0))
-        frame = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) # convert the frame to RGB color
-        #frame = cv2.resize(frame, (256, 256)).astype("float32") # resize the frame to 256 by 256 to cut the boundary
-        #frame[elev_angle < angle] = 0 #cut the boundary
-        frame = cv2.resize(frame, (224, 224)).astype("float32") # resize the frame to 224 by 224 for prediction
+        #frame = cv2.resize(image, (256, 256)) # resize the frame to 256 by 256 to cut the boundary
+        frame = cv2.resize(image, (224, 224)) # resize the frame to 224 by 224 for prediction
+        # model_input converts it to RGB float32
         return frame, directory_path, ymd_str, time_str
     except Exception as e:
         logging.critical(f'Issue processing image: {e}.')
@@ -0,0 +1,55 @@
+"""
+Script to benchmark the classification pipeline on synthetic data.
+Writes a synthetic stream0 tree to data/interim/benchmark/, runs every stage
+of all_tasks.py on it with a stand-in model and writes a json report with
+per-stage timings, frames per second and peak memory to reports/.
+Needs no GPU, network, real THEMIS data, or the real model.
+
+Run from the base directory with:
+python3 src/models/benchmark-pipeline.py [NUM_PROCESSES] [mobilenet|small]
+
+Written by Riley Troyer
+science@rileytroyer.com
+"""
+# Import needed libraries
+from datetime import datetime
+import logging
+from multiprocessing import cpu_count
+import os
+from pathlib import Path
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+from src.models.benchmark_functions import run_benchmark
+
+# Important directories
+logs_dir = 'logs/'
+
+# set GPU devices to empty, same as all_tasks.py
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+# Initiate logging
+logging.basicConfig(filename=logs_dir + f'benchmark-pipeline-{datetime.today().date()}.log',
+                    encoding='utf-8',
+                    format='%(asctime)s %(levelname)-8s %(message)s',
+                    level=logging.INFO,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+#------------------------------Initializing done------------------------------
+
+if __name__ == '__main__':
+
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else cpu_count()
+    model_kind = sys.argv[2] if len(sys.argv) > 2 else 'mobilenet'
+
+    report = run_benchmark(workers=workers, model_kind=model_kind,
+                           sites=['atha', 'fsmi'], hours=[6, 7])
+
+    print(f"{report['frames']} frames at {report['end_to_end_frames_per_s']:.1f} frames/s end to end.")
+    for name, seconds in report['seconds'].items():
+        print(f"  {name:18s} {seconds:8.2f} s  {report['frames_per_s'][name]:8.1f} frames/s")
+    for stage, kind in report['fastest_executor'].items():
+        print(f'Fastest executor for {stage}: {kind}, run with ASI_EXECUTORS="{stage}={kind}" to use it.')
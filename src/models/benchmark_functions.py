@@ -0,0 +1,366 @@
+"""
+Functions to benchmark the classification pipeline without real THEMIS
+data or the real model. A generator writes synthetic stream0 trees
+(stream0/YYYY/MM/DD/site_themisNN/utHH/*_full.pgm.gz) with realistic
+frames and headers, and a stand-in model with the same (224, 224, 3) input
+replaces CNN_0524.model. Each stage of all_tasks.py (decode, preprocess,
+IPC, predict, write) is timed separately along with end-to-end frames per
+second and peak memory, and results are written to a json report.
+Preprocessing is timed on every executor backend (inline, thread, process)
+and the fastest is reported.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+import cv2
+from datetime import datetime, timedelta
+import gzip
+import json
+import logging
+import numpy
+import os
+import pandas
+import pickle
+import platform
+import resource
+import time
+
+from src.data.executors import default_chunksize, executor_kind, executor_kinds, make_executor
+from src.models.memory_watchdog import model_input
+
+# Frames in each THEMIS file, one per 3 seconds
+frames_per_file = 20
+
+
+def synthetic_elev_angle(size:int=256) -> numpy.ndarray:
+    """Function to make an elevation angle map like T_angle.npy,
+    90 degrees at the image center falling to 0 at the edge of the field of view.
+    """
+
+    rows, cols = numpy.mgrid[0:size, 0:size]
+    radius = numpy.hypot(rows - (size - 1)/2, cols - (size - 1)/2)/(size/2)
+
+    return (90*(1 - numpy.clip(radius, 0, 1))).astype('float32')
+
+
+def synthetic_frames(n_frames:int, size:int=256, seed:int=0,
+                     start_frame:int=0) -> numpy.ndarray:
+    """Function to make realistic 16-bit all-sky frames: a dark vignetted sky
+    with noise, a drifting auroral arc and patches that pulse on and off.
+    INPUT
+    n_frames - number of frames
+    size - rows and columns of each frame
+    seed - random seed for the noise and patches
+    start_frame - frame number of the first frame, so files continue smoothly
+    OUTPUT
+    frames - uint16 array of shape (frames, size, size)
+    """
+
+    rng = numpy.random.default_rng(seed)
+    rows, cols = numpy.mgrid[0:size, 0:size].astype('float32')/size
+    radius = numpy.hypot(rows - 0.5, cols - 0.5)
+    fov = radius < 0.5
+
+    # Patches that pulse with periods of 2 to 7 frames, about 6 to 20 seconds
+    n_patches = 8
+    centers = rng.uniform(0.25, 0.75, size=(n_patches, 2))
+    periods = rng.uniform(2, 7, size=n_patches)
+    patches = numpy.exp(-((rows[None] - centers[:, 0, None, None])**2
+                          + (cols[None] - centers[:, 1, None, None])**2)/0.003)
+
+    frames = numpy.empty((n_frames, size, size), dtype='uint16')
+    for n in range(n_frames):
+        t = start_frame + n
+        arc_row = 0.3 + 0.2*numpy.sin(t/200)
+        image = 3000 + 1500*numpy.exp(-((rows - arc_row)/0.03)**2)
+        pulsing = (numpy.sin(2*numpy.pi*t/periods) > 0).astype('float32')
+        image += 2000*numpy.tensordot(pulsing, patches, axes=1)
+        image *= numpy.where(fov, 1 - radius, 0.2)
+        image += rng.normal(0, 60, size=(size, size))
+        frames[n] = numpy.clip(image, 0, 65535)
+
+    return frames
+
+
+def write_synthetic_pgm(filename:str, frames:numpy.ndarray, times:list, site:str,
+                        imager:str) -> None:
+    """Function to write frames as a multi-frame 16-bit THEMIS .pgm.gz file,
+    with the same comment keys themis_imager_readfile reads.
+    INPUT
+    filename - file to write
+    frames - uint16 array of shape (frames, rows, columns)
+    times - datetime of each frame
+    site - 4 letter site code, e.g. atha
+    imager - imager code, e.g. themis02
+    """
+
+    with gzip.open(filename, 'wb', compresslevel=6) as f:
+        for frame, frame_time in zip(frames, times):
+            header = ('P5\n'
+                      '#"Image request start" {} UTC\n'
+                      '#"Mode unique ID" full\n'
+                      '#"Site unique ID" {}\n'
+                      '#"Imager unique ID" {}\n'
+                      '#"Exposure time" 1000 ms\n'
+                      '{} {}\n65535\n').format(frame_time.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                                               site, imager, frame.shape[1], frame.shape[0])
+            f.write(header.encode())
+            f.write(frame.astype('>u2').tobytes())
+
+
+def generate_synthetic_stream0(stream0_dir:str, date:datetime, sites:list=['atha'],
+                               hours:list=[6], minutes_per_hour:int=60, size:int=256,
+                               seed:int=0) -> list:
+    """Function to write a synthetic stream0 tree for one day.
+    INPUT
+    stream0_dir - base directory, files go in stream0_dir/YYYY/MM/DD/site_themisNN/utHH/
+    date - day to write
+    sites - 4 letter site codes
+    hours - UT hours to write
+    minutes_per_hour - one file per minute, 60 is a full hour
+    size - rows and columns of each frame
+    seed - random seed
+    OUTPUT
+    hour_dirs - list of the hour directories written
+    """
+
+    hour_dirs = []
+
+    for n_site, site in enumerate(sites):
+        imager = 'themis{:02d}'.format(n_site + 1)
+
+        for hour in hours:
+            hour_dir = os.path.join(stream0_dir, date.strftime('%Y/%m/%d'),
+                                    '{}_{}'.format(site, imager), 'ut{:02d}'.format(hour))
+            if not os.path.exists(hour_dir):
+                os.makedirs(hour_dir)
+
+            for minute in range(minutes_per_hour):
+                start = datetime(date.year, date.month, date.day, hour, minute)
+                times = [start + timedelta(seconds=3*n, microseconds=53611)
+                         for n in range(frames_per_file)]
+                frames = synthetic_frames(frames_per_file, size=size, seed=seed + n_site,
+                                          start_frame=(hour*60 + minute)*frames_per_file)
+
+                filename = '{}_{:02d}{:02d}_{}_{}_full.pgm.gz'.format(start.strftime('%Y%m%d'), hour,
+                                                                   minute, site, imager)
+                write_synthetic_pgm(os.path.join(hour_dir, filename), frames, times, site, imager)
+
+            hour_dirs.append(hour_dir)
+
+    logging.info('Wrote {} synthetic hours to {}.'.format(len(hour_dirs), stream0_dir))
+
+    return hour_dirs
+
+
+def make_standin_model(kind:str='mobilenet', n_classes:int=4):
+    """Function to make an untrained model with the same input and output as CNN_0524.model.
+    INPUT
+    kind - mobilenet for a realistic amount of compute, small for a quick test
+    n_classes - number of output classes
+    OUTPUT
+    model - keras model taking (224, 224, 3) float32 frames
+    """
+
+    # Only the predict stage needs tensorflow, so pool workers don't import it
+    import tensorflow as tf
+
+    if kind == 'mobilenet':
+        return tf.keras.applications.MobileNetV2(input_shape=(224, 224, 3), weights=None,
+                                                 classes=n_classes)
+
+    return tf.keras.Sequential([tf.keras.Input(shape=(224, 224, 3)),
+                                tf.keras.layers.Conv2D(16, 3, strides=2, activation='relu'),
+                                tf.keras.layers.Conv2D(32, 3, strides=2, activation='relu'),
+                                tf.keras.layers.GlobalAveragePooling2D(),
+                                tf.keras.layers.Dense(n_classes, activation='softmax')])
+
+
+# Elevation map used by the preprocessing, set per process
+_elev_angle = synthetic_elev_angle()
+
+
+def preprocess_frame(item:tuple) -> numpy.ndarray:
+    """Function to preprocess one frame the same way as process_image_clahe
+    in all_tasks_func.py, which can't be imported without loading the real model.
+    """
+
+    key, value = item
+
+    clahe = cv2.createCLAHE(clipLimit=3, tileGridSize=(8, 8))
+    image = cv2.convertScaleAbs(clahe.apply(value), alpha=(255.0/65535.0))
+
+    return cv2.resize(image, (256, 256))
+
+
+def _peak_rss_mb() -> dict:
+    """Function to get the peak resident memory of this process and its children in MB."""
+
+    # ru_maxrss is in kB on Linux
+    return {'self':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+            'children':resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024}
+
+
+def benchmark_hour(hour_dir:str, model, workers:int=4, reader_workers:int=None,
+                   batch_size:int=30, output_file:str=None) -> dict:
+    """Function to time each stage of classifying one hour like all_tasks.py.
+    INPUT
+    hour_dir - utHH directory of .pgm.gz files
+    model - keras model, see make_standin_model
+    workers - threads or processes for the preprocessing pool
+    reader_workers - workers for themis_imager_readfile, defaults to workers
+    batch_size - model.predict batch size
+    output_file - classification text file to write, a temporary file if None
+    OUTPUT
+    results - dictionary with frames, bytes, and seconds for each stage
+    """
+
+    import themis_imager_readfile
+
+    reader_workers = workers if reader_workers is None else reader_workers
+    file_names = sorted(os.path.join(hour_dir, f) for f in os.listdir(hour_dir)
+                        if 'full' in f and not f.startswith('.'))
+    stages = {}
+
+    # Decode
+    start_time = time.perf_counter()
+    img, meta, problematic_files = themis_imager_readfile.read(file_names, workers=reader_workers)
+    camera_dict = {}
+    for frame in range(img.shape[2]):
+        dt = datetime.strptime(meta[frame]['Image request start'], '%Y-%m-%d %H:%M:%S.%f %Z')
+        camera_dict[meta[frame]['Site unique ID'] + dt.strftime('%Y%m%d%H%M%S')] = img[:, :, frame]
+    stages['decode'] = time.perf_counter() - start_time
+
+    items = list(camera_dict.items())
+    n_frames = len(items)
+
+    # Preprocess on each executor backend, inline separates the work from the pool overhead
+    for kind in executor_kinds:
+        start_time = time.perf_counter()
+        with make_executor(kind, workers, mp_context='spawn') as executor:
+            frames = list(executor.map(preprocess_frame, items,
+                                       chunksize=default_chunksize(n_frames, workers)))
+        stages['preprocess_' + kind] = time.perf_counter() - start_time
+
+    # IPC, the pickling the pool does to send frames out and get results back
+    start_time = time.perf_counter()
+    pickle.loads(pickle.dumps(items, protocol=pickle.HIGHEST_PROTOCOL))
+    pickle.loads(pickle.dumps(frames, protocol=pickle.HIGHEST_PROTOCOL))
+    stages['ipc'] = time.perf_counter() - start_time
+
+    # Predict
+    start_time = time.perf_counter()
+    preds = model.predict(model_input(numpy.array(frames), _elev_angle < 15),
+                          batch_size=batch_size, verbose=0)
+    stages['predict'] = time.perf_counter() - start_time
+
+    # Write
+    start_time = time.perf_counter()
+    times = [datetime.strptime(k[4:], '%Y%m%d%H%M%S') for k, v in items]
+    df = pandas.DataFrame({'date':[t.strftime('%Y%m%d') for t in times],
+                           'time':[t.strftime('%H:%M:%S') for t in times],
+                           'prediction':preds.argmax(axis=1),
+                           'prediction_str':preds.argmax(axis=1).astype(str),
+                           'confidence':preds.max(axis=1)})
+    output_file = os.path.join(hour_dir, 'benchmark_classifications.txt') if output_file is None else output_file
+    df.to_csv(output_file, index=False, header=True)
+    stages['write'] = time.perf_counter() - start_time
+    if output_file.startswith(hour_dir):
+        os.remove(output_file)
+
+    # End to end is the pipeline as all_tasks.py runs it with the configured preprocess
+    # backend, a process pool's time already includes its pickling so ipc is left out
+    end_to_end = sum(stages[name] for name in ['decode', 'preprocess_' + executor_kind('preprocess'),
+                                               'predict', 'write'])
+
+    return {'hour_dir':hour_dir,
+            'frames':n_frames,
+            'compressed_bytes':sum(os.path.getsize(f) for f in file_names),
+            'raw_bytes':int(img.nbytes),
+            'seconds':stages,
+            'frames_per_s':{name:n_frames/max(t, 1e-9) for name, t in stages.items()},
+            'end_to_end_s':end_to_end,
+            'end_to_end_frames_per_s':n_frames/max(end_to_end, 1e-9)}
+
+
+def fastest_executors(seconds:dict) -> dict:
+    """Function to get the fastest backend of each stage timed on several,
+    from {stage}_{kind} entries like preprocess_thread.
+    """
+
+    fastest = {}
+    for name, t in seconds.items():
+        stage, _, kind = name.rpartition('_')
+        if (kind in executor_kinds) and ((stage not in fastest) or (t < seconds[stage + '_' + fastest[stage]])):
+            fastest[stage] = kind
+
+    return fastest
+
+
+def run_benchmark(work_dir:str='data/interim/benchmark/', report_file:str=None,
+                  sites:list=['atha'], hours:list=[6], minutes_per_hour:int=60,
+                  workers:int=4, model_kind:str='mobilenet', batch_size:int=30) -> dict:
+    """Function to run the full benchmark: generate data, time every hour and write a report.
+    INPUT
+    work_dir - where to write the synthetic stream0 tree
+    report_file - json report file, defaults to reports/benchmark-{time}.json
+    sites, hours, minutes_per_hour - size of the synthetic data, see generate_synthetic_stream0
+    workers - processes for decoding and preprocessing
+    model_kind - stand-in model, see make_standin_model
+    batch_size - model.predict batch size
+    OUTPUT
+    report - dictionary with the settings, machine, per hour results and totals
+    """
+
+    if report_file is None:
+        report_file = 'reports/benchmark-{}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S'))
+
+    stream0_dir = os.path.join(work_dir, 'stream0')
+    start_time = time.perf_counter()
+    hour_dirs = generate_synthetic_stream0(stream0_dir, datetime(2020, 1, 4), sites=sites,
+                                           hours=hours, minutes_per_hour=minutes_per_hour)
+    generate_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    model = make_standin_model(model_kind)
+    model_time = time.perf_counter() - start_time
+
+    results = [benchmark_hour(hour_dir, model, workers=workers, batch_size=batch_size)
+               for hour_dir in hour_dirs]
+
+    n_frames = sum(r['frames'] for r in results)
+    stage_totals = {name:sum(r['seconds'][name] for r in results) for name in results[0]['seconds']}
+    end_to_end = sum(r['end_to_end_s'] for r in results)
+
+    report = {'created':datetime.now().isoformat(),
+              'machine':{'platform':platform.platform(), 'processor':platform.processor(),
+                         'cpu_count':os.cpu_count(), 'python':platform.python_version()},
+              'settings':{'sites':sites, 'hours':hours, 'minutes_per_hour':minutes_per_hour,
+                          'workers':workers, 'model_kind':model_kind, 'batch_size':batch_size},
+              'generate_s':generate_time,
+              'model_load_s':model_time,
+              'frames':n_frames,
+              'seconds':stage_totals,
+              'frames_per_s':{name:n_frames/max(t, 1e-9) for name, t in stage_totals.items()},
+              'fastest_executor':fastest_executors(stage_totals),
+              'end_to_end_s':end_to_end,
+              'end_to_end_frames_per_s':n_frames/max(end_to_end, 1e-9),
+              'peak_rss_mb':_peak_rss_mb(),
+              'hours':results}
+
+    report_dir = os.path.dirname(report_file)
+    if (report_dir != '') and (not os.path.exists(report_dir)):
+        os.makedirs(report_dir)
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    for stage, kind in report['fastest_executor'].items():
+        logging.info('Fastest executor for {} is {}, set ASI_EXECUTORS="{}={}" to use it.'.format(
+            stage, kind, stage, kind))
+
+    logging.info('Benchmark of {} frames at {:.1f} frames/s written to {}.'.format(n_frames,
+                                                                                  report['end_to_end_frames_per_s'],
+                                                                                  report_file))
+
+    return report
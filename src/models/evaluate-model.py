@@ -0,0 +1,69 @@
+"""
+Script to score model classifications against the human labels.
+Compares every classification file below a directory with the label
+catalog and writes a json report with confusion matrices, per-station and
+per-confidence accuracy, and event-level scores to reports/.
+
+Run from the base directory with:
+python3 src/models/evaluate-model.py data/processed/ml-classifications/ [all]
+By default only the labels in final-test-classifications.xlsx are used,
+add all to use every labeled batch.
+
+Written by Riley Troyer
+science@rileytroyer.com
+"""
+# Import needed libraries
+from datetime import datetime
+import logging
+import os
+from pathlib import Path
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+from src.data.h5_reader import read_catalog
+from src.data.label_catalog import (get_label_catalog, label_codes, resolve_frame_times,
+                                    select_labels)
+from src.models.evaluation_functions import evaluate_directory
+
+# Important directories
+logs_dir = 'logs/'
+reports_dir = 'reports/'
+classification_dir = 'docs/classifications/'
+
+# Frame times of the test days, needed for labels that only give frame numbers
+h5_catalog_file = 'data/interim/testing/themis/catalog.h5'
+
+# Initiate logging
+logging.basicConfig(filename=logs_dir + f'evaluate-model-{datetime.today().date()}.log',
+                    encoding='utf-8',
+                    format='%(asctime)s %(levelname)-8s %(message)s',
+                    level=logging.INFO,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+#------------------------------Initializing done------------------------------
+
+if __name__ == '__main__':
+
+    predictions_dir = sys.argv[1]
+    use_all = (len(sys.argv) > 2) and (sys.argv[2] == 'all')
+
+    catalog = get_label_catalog(classification_dir)
+    if not use_all:
+        catalog = select_labels(catalog, catalog['source'] == b'themis/final-test-classifications.xlsx')
+
+    if os.path.exists(h5_catalog_file):
+        catalog = resolve_frame_times(catalog, read_catalog(h5_catalog_file))
+    else:
+        logging.warning(f'No h5 catalog at {h5_catalog_file}, labels with only frame numbers are skipped.')
+
+    # Model classes, prediction_str in the classification files uses the same names
+    classes = sorted(set(label_codes.values()))
+
+    report_file = os.path.join(reports_dir, f'evaluation-{datetime.now():%Y%m%d-%H%M%S}.json')
+    report = evaluate_directory(predictions_dir, catalog, classes, report_file=report_file)
+
+    print(f"Accuracy {report['overall']['accuracy']:.3f} on {report['labeled_frames']} labeled frames."
+          f" Report written to {report_file}")
@@ -0,0 +1,301 @@
+"""
+Functions to score model classifications against the human labels.
+Classification files written by all_tasks.py are read one station-day at
+a time and joined to the label catalog with a sorted time merge, so no
+per-frame python loops are needed and millions of frames take seconds.
+Results are accumulated into confusion matrices, per-station and
+per-confidence accuracy, and event-level scores for each labeled interval.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+import h5py
+import json
+import logging
+import numpy
+import os
+import pandas
+
+from src.data.label_catalog import lookup_labels
+
+# Model confidence bins for the accuracy by confidence
+confidence_bins = [0, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+
+
+def find_classification_files(classification_dir:str) -> list:
+    """Function to find all classification files below a directory, e.g.
+    data/processed/ml-classifications/2020/1/4/20200104_atha_themis02_classifications.txt
+    Text files from all_tasks.py and h5 files with the same columns are both used.
+    """
+
+    files = []
+    for root, dirs, names in os.walk(classification_dir):
+        files.extend(os.path.join(root, f) for f in names
+                     if f.endswith('_classifications.txt') or f.endswith('_classifications.h5'))
+
+    return sorted(files)
+
+
+def classification_station(classification_file:str) -> str:
+    """Function to get the station from a classification filename,
+    e.g. 20200104_atha_themis02_classifications.txt is atha.
+    """
+
+    return os.path.basename(classification_file).split('_')[1][0:4]
+
+
+def read_classification_file(classification_file:str) -> dict:
+    """Function to read a classification file into columns sorted by time.
+    INPUT
+    classification_file - text file from all_tasks.py, or an h5 file with
+                          epoch_us, prediction_str and confidence datasets
+    OUTPUT
+    classifications - dictionary with epoch_us (int64), prediction_str (S)
+                      and confidence (float32) arrays
+    """
+
+    if classification_file.endswith('.h5'):
+        with h5py.File(classification_file, 'r') as h5f:
+            classifications = {'epoch_us':h5f['epoch_us'][:].astype('int64'),
+                               'prediction_str':h5f['prediction_str'][:].astype('S'),
+                               'confidence':h5f['confidence'][:].astype('float32')}
+
+    else:
+        df = pandas.read_csv(classification_file, comment='#',
+                             usecols=['date', 'time', 'prediction_str', 'confidence'],
+                             dtype={'date':str, 'time':str, 'prediction_str':str,
+                                    'confidence':'float32'})
+        times = pandas.to_datetime(df['date'] + ' ' + df['time'], format='%Y%m%d %H:%M:%S')
+
+        classifications = {'epoch_us':times.to_numpy().astype('datetime64[us]').astype('int64'),
+                           'prediction_str':df['prediction_str'].to_numpy(dtype='S'),
+                           'confidence':df['confidence'].to_numpy()}
+
+    order = numpy.argsort(classifications['epoch_us'], kind='stable')
+
+    return {name:data[order] for name, data in classifications.items()}
+
+
+def new_evaluation(classes:list) -> dict:
+    """Function to create empty evaluation counts for a list of classes."""
+
+    n = len(classes)
+
+    return {'classes':list(classes),
+            'frames':0,
+            'labeled_frames':0,
+            'unmapped_frames':0,
+            'confusion':numpy.zeros((n, n), dtype='int64'),
+            'stations':{},
+            'label_confidence':{},
+            'model_confidence':numpy.zeros((len(confidence_bins) - 1, 2), dtype='int64'),
+            'label_events':numpy.zeros((n, 2), dtype='int64'),
+            'predicted_events':numpy.zeros((n, 2), dtype='int64')}
+
+
+def _confusion(true:numpy.ndarray, pred:numpy.ndarray, n:int) -> numpy.ndarray:
+    """Function to count a confusion matrix, rows are true classes and columns predictions."""
+
+    return numpy.bincount(true*n + pred, minlength=n*n).reshape(n, n)
+
+
+def _runs(values:numpy.ndarray, epoch_us:numpy.ndarray, max_gap_us:int) -> numpy.ndarray:
+    """Function to number runs of equal consecutive values, a gap in time also starts a new run."""
+
+    new_run = numpy.ones(len(values), dtype=bool)
+    new_run[1:] = (values[1:] != values[:-1]) | (numpy.diff(epoch_us) > max_gap_us)
+
+    return numpy.cumsum(new_run) - 1
+
+
+def evaluate_classifications(evaluation:dict, classifications:dict, catalog:dict, station:str,
+                             class_map:dict=None, min_event_frames:int=10,
+                             max_gap_s:float=60) -> dict:
+    """Function to add one station-day of classifications to an evaluation.
+    INPUT
+    evaluation - counts to add to, see new_evaluation
+    classifications - see read_classification_file
+    catalog - label catalog, see get_label_catalog and resolve_frame_times
+    station - station of the classifications
+    class_map - dictionary from model prediction_str to catalog class, if they differ
+    min_event_frames - shortest run of predictions counted as a predicted event
+    max_gap_s - longest time between frames within one predicted event
+    OUTPUT
+    evaluation - the updated evaluation
+    """
+
+    classes = evaluation['classes']
+    n = len(classes)
+    class_lookup = {c.encode():m for m, c in enumerate(classes)}
+    if class_map is not None:
+        class_lookup.update({k.encode():class_lookup[v.encode()] for k, v in class_map.items()})
+
+    epoch_us = classifications['epoch_us']
+    evaluation['frames'] += len(epoch_us)
+
+    # Model predictions as class positions, -1 if not one of classes
+    pred_names, pred_inverse = numpy.unique(classifications['prediction_str'], return_inverse=True)
+    pred = numpy.array([class_lookup.get(p, -1) for p in pred_names], dtype='int64')[pred_inverse]
+    evaluation['unmapped_frames'] += int((pred < 0).sum())
+
+    # Sorted time merge with the labels
+    rows = lookup_labels(catalog, station, epoch_us)
+    catalog_class = numpy.array([class_lookup.get(l, -1) for l in catalog['label']], dtype='int64')
+    true = numpy.full(len(epoch_us), -1, dtype='int64')
+    true[rows >= 0] = catalog_class[rows[rows >= 0]]
+
+    use = (true >= 0) & (pred >= 0)
+    evaluation['labeled_frames'] += int(use.sum())
+    if not use.any():
+        return evaluation
+
+    confusion = _confusion(true[use], pred[use], n)
+    evaluation['confusion'] += confusion
+
+    if station not in evaluation['stations']:
+        evaluation['stations'][station] = numpy.zeros((n, n), dtype='int64')
+    evaluation['stations'][station] += confusion
+
+    # Accuracy by human confidence, labels without one are grouped as none
+    label_confidence = catalog['confidence'][rows[use]]
+    groups = {str(int(value)):label_confidence == value
+              for value in numpy.unique(label_confidence[~numpy.isnan(label_confidence)])}
+    groups['none'] = numpy.isnan(label_confidence)
+
+    for key, same in groups.items():
+        if not same.any():
+            continue
+        if key not in evaluation['label_confidence']:
+            evaluation['label_confidence'][key] = numpy.zeros((n, n), dtype='int64')
+        evaluation['label_confidence'][key] += _confusion(true[use][same], pred[use][same], n)
+
+    # Accuracy by model confidence
+    correct = true[use] == pred[use]
+    bins = numpy.clip(numpy.digitize(classifications['confidence'][use], confidence_bins) - 1,
+                      0, len(confidence_bins) - 2)
+    evaluation['model_confidence'][:, 0] += numpy.bincount(bins, weights=correct,
+                                                           minlength=len(confidence_bins) - 1).astype('int64')
+    evaluation['model_confidence'][:, 1] += numpy.bincount(bins, minlength=len(confidence_bins) - 1)
+
+    # Label events, each labeled interval is correct if most of its frames are
+    event_rows, event_index = numpy.unique(rows[use], return_inverse=True)
+    votes = numpy.bincount(event_index*n + pred[use], minlength=len(event_rows)*n).reshape(-1, n)
+    event_true = true[use][numpy.unique(event_index, return_index=True)[1]]
+    event_correct = votes.argmax(axis=1) == event_true
+    evaluation['label_events'][:, 0] += numpy.bincount(event_true, weights=event_correct,
+                                                       minlength=n).astype('int64')
+    evaluation['label_events'][:, 1] += numpy.bincount(event_true, minlength=n)
+
+    # Predicted events, runs of the same prediction are correct if most of
+    # their labeled frames have that label
+    run = _runs(pred, epoch_us, int(max_gap_s*1e6))
+    run_length = numpy.bincount(run)
+    run_pred = pred[numpy.unique(run, return_index=True)[1]]
+
+    run_votes = numpy.bincount(run[use]*n + true[use], minlength=len(run_length)*n).reshape(-1, n)
+    counted = (run_length >= min_event_frames) & (run_votes.sum(axis=1) > 0) & (run_pred >= 0)
+    run_correct = run_votes.argmax(axis=1) == run_pred
+
+    evaluation['predicted_events'][:, 0] += numpy.bincount(run_pred[counted],
+                                                           weights=run_correct[counted],
+                                                           minlength=n).astype('int64')
+    evaluation['predicted_events'][:, 1] += numpy.bincount(run_pred[counted], minlength=n)
+
+    return evaluation
+
+
+def _scores(confusion:numpy.ndarray, classes:list) -> dict:
+    """Function to get accuracy and per class precision, recall and f1 from a confusion matrix."""
+
+    total = confusion.sum()
+    true_positive = numpy.diag(confusion)
+    precision = true_positive/numpy.maximum(confusion.sum(axis=0), 1)
+    recall = true_positive/numpy.maximum(confusion.sum(axis=1), 1)
+    f1 = 2*precision*recall/numpy.maximum(precision + recall, 1e-12)
+
+    return {'frames':int(total),
+            'accuracy':float(true_positive.sum()/max(total, 1)),
+            'confusion':confusion.tolist(),
+            'per_class':{c:{'precision':float(precision[m]), 'recall':float(recall[m]),
+                            'f1':float(f1[m]), 'frames':int(confusion[m].sum())}
+                         for m, c in enumerate(classes)}}
+
+
+def summarize_evaluation(evaluation:dict) -> dict:
+    """Function to turn evaluation counts into a json serializable report."""
+
+    classes = evaluation['classes']
+    report = {'classes':classes,
+              'frames':evaluation['frames'],
+              'labeled_frames':evaluation['labeled_frames'],
+              'unmapped_frames':evaluation['unmapped_frames'],
+              'overall':_scores(evaluation['confusion'], classes)}
+
+    report['stations'] = {s:_scores(c, classes) for s, c in sorted(evaluation['stations'].items())}
+    report['label_confidence'] = {k:_scores(c, classes)
+                                  for k, c in sorted(evaluation['label_confidence'].items())}
+
+    report['model_confidence'] = [{'min':confidence_bins[m], 'max':confidence_bins[m + 1],
+                                   'frames':int(total),
+                                   'accuracy':float(correct/max(total, 1))}
+                                  for m, (correct, total) in enumerate(evaluation['model_confidence'])]
+
+    for name in ['label_events', 'predicted_events']:
+        correct, total = evaluation[name][:, 0], evaluation[name][:, 1]
+        report[name] = {'events':int(total.sum()),
+                        'accuracy':float(correct.sum()/max(total.sum(), 1)),
+                        'per_class':{c:{'events':int(total[m]),
+                                        'accuracy':float(correct[m]/max(total[m], 1))}
+                                     for m, c in enumerate(classes)}}
+
+    return report
+
+
+def evaluate_directory(classification_dir:str, catalog:dict, classes:list,
+                       class_map:dict=None, stations:list=None, report_file:str=None,
+                       **kwargs) -> dict:
+    """Function to evaluate every classification file in a directory against the labels.
+    INPUT
+    classification_dir - base directory of the classification files
+    catalog - label catalog, see get_label_catalog and resolve_frame_times
+    classes - class names to score
+    class_map - dictionary from model prediction_str to catalog class, if they differ
+    stations - only evaluate these stations
+    report_file - json file to write the report to
+    kwargs - passed to evaluate_classifications
+    OUTPUT
+    report - see summarize_evaluation
+    """
+
+    evaluation = new_evaluation(classes)
+    labeled_stations = set(s.decode() for s in numpy.unique(catalog['station']))
+
+    for classification_file in find_classification_files(classification_dir):
+        station = classification_station(classification_file)
+        if (station not in labeled_stations) or ((stations is not None) and (station not in stations)):
+            continue
+
+        try:
+            classifications = read_classification_file(classification_file)
+        except Exception as e:
+            logging.warning('Unable to read {}, skipping. {}'.format(classification_file, e))
+            continue
+
+        evaluate_classifications(evaluation, classifications, catalog, station,
+                                 class_map=class_map, **kwargs)
+
+    report = summarize_evaluation(evaluation)
+
+    logging.info('Evaluated {} labeled of {} frames, accuracy {:.3f}.'.format(report['labeled_frames'],
+                                                                            report['frames'],
+                                                                            report['overall']['accuracy']))
+
+    if report_file is not None:
+        report_dir = os.path.dirname(report_file)
+        if (report_dir != '') and (not os.path.exists(report_dir)):
+            os.makedirs(report_dir)
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    return report
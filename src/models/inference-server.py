@@ -0,0 +1,82 @@
+"""
+Script to run, check or stop the local inference server. While it runs,
+all_tasks.py, all_tasks_pfrr.py and notebooks send their frames to it
+instead of loading the model themselves, see inference_server.py.
+
+Run from the base directory with:
+python3 src/models/inference-server.py [start|status|stop] [MODEL_FILE]
+
+The socket defaults to $XDG_RUNTIME_DIR/asi-inference.sock, or
+/tmp/asi-inference-{uid}/asi-inference.sock, set ASI_INFERENCE_SOCKET to use
+another one. Clients need the key the server writes next to it in a .key file.
+
+Written by Riley Troyer
+science@rileytroyer.com
+"""
+# Import needed libraries
+from datetime import datetime
+import logging
+import os
+from pathlib import Path
+import signal
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+from src.models.inference_server import (InferenceServer, connect_inference_server,
+                                         default_socket)
+
+# Important directories
+logs_dir = 'logs/'
+model_file = 'models/CNN_model/model/CNN_0524.model'
+
+# set GPU devices to empty, same as all_tasks.py
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+# Initiate logging
+logging.basicConfig(filename=logs_dir + f'inference-server-{datetime.today().date()}.log',
+                    encoding='utf-8',
+                    format='%(asctime)s %(levelname)-8s %(message)s',
+                    level=logging.INFO,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+#------------------------------Initializing done------------------------------
+
+if __name__ == '__main__':
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'start'
+    if len(sys.argv) > 2:
+        model_file = sys.argv[2]
+
+    if command == 'start':
+        server = InferenceServer(model_file)
+
+        # Stop cleanly and remove the socket on kill or Ctrl-C
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+        signal.signal(signal.SIGINT, lambda signum, frame: server.shutdown())
+
+        print(f'Inference server {os.getpid()} serving {model_file} on {default_socket}.')
+        server.serve_forever()
+
+    elif command in ['status', 'stop']:
+        client = connect_inference_server()
+        if client is None:
+            print(f'No inference server running on {default_socket}.')
+            sys.exit(1)
+
+        status = client.status()
+        print(f"Inference server {status['pid']} serving {status['model_file']} for "
+              f"{status['uptime_s']/3600:.1f} h, {status['requests']} requests, "
+              f"{status['frames']} frames, {status['rss_bytes']/2**20:.0f} MB.")
+
+        if command == 'stop':
+            client.shutdown()
+            print('Stopped.')
+        else:
+            client.close()
+
+    else:
+        print('Usage: python3 src/models/inference-server.py [start|status|stop] [MODEL_FILE]')
+        sys.exit(1)
@@ -0,0 +1,295 @@
+"""
+Functions and classes to keep model.predict batches full across cameras
+and hours. Producers submit the preprocessed frames of a camera day as
+they come, a background thread packs them into fixed size batches, runs
+the model, and routes each prediction back to the writer of the camera
+day it came from. A batch that isn't full is predicted anyway once its
+oldest frame has waited max_latency_s, and a camera day's writer is
+called to write once all of its frames are predicted.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+from collections import deque
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+class InferenceBatcher(threading.Thread):
+    """Packs frames from many producers into full prediction batches.
+
+    batcher = InferenceBatcher(partial(model.predict, batch_size=30), batch_size=240)
+    batcher.start()
+    batcher.open(txt_path, ClassificationWriter(txt_path, lb.classes_))
+    batcher.submit(txt_path, frames, items)
+    batcher.finish(txt_path)
+    batcher.close()
+    """
+
+    def __init__(self, predict, batch_size:int=240, max_latency_s:float=30,
+                 max_pending:int=None, metrics=None):
+        """
+        INPUT
+        predict - function taking an array of frames and returning one prediction per frame,
+                  can be replaced while running, e.g. with an IsolatedPredictor
+        batch_size - frames per prediction batch, a multiple of the model.predict batch size
+                     keeps its steps full
+        max_latency_s - predict a partial batch once its oldest frame has waited this long
+        max_pending - submit waits while more than this many frames are queued,
+                      defaults to 4 batches
+        metrics - RunMetrics to record each batch as a predict stage, or None
+        """
+
+        super().__init__(name='inference-batcher', daemon=True)
+
+        self.predict = predict
+        self.batch_size = batch_size
+        self.max_latency_s = max_latency_s
+        self.max_pending = 4*batch_size if max_pending is None else max_pending
+        self.metrics = metrics
+
+        # Queued chunks of [key, frames, items, submit time], split when a batch ends mid chunk
+        self._pending = deque()
+        self._pending_frames = 0
+
+        # Writers, frames not yet routed back and finished keys
+        self._sinks = {}
+        self._outstanding = {}
+        self._finished = set()
+
+        self._cond = threading.Condition()
+        self._closing = False
+
+        self.batches = 0
+        self.frames = 0
+        self.failed_frames = 0
+
+    @property
+    def pending_frames(self) -> int:
+        """Frames submitted but not yet taken into a prediction batch."""
+
+        with self._cond:
+            return self._pending_frames
+
+    def open(self, key, sink) -> None:
+        """Function to register the writer predictions for key are routed to.
+        INPUT
+        key - identifies the producer, e.g. the output file of a camera day
+        sink - object with add(key, items, preds) called for each routed chunk and
+               write(key) called once all submitted frames of key are predicted
+        """
+
+        with self._cond:
+            self._sinks[key] = sink
+            self._outstanding[key] = 0
+
+    def submit(self, key, frames:np.ndarray, items:list) -> None:
+        """Function to queue frames for prediction, waits while the queue is full.
+        INPUT
+        key - producer the frames belong to, opened before
+        frames - array of frames passed to predict, e.g. uint8 frames or model inputs
+        items - one entry per frame given back with its prediction, e.g. (date, time)
+        """
+
+        if len(frames) == 0:
+            return
+
+        with self._cond:
+            while (self._pending_frames >= self.max_pending) and self.is_alive():
+                self._cond.wait(1)
+
+            self._pending.append([key, frames, items, time.monotonic()])
+            self._pending_frames += len(frames)
+            self._outstanding[key] += len(frames)
+            self._cond.notify_all()
+
+    def finish(self, key) -> None:
+        """Function to mark that key won't submit more, its writer writes once the rest is predicted."""
+
+        with self._cond:
+            self._finished.add(key)
+            self._cond.notify_all()
+
+    def _batch_ready(self) -> bool:
+        if self._pending_frames >= self.batch_size:
+            return True
+
+        if self._pending_frames > 0:
+            return (self._closing
+                    or (time.monotonic() - self._pending[0][3] >= self.max_latency_s))
+
+        return False
+
+    def _take_batch(self) -> list:
+        """Function to take up to batch_size frames off the queue, as (key, frames, items) chunks."""
+
+        chunks = []
+        n_frames = 0
+
+        while self._pending and (n_frames < self.batch_size):
+            key, frames, items, submit_time = self._pending[0]
+            n_take = min(len(frames), self.batch_size - n_frames)
+
+            if n_take == len(frames):
+                self._pending.popleft()
+            else:
+                self._pending[0] = [key, frames[n_take:], items[n_take:], submit_time]
+
+            chunks.append((key, frames[:n_take], items[:n_take]))
+            n_frames = n_frames + n_take
+
+        self._pending_frames -= n_frames
+        self._cond.notify_all()
+
+        return chunks
+
+    def _predict_batch(self, chunks:list) -> None:
+        """Function to predict one batch and route the predictions to the writers."""
+
+        frames = np.concatenate([c[1] for c in chunks], axis=0)
+        keys = set(c[0] for c in chunks)
+
+        try:
+            if self.metrics is None:
+                preds = self.predict(frames)
+            else:
+                with self.metrics.stage('predict') as record:
+                    preds = self.predict(frames)
+                    record.update(frames=len(frames), bytes=frames.nbytes, producers=len(keys),
+                                  batch_fill=len(frames)/self.batch_size,
+                                  queue_depth=self.pending_frames)
+        except Exception as e:
+            logging.critical('Issue with model prediction of {} frames from {}: {}.'.format(
+                len(frames), sorted(str(k) for k in keys), e))
+            preds = None
+            self.failed_frames += len(frames)
+
+        self.batches += 1
+        self.frames += len(frames)
+
+        first = 0
+        for key, chunk_frames, items in chunks:
+            n_frames = len(chunk_frames)
+            if preds is not None:
+                try:
+                    self._sinks[key].add(key, items, preds[first:first + n_frames])
+                except Exception as e:
+                    logging.critical('Issue writing predictions for {}: {}.'.format(key, e))
+            first = first + n_frames
+
+            with self._cond:
+                self._outstanding[key] -= n_frames
+
+    def _write_finished(self) -> None:
+        """Function to call write for finished keys with nothing left to predict."""
+
+        with self._cond:
+            done = [k for k in self._finished if self._outstanding.get(k, 0) == 0]
+            for key in done:
+                self._finished.discard(key)
+                self._outstanding.pop(key, None)
+
+            sinks = [(key, self._sinks.pop(key)) for key in done if key in self._sinks]
+
+        for key, sink in sinks:
+            try:
+                sink.write(key)
+            except Exception as e:
+                logging.critical('Issue writing predictions for {}: {}.'.format(key, e))
+
+    def run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._batch_ready():
+                    if any(self._outstanding.get(k, 0) == 0 for k in self._finished):
+                        break
+                    if self._closing and (self._pending_frames == 0):
+                        break
+
+                    timeout = None
+                    if self._pending:
+                        timeout = max(self.max_latency_s - (time.monotonic() - self._pending[0][3]),
+                                      0.01)
+                    self._cond.wait(timeout)
+
+                chunks = self._take_batch() if self._batch_ready() else []
+                closing = self._closing
+
+            if chunks:
+                self._predict_batch(chunks)
+
+            self._write_finished()
+
+            with self._cond:
+                if closing and (self._pending_frames == 0) and (len(self._finished) == 0):
+                    self._cond.notify_all()
+                    return
+
+    def close(self) -> None:
+        """Function to predict what is left, write finished keys and stop the thread."""
+
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+
+        if self.is_alive():
+            self.join()
+
+        if self._sinks:
+            logging.warning('Predictions for {} were never finished and not written.'.format(
+                sorted(str(k) for k in self._sinks)))
+
+        logging.info('Predicted {} frames in {} batches, {:.0f} frames per batch.'.format(
+            self.frames, self.batches, self.frames/max(self.batches, 1)))
+
+
+class ClassificationWriter:
+    """Collects the predictions of one camera day and writes them to its
+    classification file, in the same columns all_tasks.py always wrote.
+    """
+
+    columns = ['date', 'time', 'prediction', 'prediction_str', 'confidence']
+
+    def __init__(self, txt_path:str, classes, metrics=None, **labels):
+        """
+        INPUT
+        txt_path - classification file, its comment header should already be written
+        classes - class names in the order of the model outputs, e.g. lb.classes_
+        metrics - RunMetrics to record the write as a stage, or None
+        labels - labels for the write stage, e.g. asi
+        """
+
+        self.txt_path = txt_path
+        self.classes = classes
+        self.metrics = metrics
+        self.labels = labels
+        self.rows = []
+
+    def add(self, key, items:list, preds:np.ndarray) -> None:
+        """Function to add predictions for (date, time) items."""
+
+        prediction_nums = list(map(np.argmax, preds))
+        self.rows.append(pd.DataFrame({'date':[i[0] for i in items], 'time':[i[1] for i in items],
+                                       'prediction':prediction_nums,
+                                       'prediction_str':[self.classes[p] for p in prediction_nums],
+                                       'confidence':list(map(np.max, preds))}))
+
+    def write(self, key=None) -> None:
+        """Function to append the collected predictions to the file."""
+
+        df = pd.concat(self.rows, ignore_index=True) if self.rows else pd.DataFrame(columns=self.columns)
+
+        if self.metrics is None:
+            df.to_csv(self.txt_path, mode='a', index=False, header=True)
+        else:
+            with self.metrics.stage('write', **self.labels) as record:
+                df.to_csv(self.txt_path, mode='a', index=False, header=True)
+                record.update(frames=len(df), bytes=os.path.getsize(self.txt_path))
+
+        logging.info(f'Predictions written to file and available at {self.txt_path}.')
@@ -0,0 +1,342 @@
+"""
+Functions and classes for a local inference server that keeps the model
+loaded between runs. The server listens on a Unix domain socket, uint8
+frames are sent to it through shared memory and the predictions come back
+over the socket, so a short all_tasks.py run or a notebook doesn't pay the
+TensorFlow import and model load each time. Start it with
+src/models/inference-server.py, clients fall back to loading the model
+themselves when it isn't running.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+import logging
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+import os
+import stat
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from src.models.memory_watchdog import predict_shared, send_frames
+from src.models.run_metrics import rss_bytes
+from src.models.tracing import span
+
+# Socket of the server, in the user's runtime directory or a private directory in /tmp.
+# Replies are unpickled, so clients only connect to a socket and key file owned by them
+# and the server only answers clients that prove they have the key.
+default_socket = os.environ.get('ASI_INFERENCE_SOCKET',
+                                os.path.join(os.environ.get('XDG_RUNTIME_DIR')
+                                             or os.path.join(tempfile.gettempdir(),
+                                                             'asi-inference-{}'.format(os.getuid())),
+                                             'asi-inference.sock'))
+
+
+def _key_file(socket_path:str) -> str:
+    """Function to get the file with the authentication key of a socket."""
+
+    return socket_path + '.key'
+
+
+def _check_private(path:str, mode_mask:int=0o077) -> os.stat_result:
+    """Function to make sure a file or directory is owned by this user and
+    can't be read or written by anyone else, raises PermissionError if not.
+    """
+
+    path_stat = os.lstat(path)
+
+    if path_stat.st_uid != os.getuid():
+        raise PermissionError('{} is owned by uid {}, not {}.'.format(path, path_stat.st_uid,
+                                                                     os.getuid()))
+
+    if stat.S_IMODE(path_stat.st_mode) & mode_mask:
+        raise PermissionError('{} can be accessed by other users, mode {:o}.'.format(
+            path, stat.S_IMODE(path_stat.st_mode)))
+
+    return path_stat
+
+
+def _make_socket_dir(socket_path:str) -> None:
+    """Function to create the directory of the socket readable by this user only,
+    or check that an existing one isn't writable by anyone else.
+    """
+
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+
+    if not os.path.exists(socket_dir):
+        os.makedirs(socket_dir, mode=0o700)
+
+    # Others may read a directory like XDG_RUNTIME_DIR but must not write to it
+    _check_private(socket_dir, mode_mask=0o022)
+
+
+def _write_authkey(socket_path:str) -> bytes:
+    """Function to write a new random authentication key readable by this user only."""
+
+    key_file = _key_file(socket_path)
+    if os.path.lexists(key_file):
+        os.remove(key_file)
+
+    authkey = os.urandom(32)
+    fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+
+    return authkey
+
+
+def _read_authkey(socket_path:str) -> bytes:
+    """Function to read the authentication key of a socket after checking that
+    the socket and key belong to this user, raises PermissionError if not.
+    """
+
+    _check_private(socket_path)
+    _check_private(_key_file(socket_path))
+
+    with open(_key_file(socket_path), 'rb') as f:
+        return f.read()
+
+
+class InferenceServer:
+    """Keeps a model loaded and predicts frames for clients on a Unix socket.
+
+    server = InferenceServer('models/CNN_model/model/CNN_0524.model')
+    server.serve_forever()
+    """
+
+    def __init__(self, model_file:str, socket_path:str=None,
+                 warmup_shape:tuple=(1, 224, 224, 3)):
+        """
+        INPUT
+        model_file - saved keras model to load
+        socket_path - Unix socket to listen on, defaults to default_socket
+        warmup_shape - shape of a batch of zeros predicted once after loading so the
+                       first request doesn't pay for building the graph, None to skip
+        """
+
+        self.model_file = model_file
+        self.socket_path = default_socket if socket_path is None else socket_path
+
+        from tensorflow.keras.models import load_model
+
+        start_time = time.perf_counter()
+        self.model = load_model(model_file)
+        if warmup_shape is not None:
+            self.model.predict(np.zeros(warmup_shape, dtype='float32'), verbose=0)
+        logging.info('Loaded {} in {:.1f} s.'.format(model_file, time.perf_counter() - start_time))
+
+        # Keras models aren't safe to predict with from several threads at once
+        self._predict_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self.start_time = time.monotonic()
+        self.requests = 0
+        self.frames = 0
+        self.listener = None
+        self.authkey = None
+
+    def _bind(self) -> Listener:
+        """Function to create the listener and its key, removing a socket left by a
+        server that died.
+        """
+
+        _make_socket_dir(self.socket_path)
+
+        if os.path.lexists(self.socket_path):
+            client = connect_inference_server(self.socket_path)
+            if client is not None:
+                client.close()
+                raise RuntimeError('An inference server is already running on {}.'.format(
+                    self.socket_path))
+            os.remove(self.socket_path)
+
+        # Create the socket readable and writable by this user only, clients
+        # also have to answer a challenge with the key
+        self.authkey = _write_authkey(self.socket_path)
+        umask = os.umask(0o177)
+        try:
+            return Listener(self.socket_path, family='AF_UNIX', authkey=self.authkey)
+        finally:
+            os.umask(umask)
+
+    def status(self) -> dict:
+        """Function to get what the server is running and how much it has done."""
+
+        return {'pid':os.getpid(), 'model_file':self.model_file,
+                'uptime_s':time.monotonic() - self.start_time, 'requests':self.requests,
+                'frames':self.frames, 'rss_bytes':rss_bytes()}
+
+    def _handle(self, conn) -> None:
+        """Function to answer the requests of one client until it disconnects."""
+
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    break
+
+                command = message[0]
+
+                if command == 'predict':
+                    try:
+                        with self._predict_lock, span('server.predict', frames=message[2][0]):
+                            preds = predict_shared(self.model, *message[1:], track=False)
+                        self.requests += 1
+                        self.frames += message[2][0]
+                        conn.send(('ok', preds))
+                    except Exception as e:
+                        logging.warning('Unable to predict request: {}'.format(e))
+                        conn.send(('error', repr(e)))
+
+                elif command == 'status':
+                    conn.send(('ok', self.status()))
+
+                elif command == 'shutdown':
+                    conn.send(('ok', None))
+                    self.shutdown()
+
+                else:
+                    conn.send(('error', 'Unknown command {}.'.format(command)))
+        finally:
+            conn.close()
+
+    def serve_forever(self) -> None:
+        """Function to accept clients until shutdown is requested, one thread per client."""
+
+        self.listener = self._bind()
+        logging.info('Inference server {} listening on {}.'.format(os.getpid(), self.socket_path))
+
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    conn = self.listener.accept()
+                except AuthenticationError as e:
+                    logging.warning('Rejected a client without the key: {}'.format(e))
+                    continue
+                except (EOFError, ConnectionError):
+                    # Client left during the challenge
+                    continue
+
+                # shutdown connects once to wake up accept
+                if self._stop_event.is_set():
+                    conn.close()
+                    break
+
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self._stop_event.set()
+            self.listener.close()
+
+            if os.path.lexists(_key_file(self.socket_path)):
+                os.remove(_key_file(self.socket_path))
+
+        logging.info('Inference server stopped after {} requests and {} frames.'.format(
+            self.requests, self.frames))
+
+    def shutdown(self) -> None:
+        """Function to stop accepting clients, the socket is removed when serve_forever returns."""
+
+        if self._stop_event.is_set():
+            return
+
+        self._stop_event.set()
+
+        try:
+            Client(self.socket_path, family='AF_UNIX', authkey=self.authkey).close()
+        except (OSError, EOFError, AuthenticationError):
+            pass
+
+
+class InferenceClient:
+    """Connection to a running inference server, predict works like model.predict.
+
+    client = InferenceClient()
+    preds = client.predict(frames, batch_size=30, cut_mask=elev_angle < 15)
+    """
+
+    def __init__(self, socket_path:str=None):
+        """
+        INPUT
+        socket_path - Unix socket of the server, defaults to default_socket
+        Raises PermissionError if the socket or its key isn't private to this user.
+        """
+
+        self.socket_path = default_socket if socket_path is None else socket_path
+        self.conn = Client(self.socket_path, family='AF_UNIX',
+                           authkey=_read_authkey(self.socket_path))
+
+        # One request at a time on the connection
+        self._lock = threading.Lock()
+
+    def _request(self, command:str, *args):
+        with self._lock:
+            self.conn.send((command,) + args)
+            status, reply = self.conn.recv()
+
+        if status != 'ok':
+            raise RuntimeError('Inference server: {}'.format(reply))
+
+        return reply
+
+    def predict(self, frames:np.ndarray, batch_size:int=30, cut_mask:np.ndarray=None,
+                **kwargs) -> np.ndarray:
+        """Function to predict frames on the server.
+        INPUT
+        frames - uint8 frames, converted to model inputs on the server, or float32 model inputs
+        batch_size - batch size for model.predict
+        cut_mask - pixels set to 0 before prediction, see model_input
+        OUTPUT
+        preds - model predictions, same as model.predict
+        """
+
+        with self._lock, span('client.predict', frames=len(frames)):
+            status, reply = send_frames(self.conn, frames, batch_size, command=('predict',),
+                                         cut_mask=cut_mask)
+
+        if status != 'ok':
+            raise RuntimeError('Inference server: {}'.format(reply))
+
+        return reply
+
+    def status(self) -> dict:
+        """Function to get the model, uptime and request counts of the server."""
+
+        return self._request('status')
+
+    def shutdown(self) -> None:
+        """Function to ask the server to stop."""
+
+        self._request('shutdown')
+        self.close()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def connect_inference_server(socket_path:str=None) -> InferenceClient:
+    """Function to connect to the inference server if one is running.
+    INPUT
+    socket_path - Unix socket of the server, defaults to default_socket
+    OUTPUT
+    client - InferenceClient, or None if no server answers on the socket
+    """
+
+    socket_path = default_socket if socket_path is None else socket_path
+
+    if not os.path.exists(socket_path):
+        return None
+
+    try:
+        client = InferenceClient(socket_path)
+        client.status()
+    except PermissionError as e:
+        logging.warning('Not using inference server socket {}: {}'.format(socket_path, e))
+        return None
+    except (OSError, EOFError, RuntimeError, AuthenticationError):
+        return None
+
+    return client
@@ -0,0 +1,412 @@
+"""
+Functions and classes to keep the memory of long classification runs bounded.
+A watchdog thread samples the resident memory of the main process and its
+worker processes, and the use of /dev/shm, writes them as run metrics, and
+fits how fast the main process grows in MB per day. When it keeps growing,
+model prediction can be moved into a subprocess that is restarted after a
+number of batches or past a memory limit, frames are passed to it through
+shared memory. Frames are sent as uint8 and only turned into float32 model
+inputs by the process with the model, see model_input.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+from collections import deque
+import gc
+import glob
+import logging
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from src.models.run_metrics import rss_bytes
+from src.models.tracing import span
+
+
+def child_pids(pid:int=None) -> list:
+    """Function to get the process IDs of the children of a process, e.g. pool workers.
+    Uses /proc on Linux, otherwise returns an empty list.
+    """
+
+    pid = os.getpid() if pid is None else pid
+
+    pids = []
+    for children_file in glob.glob('/proc/{}/task/*/children'.format(pid)):
+        try:
+            with open(children_file, 'r') as f:
+                pids.extend(int(p) for p in f.read().split())
+        except (OSError, ValueError):
+            continue
+
+    return sorted(set(pids))
+
+
+def shm_usage(shm_dir:str='/dev/shm') -> tuple:
+    """Function to get the used and total bytes of the shared memory filesystem.
+    OUTPUT
+    used, total - in bytes, both 0 if it doesn't exist
+    """
+
+    try:
+        stat = os.statvfs(shm_dir)
+    except OSError:
+        return 0, 0
+
+    total = stat.f_blocks*stat.f_frsize
+    return total - stat.f_bfree*stat.f_frsize, total
+
+
+def growth_rate(samples) -> float:
+    """Function to get the least squares slope of (seconds, bytes) samples in MB per day."""
+
+    if len(samples) < 2:
+        return 0.0
+
+    t = np.array([s[0] for s in samples], dtype='float64')
+    y = np.array([s[1] for s in samples], dtype='float64')
+    t = t - t.mean()
+
+    if not np.any(t):
+        return 0.0
+
+    return float(np.sum(t*(y - y.mean()))/np.sum(t*t)*86400/2**20)
+
+
+class MemoryWatchdog(threading.Thread):
+    """Thread that samples the memory of this process, its workers and /dev/shm.
+
+    watchdog = MemoryWatchdog(metrics=metrics)
+    watchdog.start()
+    ...
+    if watchdog.growing():
+        # move prediction to an IsolatedPredictor
+    watchdog.stop()
+    """
+
+    def __init__(self, metrics=None, interval_s:float=60, rss_limit_mb:float=None,
+                 shm_limit_fraction:float=0.8, growth_limit_mb_per_day:float=2048,
+                 min_window_s:float=3600, window:int=1440):
+        """
+        INPUT
+        metrics - RunMetrics to write the samples to as gauges, or None to only log
+        interval_s - seconds between samples
+        rss_limit_mb - warn when this process and its workers together use more than this
+        shm_limit_fraction - warn when /dev/shm is fuller than this
+        growth_limit_mb_per_day - growth of the main process counted as a leak
+        min_window_s - samples must cover at least this long before growth is judged
+        window - how many samples the growth is fit over, one day at the default interval
+        """
+
+        super().__init__(name='memory-watchdog', daemon=True)
+
+        self.metrics = metrics
+        self.interval_s = interval_s
+        self.rss_limit_mb = rss_limit_mb
+        self.shm_limit_fraction = shm_limit_fraction
+        self.growth_limit_mb_per_day = growth_limit_mb_per_day
+        self.min_window_s = min_window_s
+
+        self.samples = deque(maxlen=window)
+        self.start_rss = None
+        self.peak = {'main':0, 'workers':0, 'shm':0}
+
+        self._stop_event = threading.Event()
+
+    def sample(self) -> dict:
+        """Function to take one sample, write it to the metrics and warn about limits."""
+
+        now = time.monotonic()
+        main_rss = rss_bytes()
+        workers = {pid:rss_bytes(pid) for pid in child_pids()}
+        workers_rss = sum(workers.values())
+        shm_used, shm_total = shm_usage()
+
+        if self.start_rss is None:
+            self.start_rss = main_rss
+
+        self.samples.append((now, main_rss))
+        sample = {'rss_bytes':main_rss, 'workers':len(workers), 'workers_rss_bytes':workers_rss,
+                  'shm_used_bytes':shm_used, 'shm_total_bytes':shm_total,
+                  'growth_mb_per_day':self.growth_mb_per_day()}
+
+        self.peak['main'] = max(self.peak['main'], main_rss)
+        self.peak['workers'] = max(self.peak['workers'], workers_rss)
+        self.peak['shm'] = max(self.peak['shm'], shm_used)
+
+        if self.metrics is not None:
+            self.metrics.gauge('memory_rss_bytes', main_rss, stage='main')
+            self.metrics.gauge('memory_rss_bytes', workers_rss, stage='workers')
+            self.metrics.gauge('memory_shm_used_bytes', shm_used)
+            self.metrics.gauge('memory_growth_mb_per_day', sample['growth_mb_per_day'])
+
+        if (self.rss_limit_mb is not None) and (main_rss + workers_rss > self.rss_limit_mb*2**20):
+            logging.warning('Memory of main process and {} workers is {:.0f} MB, over the'
+                            ' {:.0f} MB limit.'.format(len(workers), (main_rss + workers_rss)/2**20,
+                                                       self.rss_limit_mb))
+
+        if shm_total and (shm_used > self.shm_limit_fraction*shm_total):
+            logging.warning('/dev/shm is {:.0f}% full, shared memory from a closed pool'
+                            ' may not have been released.'.format(100*shm_used/shm_total))
+
+        return sample
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                logging.warning('Unable to sample memory: {}'.format(e))
+            self._stop_event.wait(self.interval_s)
+
+    def growth_mb_per_day(self) -> float:
+        """Function to get how fast the main process has been growing, in MB per day."""
+
+        return growth_rate(list(self.samples))
+
+    def growing(self) -> bool:
+        """Function to check if the main process keeps growing faster than the limit."""
+
+        samples = list(self.samples)
+        if (len(samples) < 3) or (samples[-1][0] - samples[0][0] < self.min_window_s):
+            return False
+
+        return growth_rate(samples) > self.growth_limit_mb_per_day
+
+    def stop(self) -> None:
+        """Function to stop sampling and log the growth and peak memory of the run."""
+
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+        self.sample()
+
+        if self.start_rss is not None:
+            logging.info('Memory: main process grew {:.0f} MB ({:.0f} MB/day), peak {:.0f} MB,'
+                         ' workers peak {:.0f} MB, /dev/shm peak {:.0f} MB.'.format(
+                             (rss_bytes() - self.start_rss)/2**20, self.growth_mb_per_day(),
+                             self.peak['main']/2**20, self.peak['workers']/2**20,
+                             self.peak['shm']/2**20))
+
+
+def model_input(frames:np.ndarray, cut_mask:np.ndarray=None, size:tuple=(224, 224)) -> np.ndarray:
+    """Function to turn preprocessed uint8 frames into the float32 model input,
+    the same as zeroing the cut pixels of the float frame and resizing it.
+    Frames that aren't uint8 are taken to be model inputs already.
+    INPUT
+    frames - (n, height, width) uint8 grayscale frames, e.g. from process_image_clahe
+    cut_mask - (height, width) boolean array of pixels set to 0, e.g. elev_angle < 15
+    size - (width, height) of the model input
+    OUTPUT
+    inputs - (n, height, width, 3) float32 frames, the gray channel repeated as BGR
+
+    >>> frames = np.full((2, 4, 4), 200, dtype='uint8')
+    >>> inputs = model_input(frames, cut_mask=np.eye(4, dtype=bool), size=(4, 4))
+    >>> inputs.shape, inputs.dtype.name, float(inputs[0, 0, 0, 0]), float(inputs[0, 0, 1, 2])
+    ((2, 4, 4, 3), 'float32', 0.0, 200.0)
+    """
+
+    frames = np.asarray(frames)
+    if frames.dtype != np.uint8:
+        return frames
+
+    inputs = np.empty((len(frames), size[1], size[0], 3), dtype='float32')
+    for n, frame in enumerate(frames):
+        frame = frame.astype('float32')
+        if cut_mask is not None:
+            frame[cut_mask] = 0
+        inputs[n] = cv2.resize(frame, size)[:, :, np.newaxis]
+
+    return inputs
+
+
+def send_frames(conn, frames:np.ndarray, batch_size:int, command:tuple=(),
+                cut_mask:np.ndarray=None):
+    """Function to put frames in shared memory, send a prediction request for
+    them over a connection and wait for the reply. The shared memory is
+    removed once the reply arrives.
+    INPUT
+    conn - multiprocessing connection to the process with the model
+    frames - uint8 frames or an array of model inputs
+    batch_size - batch size for model.predict
+    command - sent before the frame description, e.g. ('predict',)
+    cut_mask - pixels set to 0 before prediction, see model_input
+    OUTPUT
+    reply - whatever the other process sent back
+    """
+
+    frames = np.ascontiguousarray(frames)
+    shm = shared_memory.SharedMemory(create=True, size=max(frames.nbytes, 1))
+    try:
+        np.ndarray(frames.shape, dtype=frames.dtype, buffer=shm.buf)[:] = frames
+        conn.send(command + (shm.name, frames.shape, frames.dtype.str, batch_size, cut_mask))
+        return conn.recv()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def predict_shared(model, shm_name:str, shape:tuple, dtype:str, batch_size:int,
+                   cut_mask:np.ndarray=None, track:bool=True) -> np.ndarray:
+    """Function to run model.predict on frames another process put in shared memory.
+    INPUT
+    model - loaded keras model
+    shm_name, shape, dtype, batch_size, cut_mask - as sent by send_frames
+    track - False if this process doesn't share the sender's resource tracker, so
+            the memory isn't also unlinked when this process exits
+    OUTPUT
+    preds - model predictions
+    """
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    if not track:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+
+    try:
+        frames = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        with span('model.predict', frames=shape[0]):
+            preds = model.predict(model_input(frames, cut_mask), batch_size=batch_size)
+        del frames
+    finally:
+        shm.close()
+
+    return preds
+
+
+def _predictor_main(conn, model_file:str) -> None:
+    """Function run by the prediction subprocess. Loads the model and predicts
+    each batch of frames it is sent through shared memory until it gets None.
+    """
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    from tensorflow.keras.models import load_model
+
+    model = load_model(model_file)
+    conn.send('ready')
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+
+        try:
+            conn.send((predict_shared(model, *message), rss_bytes()))
+        except Exception as e:
+            conn.send((e, rss_bytes()))
+
+        # Garbage collection to deal with memory leak from model.predict
+        gc.collect()
+
+    conn.close()
+
+
+class IsolatedPredictor:
+    """Runs model prediction in a subprocess that is restarted after max_tasks
+    batches or when its memory is past rss_limit_mb, so memory that model.predict
+    doesn't give back is released with the process.
+
+    predictor = IsolatedPredictor(model_file, max_tasks=200)
+    preds = predictor.predict(frames, batch_size=30, cut_mask=elev_angle < 15)
+    predictor.close()
+    """
+
+    def __init__(self, model_file:str, max_tasks:int=None, rss_limit_mb:float=None):
+        """
+        INPUT
+        model_file - saved keras model to load in the subprocess
+        max_tasks - restart the subprocess after this many batches
+        rss_limit_mb - restart the subprocess when it uses more memory than this
+        """
+
+        self.model_file = model_file
+        self.max_tasks = max_tasks
+        self.rss_limit_mb = rss_limit_mb
+
+        self.process = None
+        self.conn = None
+        self.tasks = 0
+        self.restarts = 0
+
+        self._start()
+
+    @property
+    def pid(self) -> int:
+        return None if self.process is None else self.process.pid
+
+    def _start(self) -> None:
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_predictor_main, args=(child_conn, self.model_file),
+                                       name='predictor', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+        # Wait until the model is loaded so startup errors show up here
+        if not self.conn.poll(600) or self.conn.recv() != 'ready':
+            self.close()
+            raise RuntimeError('Prediction subprocess did not load {}.'.format(self.model_file))
+
+        logging.info('Prediction subprocess {} started.'.format(self.process.pid))
+
+    def restart(self) -> None:
+        """Function to stop the subprocess and start a fresh one."""
+
+        logging.info('Restarting prediction subprocess {} after {} batches.'.format(self.process.pid,
+                                                                                   self.tasks))
+        self.close()
+        self._start()
+        self.restarts += 1
+
+    def predict(self, frames:np.ndarray, batch_size:int=30, cut_mask:np.ndarray=None) -> np.ndarray:
+        """Function to predict frames in the subprocess.
+        INPUT
+        frames - uint8 frames or an array of model inputs
+        batch_size - batch size for model.predict
+        cut_mask - pixels set to 0 before prediction, see model_input
+        OUTPUT
+        preds - model predictions, same as model.predict
+        """
+
+        try:
+            preds, child_rss = send_frames(self.conn, frames, batch_size, cut_mask=cut_mask)
+        except EOFError:
+            self.close()
+            self._start()
+            raise RuntimeError('Prediction subprocess exited during predict.')
+
+        self.tasks += 1
+
+        if isinstance(preds, Exception):
+            raise preds
+
+        if (((self.max_tasks is not None) and (self.tasks >= self.max_tasks))
+            or ((self.rss_limit_mb is not None) and (child_rss > self.rss_limit_mb*2**20))):
+            self.restart()
+
+        return preds
+
+    def close(self) -> None:
+        """Function to stop the subprocess."""
+
+        if self.process is None:
+            return
+
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+
+        self.process.join(timeout=60)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+        self.conn.close()
+        self.process = None
@@ -0,0 +1,197 @@
+"""
+Functions to split a core budget between the stages of a classification run
+so they use the whole machine without fighting over it. The reader, the
+preprocessing pool and TensorFlow each get a number of workers and threads,
+the OpenCV, OpenMP, BLAS and TensorFlow thread pools are limited to match,
+and each stage can optionally be pinned to its own cores. The chosen
+allocation is logged, written to the run metrics and saved as json.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+from contextlib import contextmanager
+import json
+import logging
+import multiprocessing
+import os
+import sys
+
+stages = ['reader', 'preprocess', 'inference']
+
+# Share of the cores each stage gets when the stages run at the same time
+default_weights = {'reader':1, 'preprocess':2, 'inference':1}
+
+# Environment variables read by the thread pools of the numerical libraries
+# when they are loaded, so they have to be set before the import
+thread_env_vars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                   'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']
+
+
+def available_cores() -> list:
+    """Function to get the cores this process is allowed to run on."""
+
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(multiprocessing.cpu_count()))
+
+
+def plan_allocation(cores:int=None, overlap:bool=False, weights:dict=None,
+                    pin:bool=False) -> dict:
+    """Function to split a core budget between the reader, preprocessing and inference.
+    When the stages run one after the other each gets the whole budget but
+    every worker runs single threaded so the pool doesn't start a thread pool
+    per worker. When they overlap, as in all_tasks.py where the inference
+    batcher predicts while the next hour is read and preprocessed, the budget
+    is split by weights and each stage gets its own cores.
+    INPUT
+    cores - core budget, defaults to all the cores this process can run on
+    overlap - whether the stages run at the same time
+    weights - share of the cores for each stage when they overlap
+    pin - whether to pin each stage to its cores
+    OUTPUT
+    allocation - dictionary with the workers, threads per worker and cores of each stage
+    """
+
+    cpus = available_cores()
+    cores = len(cpus) if cores is None else max(min(int(cores), len(cpus)), 1)
+    cpus = cpus[:cores]
+
+    if (not overlap) or (cores < len(stages)):
+        counts = {stage:cores for stage in stages}
+        stage_cpus = {stage:cpus for stage in stages}
+
+    else:
+        weights = default_weights if weights is None else weights
+        total = sum(weights[stage] for stage in stages)
+
+        # At least one core each, the rest by weight, any left over go to preprocessing
+        counts = {stage:max(int(cores*weights[stage]/total), 1) for stage in stages}
+        counts['preprocess'] += cores - sum(counts.values())
+
+        stage_cpus = {}
+        first = 0
+        for stage in stages:
+            stage_cpus[stage] = cpus[first:first + counts[stage]]
+            first = first + counts[stage]
+
+    # The reader and preprocessing scale with processes, inference with threads
+    allocation = {'cores':cores, 'overlap':overlap, 'pin':pin,
+                  'workers':{'reader':counts['reader'], 'preprocess':counts['preprocess'],
+                             'inference':1},
+                  'threads':{'reader':1, 'preprocess':1, 'inference':counts['inference']},
+                  'cpus':stage_cpus}
+
+    return allocation
+
+
+def thread_env(threads:int) -> dict:
+    """Function to get the environment variables that limit library thread pools to threads."""
+
+    env = {var:str(threads) for var in thread_env_vars}
+    env['TF_NUM_INTRAOP_THREADS'] = str(threads)
+    env['TF_NUM_INTEROP_THREADS'] = str(min(threads, 2))
+
+    return env
+
+
+def limit_threads(threads:int, cpus:list=None) -> None:
+    """Function to limit the thread pools of this process and optionally pin it to cores.
+    The environment variables only take effect for libraries imported after
+    this, OpenCV and, if installed, threadpoolctl are also limited at runtime.
+    TensorFlow can only be limited before it runs its first operation.
+    INPUT
+    threads - threads each library may use
+    cpus - cores to pin this process to, None to leave it
+    """
+
+    os.environ.update(thread_env(threads))
+
+    if 'cv2' in sys.modules:
+        sys.modules['cv2'].setNumThreads(threads)
+
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+
+    if 'tensorflow' in sys.modules:
+        tf = sys.modules['tensorflow']
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(threads)
+            tf.config.threading.set_inter_op_parallelism_threads(min(threads, 2))
+        except RuntimeError:
+            # Already initialized, the environment variables set above apply next time
+            pass
+
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except (AttributeError, OSError) as e:
+            logging.warning('Unable to pin process to cores {}: {}'.format(cpus, e))
+
+
+def limit_stage(allocation:dict, stage:str) -> None:
+    """Function to limit this process to the threads, and if pinning, the cores of a stage."""
+
+    limit_threads(allocation['threads'][stage],
+                  allocation['cpus'][stage] if allocation['pin'] else None)
+
+
+@contextmanager
+def worker_environment(allocation:dict, stage:str):
+    """Context manager to start pool workers with the thread limits of a stage.
+    Spawned workers load their libraries before the pool initializer runs,
+    so the limits are passed to them through the environment.
+    """
+
+    saved = {var:os.environ.get(var) for var in thread_env(1)}
+    os.environ.update(thread_env(allocation['threads'][stage]))
+
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def init_worker(allocation:dict, stage:str) -> None:
+    """Function to use as a pool initializer, limits each worker to its stage."""
+
+    limit_stage(allocation, stage)
+
+
+def publish_allocation(allocation:dict, metrics=None, allocation_file:str=None) -> None:
+    """Function to log the allocation, write it to the run metrics and save it as json.
+    INPUT
+    allocation - from plan_allocation
+    metrics - RunMetrics to write the workers and threads of each stage to, or None
+    allocation_file - json file to write, defaults to logs/{metrics name}-allocation.json
+    """
+
+    logging.info('Core budget {}: {}.'.format(allocation['cores'], ', '.join(
+        '{} {} workers x {} threads{}'.format(stage, allocation['workers'][stage],
+                                              allocation['threads'][stage],
+                                              ' on cores {}-{}'.format(allocation['cpus'][stage][0],
+                                                                       allocation['cpus'][stage][-1])
+                                              if allocation['pin'] else '')
+        for stage in stages)))
+
+    if metrics is not None:
+        metrics.gauge('allocated_cores', allocation['cores'])
+        for stage in stages:
+            metrics.gauge('allocated_workers', allocation['workers'][stage], stage=stage)
+            metrics.gauge('allocated_threads', allocation['threads'][stage], stage=stage)
+
+        if allocation_file is None:
+            allocation_file = os.path.join(os.path.dirname(metrics.jsonl_file),
+                                           metrics.name + '-allocation.json')
+
+    if allocation_file is not None:
+        with open(allocation_file, 'w') as f:
+            json.dump(allocation, f, indent=2)
@@ -0,0 +1,73 @@
+"""
+Script to retrain the CNN model on all labeled THEMIS training data.
+Frames are streamed from the daily h5 files in data/interim/training/themis/
+so the full corpus never has to fit in memory.
+
+Written by Riley Troyer
+science@rileytroyer.com
+"""
+# Import needed libraries
+from datetime import datetime
+import glob
+import logging
+import numpy as np
+import os
+from pathlib import Path
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+from tensorflow.keras.models import load_model
+
+from src.data.label_catalog import exclude_labels, get_label_catalog
+from src.models.training_data_functions import build_frame_index, make_dataset, split_frame_index
+
+# Important directories
+logs_dir = 'logs/'
+h5_dir = 'data/interim/training/themis/'
+model_path = 'models/CNN_model'
+classification_dir = 'docs/classifications/'
+
+# Where to save the retrained model
+new_model_file = os.path.join(model_path, 'model', f'CNN_{datetime.today():%m%d}.model')
+
+batch_size = 32
+epochs = 10
+
+# Initiate logging
+logging.basicConfig(filename=logs_dir + f'retrain-cnn-{datetime.today().date()}.log',
+                    encoding='utf-8',
+                    format='%(asctime)s %(levelname)-8s %(message)s',
+                    level=logging.INFO,
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+#------------------------------Initializing done------------------------------
+
+if __name__ == '__main__':
+
+    # Test classifications are kept out of training, including the copies
+    # of them in other spreadsheets
+    catalog = get_label_catalog(classification_dir)
+    catalog = exclude_labels(catalog, 'themis/final-test-classifications.xlsx')
+
+    h5_files = sorted(glob.glob(os.path.join(h5_dir, 'all-images-*.h5')))
+    frame_index = build_frame_index(h5_files, catalog)
+    train_index, val_index = split_frame_index(frame_index, val_fraction=0.2)
+
+    elev_angle = np.load(os.path.join(model_path, 'T_angle.npy'))
+
+    train_ds = make_dataset(train_index, batch_size=batch_size, elev_angle=elev_angle)
+    val_ds = make_dataset(val_index, batch_size=batch_size, elev_angle=elev_angle,
+                          shuffle=False)
+
+    model = load_model(os.path.join(model_path, 'model', 'CNN_0524.model'))
+
+    logging.info(f'Training on {sum(len(f[1]) for f in train_index)} frames,'
+                 f' validating on {sum(len(f[1]) for f in val_index)}.')
+
+    model.fit(train_ds, validation_data=val_ds, epochs=epochs)
+    model.save(new_model_file)
+
+    logging.info(f'Model saved to {new_model_file}.')
@@ -0,0 +1,242 @@
+"""
+Functions and a small class to instrument long classification runs.
+Each stage of an hour (reading, preprocessing, prediction, writing) is
+timed, and frames, bytes, frames/s, queue depth, worker utilization, and
+memory are written as one json line per stage to a metrics file. Running
+totals are also written as a Prometheus textfile for the node exporter,
+and a progress summary with an ETA is logged every few minutes.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+from src.models.tracing import span
+
+
+def rss_bytes(pid:int=None) -> int:
+    """Function to get the current resident memory of a process in bytes.
+    Uses /proc on Linux, otherwise the peak memory of this process.
+    """
+
+    try:
+        with open('/proc/{}/statm'.format('self' if pid is None else pid), 'r') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+def timed_call(func, item):
+    """Function to run func(item) and also return how long it took.
+    Use with functools.partial in a pool to measure how busy the workers are.
+    The call is also recorded as a trace span when tracing is on.
+    """
+
+    start_time = time.perf_counter()
+    with span(getattr(func, '__name__', 'task')):
+        result = func(item)
+
+    return result, time.perf_counter() - start_time
+
+
+class RunMetrics:
+    """Collects per-stage timings of a run and writes them as json lines and a
+    Prometheus textfile.
+
+    metrics = RunMetrics('all_tasks', total=len(days))
+    with metrics.stage('read', asi='atha', hour='ut06') as record:
+        ...
+        record['frames'] = n_frames
+    metrics.unit_done()
+    """
+
+    def __init__(self, name:str, metrics_dir:str='logs/', textfile_dir:str=None,
+                 total:int=None, progress_every_s:float=300):
+        """
+        INPUT
+        name - run name, used for the file names and as the metric prefix
+        metrics_dir - where to write {name}-metrics.jsonl
+        textfile_dir - node exporter textfile directory for {name}.prom, defaults to metrics_dir
+        total - number of units (e.g. days) in the run, for the progress and ETA
+        progress_every_s - how often to log a progress summary
+        """
+
+        self.name = name
+        self.jsonl_file = os.path.join(metrics_dir, name + '-metrics.jsonl')
+        self.prom_file = os.path.join(metrics_dir if textfile_dir is None else textfile_dir,
+                                      name + '.prom')
+        self.total = total
+        self.progress_every_s = progress_every_s
+
+        self.start_time = time.monotonic()
+        self.last_progress = self.start_time
+        self.done = 0
+        self.totals = {}
+        self.gauges = {}
+
+        # Stages and gauges are also recorded from other threads, e.g. the inference
+        # batcher and the memory watchdog, so totals, gauges and done are only
+        # changed or read with this held
+        self._lock = threading.Lock()
+
+        for directory in [os.path.dirname(self.jsonl_file), os.path.dirname(self.prom_file)]:
+            if (directory != '') and (not os.path.exists(directory)):
+                os.makedirs(directory)
+
+    def _write(self, record:dict) -> None:
+        with self._lock, open(self.jsonl_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    @contextmanager
+    def stage(self, stage:str, **labels):
+        """Context manager timing one stage. The yielded dictionary can be
+        filled with frames, bytes, queue_depth, workers and busy_s before it exits.
+        """
+
+        record = {'frames':0, 'bytes':0}
+        start_time = time.perf_counter()
+
+        try:
+            with span(stage, **labels):
+                yield record
+        finally:
+            seconds = time.perf_counter() - start_time
+
+            record.update({'time':datetime.now().isoformat(timespec='seconds'),
+                           'run':self.name, 'stage':stage, 'seconds':seconds,
+                           'frames_per_s':record['frames']/max(seconds, 1e-9),
+                           'rss_bytes':rss_bytes()})
+            record.update(labels)
+
+            # Fraction of the pool's time spent doing work
+            if ('busy_s' in record) and ('workers' in record):
+                record['worker_utilization'] = record['busy_s']/max(seconds*record['workers'], 1e-9)
+
+            with self._lock:
+                if 'worker_utilization' in record:
+                    self.gauges[('worker_utilization', stage)] = record['worker_utilization']
+
+                if 'queue_depth' in record:
+                    self.gauges[('queue_depth', stage)] = record['queue_depth']
+
+                totals = self.totals.setdefault(stage, {'seconds':0.0, 'frames':0, 'bytes':0,
+                                                        'count':0})
+                totals['seconds'] += seconds
+                totals['frames'] += record['frames']
+                totals['bytes'] += record['bytes']
+                totals['count'] += 1
+
+            self._write(record)
+
+    def gauge(self, name:str, value:float, **labels) -> None:
+        """Function to record a single value, e.g. the number of hours left."""
+
+        with self._lock:
+            self.gauges[(name, labels.get('stage', ''))] = value
+        self._write(dict({'time':datetime.now().isoformat(timespec='seconds'),
+                          'run':self.name, 'gauge':name, 'value':value}, **labels))
+
+    def unit_done(self, n:int=1) -> None:
+        """Function to mark units of the run as finished and log progress if it's time."""
+
+        with self._lock:
+            self.done += n
+
+        if time.monotonic() - self.last_progress >= self.progress_every_s:
+            self.log_progress()
+
+        self.write_textfile()
+
+    def progress(self) -> dict:
+        """Function to get the progress, throughput and ETA of the run."""
+
+        elapsed = time.monotonic() - self.start_time
+        with self._lock:
+            done = self.done
+            frames = max([t['frames'] for t in self.totals.values()], default=0)
+
+        progress = {'done':done, 'total':self.total, 'elapsed_s':elapsed,
+                    'frames':frames, 'frames_per_s':frames/max(elapsed, 1e-9),
+                    'eta_s':None}
+
+        if self.total and done > 0:
+            progress['eta_s'] = elapsed/done*(self.total - done)
+
+        return progress
+
+    def log_progress(self) -> None:
+        """Function to log a progress summary with the time spent in each stage."""
+
+        progress = self.progress()
+        self.last_progress = time.monotonic()
+
+        with self._lock:
+            stage_seconds = {stage:t['seconds'] for stage, t in self.totals.items()}
+
+        stage_time = sum(stage_seconds.values())
+        stages = ', '.join('{} {:.0f}%'.format(stage, 100*t/max(stage_time, 1e-9))
+                           for stage, t in stage_seconds.items())
+
+        eta = ('unknown' if progress['eta_s'] is None
+               else str(timedelta(seconds=int(progress['eta_s']))))
+
+        logging.info('Progress {}/{}, {} frames at {:.1f} frames/s, ETA {}. Time in {}.'.format(
+            progress['done'], progress['total'] if self.total else '?', progress['frames'],
+            progress['frames_per_s'], eta, stages))
+
+        self._write(dict({'time':datetime.now().isoformat(timespec='seconds'),
+                          'run':self.name, 'progress':True}, **progress))
+
+    def write_textfile(self) -> None:
+        """Function to write the running totals in the Prometheus text format.
+        Written to a temporary file and renamed so the node exporter never reads half a file.
+        """
+
+        prefix = self.name
+        lines = []
+
+        with self._lock:
+            totals = {stage:dict(t) for stage, t in self.totals.items()}
+            gauges = dict(self.gauges)
+
+        for metric, key, about in [('stage_seconds_total', 'seconds', 'Seconds spent in each stage.'),
+                                   ('stage_frames_total', 'frames', 'Frames through each stage.'),
+                                   ('stage_bytes_total', 'bytes', 'Bytes through each stage.'),
+                                   ('stage_runs_total', 'count', 'Times each stage ran.')]:
+            lines.append('# HELP {}_{} {}'.format(prefix, metric, about))
+            lines.append('# TYPE {}_{} counter'.format(prefix, metric))
+            for stage, stage_totals in totals.items():
+                lines.append('{}_{}{{stage="{}"}} {}'.format(prefix, metric, stage, stage_totals[key]))
+
+        for (name, stage), value in gauges.items():
+            labels = '{{stage="{}"}}'.format(stage) if stage else ''
+            lines.append('{}_{}{} {}'.format(prefix, name, labels, value))
+
+        progress = self.progress()
+        lines.append('{}_rss_bytes {}'.format(prefix, rss_bytes()))
+        lines.append('{}_units_done {}'.format(prefix, progress['done']))
+        if self.total:
+            lines.append('{}_units_total {}'.format(prefix, self.total))
+        if progress['eta_s'] is not None:
+            lines.append('{}_eta_seconds {:.0f}'.format(prefix, progress['eta_s']))
+        lines.append('{}_last_update_timestamp_seconds {:.0f}'.format(prefix, time.time()))
+
+        tmp_file = self.prom_file + '.tmp'
+        with self._lock:
+            with open(tmp_file, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp_file, self.prom_file)
+
+    def close(self) -> None:
+        """Function to log the final summary and write the textfile one last time."""
+
+        self.log_progress()
+        self.write_textfile()
@@ -0,0 +1,203 @@
+"""
+Functions for opt-in tracing of runs in the Chrome trace-event format.
+When the ASI_TRACE_DIR environment variable is set, spans are recorded in
+the main process and in every pool worker (spawned workers inherit the
+variable) with their process and thread IDs. Each process appends its
+spans to its own file, named with the run it belongs to, and merge_traces
+combines the files of this run into one json file that can be opened in Perfetto (ui.perfetto.dev) or chrome://tracing.
+When tracing is off, span returns a shared do-nothing context manager.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+import atexit
+import contextlib
+import glob
+import json
+import logging
+import multiprocessing
+from multiprocessing import util
+import os
+import threading
+import time
+
+# Directory for trace files, tracing is off if this is None
+_trace_dir = os.environ.get('ASI_TRACE_DIR')
+
+# Run the trace files belong to, set by the first process that imports this
+# module and inherited by the workers it starts
+_run_id = os.environ.setdefault('ASI_TRACE_RUN', '{}-{}'.format(os.getpid(), int(time.time())))
+
+# Events recorded in this process but not yet written, _lock guards _events
+# and _write_lock keeps flushes from different threads from mixing lines
+_events = []
+_lock = threading.Lock()
+_write_lock = threading.Lock()
+_flush_every = 1000
+
+# Returned by span when tracing is off
+_null_span = contextlib.nullcontext()
+
+# pid the process metadata and exit handlers were set up for
+_setup_pid = None
+
+
+def tracing_enabled() -> bool:
+    """Function to check if tracing is on in this process."""
+
+    return _trace_dir is not None
+
+
+def enable_tracing(trace_dir:str) -> None:
+    """Function to turn tracing on for this process and any worker it starts later.
+    INPUT
+    trace_dir - directory to write the per-process trace files to
+    """
+
+    global _trace_dir
+
+    if not os.path.exists(trace_dir):
+        os.makedirs(trace_dir)
+
+    _trace_dir = trace_dir
+    os.environ['ASI_TRACE_DIR'] = trace_dir
+
+
+def _setup_process() -> None:
+    """Function to add the process name and register the flush at exit, once per
+    process. Called with _lock held.
+    """
+
+    global _setup_pid
+
+    _setup_pid = os.getpid()
+    if not os.path.exists(_trace_dir):
+        os.makedirs(_trace_dir, exist_ok=True)
+
+    _events.append({'name':'process_name', 'ph':'M', 'pid':_setup_pid, 'tid':0,
+                    'args':{'name':'{} ({})'.format(multiprocessing.current_process().name,
+                                                    _setup_pid)}})
+
+    # Pool workers don't run atexit handlers, but do run multiprocessing finalizers
+    util.Finalize(None, flush, exitpriority=100)
+    atexit.register(flush)
+
+
+class _Span:
+    """Records one complete (ph X) event between enter and exit."""
+
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name:str, args:dict):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.time_ns()
+
+        event = {'name':self.name, 'ph':'X', 'ts':self.start/1000, 'dur':(end - self.start)/1000,
+                 'pid':os.getpid(), 'tid':threading.get_native_id()}
+        if self.args:
+            event['args'] = {k:str(v) for k, v in self.args.items()}
+        if exc_type is not None:
+            event.setdefault('args', {})['error'] = repr(exc_value)
+
+        with _lock:
+            if _setup_pid != os.getpid():
+                _setup_process()
+
+            _events.append(event)
+            full = len(_events) >= _flush_every
+
+        if full:
+            flush()
+
+        return False
+
+
+def span(name:str, **args):
+    """Function to record a span around a block of code, e.g.
+    with span('model.predict', frames=len(frames)):
+        preds = model.predict(frames)
+    INPUT
+    name - name of the span
+    args - extra values shown with the span
+    OUTPUT
+    context manager
+    """
+
+    if _trace_dir is None:
+        return _null_span
+
+    return _Span(name, args)
+
+
+def flush() -> None:
+    """Function to append the recorded events of this process to its trace file."""
+
+    global _events
+
+    if _trace_dir is None:
+        return
+
+    # Swap the list so spans recorded while writing go to the next flush
+    with _lock:
+        events, _events = _events, []
+
+    if len(events) == 0:
+        return
+
+    trace_part = os.path.join(_trace_dir, 'trace-{}-{}.jsonl'.format(_run_id, os.getpid()))
+    try:
+        with _write_lock, open(trace_part, 'a') as f:
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+    except OSError as e:
+        logging.warning('Unable to write trace events: {}'.format(e))
+
+
+def merge_traces(trace_dir:str=None, trace_file:str=None, remove_parts:bool=True,
+                 run_id:str=None) -> str:
+    """Function to merge the trace files of the processes of a run into one trace-event
+    json file. Files of other runs writing to the same directory are left alone.
+    INPUT
+    trace_dir - directory with the per-process trace files, defaults to the current one
+    trace_file - json file to write, defaults to trace_dir/trace.json
+    remove_parts - delete the merged per-process files
+    run_id - run to merge the files of, defaults to the run of this process
+    OUTPUT
+    trace_file - the merged file
+    """
+
+    flush()
+
+    trace_dir = _trace_dir if trace_dir is None else trace_dir
+    trace_file = os.path.join(trace_dir, 'trace.json') if trace_file is None else trace_file
+
+    run_id = _run_id if run_id is None else run_id
+    part_files = sorted(glob.glob(os.path.join(trace_dir,
+                                               'trace-{}-*.jsonl'.format(glob.escape(run_id)))))
+    events = []
+    for part_file in part_files:
+        with open(part_file, 'r') as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+
+    events.sort(key=lambda e: e.get('ts', 0))
+
+    with open(trace_file, 'w') as f:
+        json.dump({'traceEvents':events, 'displayTimeUnit':'ms'}, f)
+
+    if remove_parts:
+        for part_file in part_files:
+            os.remove(part_file)
+
+    logging.info('Merged {} trace events from {} processes into {}.'.format(len(events),
+                                                                           len(part_files),
+                                                                           trace_file))
+
+    return trace_file
@@ -0,0 +1,218 @@
+"""
+Functions to stream labeled training and evaluation data from the daily h5
+image files into tf.data. Labels come from the catalog compiled from the
+classification spreadsheets in docs/classifications/ and are attached to
+frames with a vectorized interval join on the epoch_us timestamps, so only
+frame times are read up front. Frames are read lazily in blocks from many files at once
+with a parallel interleave, and the same preprocessing used by all_tasks.py
+(256x256, elevation cut, 224x224x3 float32) is done inside the graph.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+from datetime import datetime
+import h5py
+import logging
+import numpy
+import os
+import tensorflow as tf
+
+from src.data.h5_layout import read_frames
+from src.data.h5_reader import get_epoch_index, h5_station
+from src.data.label_catalog import catalog_frame_labels, lookup_labels, select_labels
+
+# Model classes in the order of the LabelBinarizer in lb_4c.pickle (sorted)
+model_classes = ['bad_viewing', 'no_aurora', 'other_aurora', 'pulsating']
+
+
+def label_frames(epoch_us:numpy.ndarray, catalog:dict, station:str, date:datetime,
+                 classes:list=model_classes) -> numpy.ndarray:
+    """Function to label every frame of a daily file with a vectorized interval join.
+    INPUT
+    epoch_us - sorted frame times in microseconds, see get_epoch_index
+    catalog - label catalog, see get_label_catalog
+    station - station of the file
+    date - day of the file
+    classes - class names, the label is the position in this list
+    OUTPUT
+    frame_labels - int array with the class of each frame, -1 if unlabeled
+    """
+
+    # Position of each catalog label in classes, -1 for labels without a model class
+    class_lookup = {c.encode():n for n, c in enumerate(classes)}
+    class_index = numpy.array([class_lookup.get(l, -1) for l in catalog['label']], dtype='int64')
+
+    frame_labels = numpy.full(len(epoch_us), -1, dtype='int64')
+    if len(class_index) == 0:
+        return frame_labels
+
+    rows = lookup_labels(catalog, station, epoch_us)
+    frame_labels[rows >= 0] = class_index[rows[rows >= 0]]
+
+    # Labels with only a frame range on this day
+    for row in catalog_frame_labels(catalog, station, date):
+        frame_labels[catalog['start_frame'][row]:catalog['end_frame'][row] + 1] = class_index[row]
+
+    return frame_labels
+
+
+def build_frame_index(h5_files:list, catalog:dict, classes:list=model_classes,
+                      min_confidence:float=None) -> list:
+    """Function to find the labeled frames of each daily h5 file.
+    Only the frame times are read, not the images.
+    INPUT
+    h5_files - daily h5 files
+    catalog - label catalog, see get_label_catalog
+    classes - class names, the label is the position in this list
+    min_confidence - skip labels below this confidence, labels without one are kept
+    OUTPUT
+    frame_index - list of (h5file, frames, frame_labels) for files with labeled frames
+    """
+
+    if min_confidence is not None:
+        catalog = select_labels(catalog, ~(catalog['confidence'] < min_confidence))
+
+    frame_index = []
+
+    for h5file in h5_files:
+        try:
+            with h5py.File(h5file, 'r') as h5f:
+                epoch_us = get_epoch_index(h5f)
+        except Exception as e:
+            logging.warning('Unable to read times from {}, skipping. {}'.format(h5file, e))
+            continue
+
+        date = datetime.strptime(os.path.basename(h5file)[11:21], '%Y-%m-%d')
+        frame_labels = label_frames(epoch_us, catalog, h5_station(h5file), date,
+                                    classes=classes)
+
+        frames = numpy.nonzero(frame_labels >= 0)[0]
+        if len(frames) > 0:
+            frame_index.append((h5file, frames, frame_labels[frames]))
+
+    logging.info('Found {} labeled frames in {} of {} files.'.format(sum(len(f[1]) for f in frame_index),
+                                                                  len(frame_index), len(h5_files)))
+
+    return frame_index
+
+
+def _frame_generator(h5file:bytes, frames:numpy.ndarray, frame_labels:numpy.ndarray,
+                     block:int, max_gap:int=16):
+    """Generator of (image, label) for the labeled frames of one file,
+    reading contiguous blocks rather than single frames. A block ends after
+    block labeled frames or where the next labeled frame is more than
+    max_gap frames away, so sparse labels don't read the frames between them.
+    """
+
+    # First labeled frame of each block
+    starts = set(range(0, len(frames), block))
+    starts.update((numpy.nonzero(numpy.diff(frames) > max_gap)[0] + 1).tolist())
+    starts = sorted(starts)
+
+    with h5py.File(h5file.decode(), 'r') as h5f:
+        img_ds = h5f['images']
+
+        for first, last in zip(starts, starts[1:] + [len(frames)]):
+            block_frames = frames[first:last]
+            images = read_frames(img_ds, block_frames[0], block_frames[-1] + 1)
+
+            for frame, label in zip(block_frames - block_frames[0], frame_labels[first:last]):
+                yield images[frame], label
+
+
+def make_preprocess_fn(elev_angle:numpy.ndarray=None, angle:float=15):
+    """Function to make the in-graph version of the all_tasks.py preprocessing.
+    Images in the h5 files are already CLAHE processed to 8-bit.
+    INPUT
+    elev_angle - (256, 256) elevation angle of each pixel, e.g. models/CNN_model/T_angle.npy,
+                 None to skip the elevation cut (PFRR)
+    angle - pixels below this elevation are set to 0
+    OUTPUT
+    preprocess - function of a (rows, columns) uint8 image to a (224, 224, 3) float32 tensor
+    """
+
+    mask = None
+    if elev_angle is not None:
+        mask = tf.constant((elev_angle >= angle)[:, :, numpy.newaxis], dtype=tf.float32)
+
+    def preprocess(image):
+        image = tf.cast(image[:, :, tf.newaxis], tf.float32)
+        if mask is not None:
+            image = tf.image.resize(image, (256, 256)) * mask
+        image = tf.image.resize(image, (224, 224))
+
+        # Same value in all 3 channels like GRAY2BGR
+        return tf.tile(image, (1, 1, 3))
+
+    return preprocess
+
+
+def make_dataset(frame_index:list, classes:list=model_classes, batch_size:int=32,
+                 elev_angle:numpy.ndarray=None, angle:float=15, shuffle:bool=True,
+                 shuffle_buffer:int=2000, cycle_length:int=4, block:int=256,
+                 max_gap:int=16, seed:int=None) -> tf.data.Dataset:
+    """Function to create a tf.data dataset streaming labeled frames from h5 files.
+    Several files are read at once with a parallel interleave, frames are
+    preprocessed in parallel in the graph, and batches are prefetched.
+    INPUT
+    frame_index - labeled frames, see build_frame_index
+    classes - class names, labels are one-hot in this order
+    batch_size - frames per batch
+    elev_angle, angle - elevation cut, see make_preprocess_fn
+    shuffle - whether to shuffle files and frames, False for evaluation
+    shuffle_buffer - how many frames to shuffle between
+    cycle_length - how many files to read from at once
+    block - how many labeled frames to read from a file at a time
+    max_gap - also start a new read where labeled frames are further apart than this
+    seed - random seed for shuffling
+    OUTPUT
+    dataset - dataset of (images, one-hot labels) batches
+    """
+
+    h5_files = [f[0] for f in frame_index]
+
+    def _file_dataset(n):
+        return tf.data.Dataset.from_generator(
+            lambda n: _frame_generator(h5_files[n].encode(), frame_index[n][1],
+                                       frame_index[n][2], block, max_gap),
+            args=(n,),
+            output_signature=(tf.TensorSpec(shape=(None, None), dtype=tf.uint8),
+                              tf.TensorSpec(shape=(), dtype=tf.int64)))
+
+    dataset = tf.data.Dataset.range(len(frame_index))
+    if shuffle:
+        dataset = dataset.shuffle(len(frame_index), seed=seed, reshuffle_each_iteration=True)
+
+    dataset = dataset.interleave(_file_dataset, cycle_length=cycle_length, block_length=1,
+                                 num_parallel_calls=tf.data.AUTOTUNE,
+                                 deterministic=not shuffle)
+
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+
+    preprocess = make_preprocess_fn(elev_angle, angle=angle)
+    dataset = dataset.map(lambda image, label: (preprocess(image),
+                                                tf.one_hot(label, len(classes))),
+                          num_parallel_calls=tf.data.AUTOTUNE,
+                          deterministic=not shuffle)
+
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def split_frame_index(frame_index:list, val_fraction:float=0.2, seed:int=0) -> tuple:
+    """Function to split a frame index into training and validation sets by file,
+    so frames from the same station and day never end up in both.
+    INPUT
+    frame_index - labeled frames, see build_frame_index
+    val_fraction - fraction of files to use for validation
+    seed - random seed for the split
+    OUTPUT
+    train_index, val_index - frame indices
+    """
+
+    order = numpy.random.default_rng(seed).permutation(len(frame_index))
+    n_val = int(round(val_fraction*len(frame_index)))
+
+    return ([frame_index[n] for n in sorted(order[n_val:])],
+            [frame_index[n] for n in sorted(order[:n_val])])